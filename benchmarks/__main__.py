@@ -0,0 +1,18 @@
+"""Run benchmarks of the checker, the writer and memory of checks with default parameters"""
+import argparse
+
+from benchmarks import bench_checker, bench_memory, bench_writer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', nargs='?', choices=['checker', 'writer', 'memory'], help='run only one benchmark')
+    args = parser.parse_args()
+    for name, module in [('checker', bench_checker), ('writer', bench_writer), ('memory', bench_memory)]:
+        if args.name and args.name != name:
+            continue
+        bench_args = argparse.ArgumentParser()
+        module.add_arguments(bench_args)
+        print(f'{name}:')
+        for k, v in module.run_args(bench_args.parse_args([])).items():
+            print(f'  {k}: {v}')
@@ -0,0 +1,91 @@
+"""Throughput of health_checker against fake fleet of sites: checks per second, scheduler lateness and peak RSS"""
+import argparse
+import resource
+import time
+from typing import List
+from unittest import mock
+
+import health_checker
+from sites_loader import parse_check_settings
+
+from benchmarks.fakes import FakeProducer
+from benchmarks.fleet import FleetConfig, fleet_sites, start_fleet
+
+
+class Recorder:
+    """Stand-in of histogram keeping all observed values"""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value: float, **labels):
+        self.values.append(value)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(sites_count: int = 2000, duration: float = 20, interval: float = 5, scheduler: str = 'loop',
+        spread: bool = True, hosts: int = 16, port: int = 18080, config: FleetConfig = None) -> dict:
+    fleet = start_fleet(port, hosts, config or FleetConfig())
+    try:
+        sites = fleet_sites(sites_count, port, hosts, interval)
+        for site in sites.values():
+            parse_check_settings(site)
+        producer = FakeProducer()
+        lateness = Recorder()
+        with mock.patch.object(health_checker, 'SCHEDULE_LATENESS', lateness), \
+                mock.patch.object(health_checker, 'SCHEDULER', scheduler), \
+                mock.patch.object(health_checker, 'SCHEDULE_SPREAD', spread):
+            start = time.perf_counter()
+            health_checker.start_checking(producer, sites, timeout=duration)
+            elapsed = time.perf_counter() - start
+    finally:
+        fleet.terminate()
+        fleet.join()
+
+    return {
+        'checks': producer.sent,
+        'checks_per_sec': round(producer.sent / elapsed, 1),
+        'expected_checks_per_sec': round(sites_count / interval, 1),
+        'lateness_p50': round(percentile(lateness.values, 0.5), 4),
+        'lateness_p99': round(percentile(lateness.values, 0.99), 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--sites', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--interval', type=float, default=5, help='interval of checks in seconds')
+    parser.add_argument('--scheduler', choices=['apscheduler', 'loop'], default='loop')
+    parser.add_argument('--no-spread', dest='spread', action='store_false')
+    parser.add_argument('--hosts', type=int, default=16, help='number of loopback addresses of fleet')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of sites in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--size', type=int, default=10000, help='body size in bytes')
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--timeout-rate', type=float, default=0.01)
+
+
+def run_args(args: argparse.Namespace) -> dict:
+    config = FleetConfig(latency=args.latency, jitter=args.jitter, size=args.size, error_rate=args.error_rate,
+                         timeout_rate=args.timeout_rate)
+    return run(sites_count=args.sites, duration=args.duration, interval=args.interval, scheduler=args.scheduler,
+               spread=args.spread, hosts=args.hosts, port=args.port, config=config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    for k, v in run_args(parser.parse_args()).items():
+        print(f'{k}: {v}')
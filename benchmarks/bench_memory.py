@@ -0,0 +1,118 @@
+"""Memory of scheduled checks and their results: bytes per site of job arguments and bytes per check of results,
+plain dicts against slotted CheckSpec and CheckResult"""
+import argparse
+import asyncio
+from datetime import datetime
+import gc
+import tracemalloc
+from typing import Callable
+from uuid import uuid4
+
+import broker
+from checks import CheckResult, CheckSpec
+from scheduler import LoopScheduler
+import sites_loader
+
+
+def make_sites(count: int) -> dict:
+    """Parsed sites like loaded from sites file, every third one with regexp, every fifth one with headers"""
+    sites = {}
+    for i in range(count):
+        site = {'url': f'https://site{i}.example.com/health', 'seconds': 10, 'timeout': 5}
+        if i % 3 == 0:
+            site['regexp'] = r'version: \d+'
+        if i % 5 == 0:
+            site.update(method='POST', headers={'X-API-KEY': f'key{i}'}, data='ping')
+        sites_loader.parse_check_settings(site)
+        sites[f'site{i}'] = site
+    return sites
+
+
+def site_data(site: dict) -> dict:
+    return {k: v for k, v in site.items() if k not in sites_loader.TRIGGER_FIELDS}
+
+
+def schedule_dicts(schedule: LoopScheduler, sites: dict):
+    """Jobs with arguments as they were passed to check_website before CheckSpec"""
+    for check_name, site in sites.items():
+        data = site_data(site)
+        schedule.add_job(noop, id=check_name, seconds=10, kwargs={
+            'check_name': check_name, **data, 'regexp': data.get('regexp') or None})
+
+
+def schedule_specs(schedule: LoopScheduler, sites: dict):
+    for check_name, site in sites.items():
+        schedule.add_job(noop, id=check_name, seconds=10, args=(CheckSpec.from_site(check_name, site_data(site)),))
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def measure_jobs(sites: dict, schedule_jobs: Callable[[LoopScheduler, dict], None]) -> float:
+    """Bytes per site of scheduled jobs, scheduler isn't started so jobs have no timers"""
+    loop = asyncio.new_event_loop()
+    try:
+        gc.collect()
+        tracemalloc.start()
+        schedule = LoopScheduler(event_loop=loop)
+        schedule_jobs(schedule, sites)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del schedule
+    finally:
+        loop.close()
+    return round(size / len(sites), 1)
+
+
+def dict_result(i: int, timings: dict) -> dict:
+    """Result as it was built by check_resp before CheckResult, id and dt are formatted on event loop"""
+    return {
+        'id': str(uuid4()), 'check_name': f'site{i}', 'dt': datetime.now().isoformat(), 'health': True,
+        'status': 200, 'duration': 0.05, 'length': 10000, 'sample': None,
+        **{k: None if v is None else round(v, 6) for k, v in timings.items()},
+    }
+
+
+def slots_result(i: int, timings: dict) -> CheckResult:
+    return CheckResult(id=uuid4(), check_name=f'site{i}', dt=datetime.now(), health=True, status=200, duration=0.05,
+                       length=10000, sample=None, timings=timings)
+
+
+def measure(count: int, build: Callable[[int], object]) -> float:
+    """Bytes allocated per item by `build(i)` for items which are kept alive"""
+    gc.collect()
+    tracemalloc.start()
+    items = [build(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return round(size / count, 1)
+
+
+def run(sites_count: int = 100000) -> dict:
+    sites = make_sites(sites_count)
+    # check names are shared by results, timings dict is built by tracer of each request
+    timings = dict.fromkeys(broker.TIMING_FIELDS, 0.0123456789)
+    return {
+        'sites': sites_count,
+        'job_dict_bytes': measure_jobs(sites, schedule_dicts),
+        'job_spec_bytes': measure_jobs(sites, schedule_specs),
+        'result_dict_bytes': measure(sites_count, lambda i: dict_result(i, dict(timings))),
+        'result_slots_bytes': measure(sites_count, lambda i: slots_result(i, dict(timings))),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--sites', type=int, default=100000)
+
+
+def run_args(args: argparse.Namespace) -> dict:
+    return run(sites_count=args.sites)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    for k, v in run_args(parser.parse_args()).items():
+        print(f'{k}: {v}')
@@ -0,0 +1,75 @@
+"""Throughput of db_writer with in-memory consumer and sqlite (or stub) database: rows per second and peak RSS"""
+import argparse
+from datetime import datetime, timedelta
+import time
+from unittest import mock
+from uuid import uuid4
+
+import broker
+import db_writer
+
+from benchmarks.bench_checker import peak_rss_mb
+from benchmarks.fakes import ConsumerDrained, FakeConsumer, SqliteDb
+
+
+def make_messages(count: int, serializer: str = 'json') -> list:
+    """Serialized results of 1000 checks run every 10 seconds with headers like published by health_checker"""
+    headers = broker.message_headers(serializer)
+    start = datetime(2023, 1, 1)
+    return [(broker.serialize({
+        'id': str(uuid4()),
+        'check_name': f'site{i % 1000}',
+        'dt': (start + timedelta(seconds=i // 1000 * 10, microseconds=i % 1000)).isoformat(),
+        'health': i % 10 != 0,
+        'status': 200 if i % 10 else 500,
+        'duration': 0.05 + (i % 100) / 1000,
+        'length': 10000,
+        'sample': '12345' if i % 10 else None,
+    }, serializer), headers) for i in range(count)]
+
+
+def run(count: int = 200000, serializer: str = 'json', stub: bool = False, pipeline: bool = False,
+        connections: int = 2, batch: int = 500, transitions: bool = False) -> dict:
+    fake_db = SqliteDb(stub=stub)
+    consumer = FakeConsumer(make_messages(count, serializer), max_poll_records=batch)
+    with mock.patch.object(db_writer, 'db', fake_db), mock.patch.object(db_writer, 'WRITE_TRANSITIONS', transitions):
+        start = time.perf_counter()
+        try:
+            if pipeline:
+                db_writer.write_pipelined(consumer, [fake_db.get_connect() for _ in range(connections)],
+                                          maintenance=False, ordered_conn=fake_db.get_connect())
+            else:
+                db_writer.write_forever(consumer, fake_db.get_connect(), maintenance=False)
+        except ConsumerDrained:
+            pass
+        elapsed = time.perf_counter() - start
+
+    return {
+        'messages': count,
+        'rows': fake_db.rows,
+        'rows_per_sec': round(fake_db.rows / elapsed, 1),
+        'messages_per_sec': round(count / elapsed, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--serializer', choices=['json', 'binary'], default='json')
+    parser.add_argument('--stub', action='store_true', help='count records instead of inserting them into sqlite')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--connections', type=int, default=2, help='connections of pipelined mode')
+    parser.add_argument('--batch', type=int, default=500, help='max records per poll')
+    parser.add_argument('--transitions', action='store_true', help='write only changes of states')
+
+
+def run_args(args: argparse.Namespace) -> dict:
+    return run(count=args.messages, serializer=args.serializer, stub=args.stub, pipeline=args.pipeline,
+               connections=args.connections, batch=args.batch, transitions=args.transitions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    for k, v in run_args(parser.parse_args()).items():
+        print(f'{k}: {v}')
@@ -0,0 +1,115 @@
+from collections import namedtuple
+import sqlite3
+from typing import Dict, List
+
+from kafka.structs import TopicPartition
+
+import broker
+
+
+class FakeFuture:
+    def add_errback(self, f, *args, **kwargs):
+        return self
+
+    def get(self, timeout=None):
+        return None
+
+
+class FakeProducer:
+    """In-memory stand-in of KafkaProducer, values are serialized like by the real one"""
+
+    def __init__(self, keep: bool = False):
+        self.sent = 0
+        self.bytes = 0
+        self.keep = keep
+        self.messages = []
+
+    def send(self, topic_name: str, value: dict, key: str = None, headers: list = None) -> FakeFuture:
+        data = broker.serialize(value)
+        self.sent += 1
+        self.bytes += len(data)
+        if self.keep:
+            self.messages.append((data, headers))
+        return FakeFuture()
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self):
+        pass
+
+
+FakeRecord = namedtuple('FakeRecord', ['topic', 'partition', 'offset', 'value', 'headers'])
+
+
+class ConsumerDrained(Exception):
+    pass
+
+
+class FakeConsumer:
+    """In-memory stand-in of KafkaConsumer of single partition, raises ConsumerDrained when all messages are polled"""
+
+    def __init__(self, messages: List[tuple], max_poll_records: int = 500, topic_name: str = 'benchmark'):
+        self.tp = TopicPartition(topic_name, 0)
+        self.records = [FakeRecord(topic_name, 0, offset, data, headers)
+                        for offset, (data, headers) in enumerate(messages)]
+        self.max_poll_records = max_poll_records
+        self.position = 0
+        self.committed = 0
+
+    def poll(self, timeout_ms=None) -> Dict[TopicPartition, List[FakeRecord]]:
+        if self.position >= len(self.records):
+            raise ConsumerDrained()
+        batch = self.records[self.position:self.position + self.max_poll_records]
+        self.position += len(batch)
+        return {self.tp: batch}
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return len(self.records)
+
+    def commit(self, offsets=None):
+        self.committed = self.position
+
+    def close(self):
+        pass
+
+
+class SqliteDb:
+    """Stand-in of db module for db_writer, records are inserted into in-memory sqlite or only counted by stub"""
+    PARTITION_BY = None
+    ROLLUPS = False
+    ROLLUP_FIELDS = []
+    TIMING_COLUMNS = False
+    CHECK_IDS = False
+    OUTAGES = False
+    FIELDS = ['id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample']
+
+    def __init__(self, stub: bool = False):
+        self.stub = stub
+        self.rows = 0
+        self.offsets = {}
+
+    def get_connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        conn.execute(f'CREATE TABLE health_checks ({", ".join(self.FIELDS)}, PRIMARY KEY (id))')
+        return conn
+
+    def write_records(self, conn: sqlite3.Connection, recs: List[dict], **kwargs) -> List[dict]:
+        self.rows += len(recs)
+        if not self.stub:
+            conn.executemany(
+                f'INSERT OR IGNORE INTO health_checks VALUES ({", ".join("?" * len(self.FIELDS))})',
+                [tuple(rec[k] for k in self.FIELDS) for rec in recs])
+        return []
+
+    def update_rollups(self, conn: sqlite3.Connection, recs: List[dict]):
+        pass
+
+    def get_offsets(self, conn: sqlite3.Connection, partitions: list) -> dict:
+        return {tp: self.offsets[tp] for tp in partitions if tp in self.offsets}
+
+    def save_offsets(self, conn: sqlite3.Connection, offsets: dict):
+        self.offsets.update(offsets)
+
+    def do_commit(self, conn: sqlite3.Connection):
+        conn.commit()
@@ -0,0 +1,82 @@
+import asyncio
+import multiprocessing
+import random
+import time
+from typing import List
+
+from aiohttp import web
+
+
+class FleetConfig:
+    """Behaviour of fake sites: latency, body size and mix of failures"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.05, size: int = 10000, error_rate: float = 0.05,
+                 timeout_rate: float = 0.01, hang: float = 10):
+        self.latency = latency
+        self.jitter = jitter
+        self.size = size
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+
+
+def make_body(size: int) -> bytes:
+    """Page of `size` bytes with the value matched by benchmark regexp at the end"""
+    tail = b' value 12345 </html>'
+    return b'<html>' + b'x' * max(0, size - len(tail) - 6) + tail
+
+
+def create_app(config: FleetConfig) -> web.Application:
+    body = make_body(config.size)
+
+    async def handle_site(request: web.Request) -> web.Response:
+        dice = random.random()
+        if dice < config.timeout_rate:
+            await asyncio.sleep(config.hang)
+        await asyncio.sleep(max(0.0, random.uniform(config.latency - config.jitter, config.latency + config.jitter)))
+        if dice < config.timeout_rate + config.error_rate:
+            return web.Response(status=500, text='internal server error')
+        return web.Response(body=body, content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/site/{n}', handle_site)
+    return app
+
+
+def fleet_hosts(hosts: int) -> List[str]:
+    """Loopback addresses of fleet, so connection limit per host of checker isn't hit by single address"""
+    return [f'127.0.0.{i + 1}' for i in range(hosts)]
+
+
+def serve(port: int, hosts: int, config: FleetConfig):
+    async def run():
+        runner = web.AppRunner(create_app(config), access_log=None)
+        await runner.setup()
+        for host in fleet_hosts(hosts):
+            await web.TCPSite(runner, host, port).start()
+        while True:
+            await asyncio.sleep(3600)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def start_fleet(port: int, hosts: int, config: FleetConfig) -> multiprocessing.Process:
+    """Run fleet in separate process, so it doesn't share CPU of event loop with the checker"""
+    proc = multiprocessing.Process(target=serve, args=(port, hosts, config), name='fleet', daemon=True)
+    proc.start()
+    time.sleep(1)
+    return proc
+
+
+def fleet_sites(count: int, port: int, hosts: int, interval: float, timeout: float = 3) -> dict:
+    """Definitions of sites like in sites file, spread across hosts of fleet"""
+    addresses = fleet_hosts(hosts)
+    return {f'site{n}': {
+        'url': f'http://{addresses[n % hosts]}:{port}/site/{n}',
+        'seconds': interval,
+        'timeout': timeout,
+        'regexp': r'(?<=value )\d+',
+    } for n in range(count)}
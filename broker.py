@@ -1,8 +1,13 @@
+from datetime import datetime, timedelta
 import json
 import logging
+import math
+import struct
+from typing import List, Mapping, Optional, Tuple
+from uuid import UUID
 
 from kafka import KafkaProducer, KafkaConsumer, KafkaAdminClient
-from kafka.admin import NewTopic
+from kafka.admin import NewPartitions, NewTopic
 
 
 # define settings default values
@@ -10,6 +15,16 @@ KAFKA_BOOTSTRAP_SERVERS = "127.0.0.1:9092"
 TOPIC_NAME = "health_checker"
 KAFKA_CLIENT_ID = "CONSUMER_CLIENT_ID1"
 KAFKA_GROUP_ID = "CONSUMER_GROUP_ID"
+# number of partitions limits number of parallel consumers of db_writer
+TOPIC_PARTITIONS = 1
+TOPIC_REPLICATION_FACTOR = 2
+
+# producer batching settings, compression: None, 'gzip', 'snappy', 'lz4' or 'zstd' (lz4/zstd need extra packages)
+PRODUCER_LINGER_MS = 50
+PRODUCER_BATCH_SIZE = 64 * 1024
+PRODUCER_COMPRESSION = None
+# format of published messages: 'json' or 'binary', consumer reads both of them by message header
+SERIALIZER = 'json'
 
 # override settings by local values
 try:
@@ -21,10 +36,148 @@ except ImportError:
 log = logging.getLogger('app.broker')
 
 
-def create_topic_if_not_exists(admin: KafkaAdminClient, topic_name: str):
+def create_topic_if_not_exists(admin: KafkaAdminClient, topic_name: str, num_partitions: int = None):
+    """Create topic or increase number of its partitions up to `num_partitions`"""
+    num_partitions = num_partitions or TOPIC_PARTITIONS
     if topic_name not in admin.list_topics():
-        log.warning(f'create topic {topic_name}')
-        admin.create_topics(new_topics=[NewTopic(name=topic_name, num_partitions=1, replication_factor=2)])
+        log.warning(f'create topic {topic_name} with {num_partitions} partitions')
+        admin.create_topics(new_topics=[NewTopic(
+            name=topic_name, num_partitions=num_partitions, replication_factor=TOPIC_REPLICATION_FACTOR)])
+        return
+
+    topic, = admin.describe_topics([topic_name])
+    if len(topic['partitions']) < num_partitions:
+        log.warning(f'increase partitions of topic {topic_name} from {len(topic["partitions"])} to {num_partitions}')
+        admin.create_partitions({topic_name: NewPartitions(total_count=num_partitions)})
+
+
+FORMAT_HEADER = 'format'
+
+# durations of request phases and CPU time of regexp search in check result, optional
+TIMING_FIELDS = ['dns', 'connect', 'ttfb', 'download', 'regexp']
+
+# binary format: fixed head, length-prefixed check_name and optional fields marked by flags
+BINARY_MAGIC = 0xC4
+BINARY_VERSION = 1
+BINARY_HEAD = struct.Struct('<BB16sqB')     # magic, version, id, dt as epoch micros, flags
+BINARY_FIELDS = ['id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample']
+FLAG_HEALTH, FLAG_STATUS, FLAG_DURATION, FLAG_LENGTH, FLAG_SAMPLE, FLAG_EXTRA = 1, 2, 4, 8, 16, 32
+# timings are packed after all other fields as doubles (NaN for None), so readers not knowing the flag ignore them;
+# new timings are appended to the end, so readers know number of timings by length of message
+FLAG_TIMINGS = 64
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def serialize_json(value: Mapping) -> bytes:
+    # results of checks are mappings formatting their values on access
+    return json.dumps(value if isinstance(value, dict) else dict(value)).encode('utf-8')
+
+
+def deserialize_json(data: bytes) -> dict:
+    return json.loads(data.decode('utf-8'))
+
+
+def pack_str(value: str, fmt: str = '<I') -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack(fmt, len(data)) + data
+
+
+def unpack_str(data: bytes, offset: int, fmt: str = '<I') -> Tuple[str, int]:
+    size, = struct.unpack_from(fmt, data, offset)
+    offset += struct.calcsize(fmt)
+    return data[offset:offset + size].decode('utf-8'), offset + size
+
+
+def serialize_binary(value: Mapping) -> bytes:
+    """Pack check result: 16-byte id, epoch micros dt, flags and present fields only, unknown fields as json"""
+    flags = FLAG_HEALTH if value.get('health') else 0
+    parts = [pack_str(value['check_name'], '<H')]
+    if value.get('status') is not None:
+        flags |= FLAG_STATUS
+        parts.append(struct.pack('<H', int(value['status'])))
+    if value.get('duration') is not None:
+        flags |= FLAG_DURATION
+        parts.append(struct.pack('<d', value['duration']))
+    if value.get('length') is not None:
+        flags |= FLAG_LENGTH
+        parts.append(struct.pack('<Q', value['length']))
+    if value.get('sample') is not None:
+        flags |= FLAG_SAMPLE
+        parts.append(pack_str(value['sample']))
+    extra = {k: v for k, v in value.items() if k not in BINARY_FIELDS and k not in TIMING_FIELDS}
+    if extra:
+        flags |= FLAG_EXTRA
+        parts.append(pack_str(json.dumps(extra)))
+    if any(k in value for k in TIMING_FIELDS):
+        flags |= FLAG_TIMINGS
+        timings = [math.nan if value.get(k) is None else value[k] for k in TIMING_FIELDS]
+        parts.append(struct.pack(f'<{len(timings)}d', *timings))
+
+    dt = (datetime.fromisoformat(value['dt']) - EPOCH) // MICROSECOND
+    head = BINARY_HEAD.pack(BINARY_MAGIC, BINARY_VERSION, UUID(value['id']).bytes, dt, flags)
+    return head + b''.join(parts)
+
+
+def deserialize_binary(data: bytes) -> dict:
+    magic, version, id, dt, flags = BINARY_HEAD.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f'unknown binary message format {magic:#x} version {version}')
+    check_name, offset = unpack_str(data, BINARY_HEAD.size, '<H')
+    value = {
+        'id': str(UUID(bytes=id)),
+        'check_name': check_name,
+        'dt': (EPOCH + dt * MICROSECOND).isoformat(),
+        'health': bool(flags & FLAG_HEALTH),
+        'status': None,
+        'duration': None,
+        'length': None,
+        'sample': None,
+    }
+    if flags & FLAG_STATUS:
+        value['status'], = struct.unpack_from('<H', data, offset)
+        offset += 2
+    if flags & FLAG_DURATION:
+        value['duration'], = struct.unpack_from('<d', data, offset)
+        offset += 8
+    if flags & FLAG_LENGTH:
+        value['length'], = struct.unpack_from('<Q', data, offset)
+        offset += 8
+    if flags & FLAG_SAMPLE:
+        value['sample'], offset = unpack_str(data, offset)
+    if flags & FLAG_EXTRA:
+        extra, offset = unpack_str(data, offset)
+        value.update(json.loads(extra))
+    if flags & FLAG_TIMINGS:
+        count = min(len(TIMING_FIELDS), (len(data) - offset) // 8)
+        timings = struct.unpack_from(f'<{count}d', data, offset)
+        value.update((k, None if math.isnan(v) else v) for k, v in zip(TIMING_FIELDS, timings))
+    return value
+
+
+SERIALIZERS = {
+    'json': (serialize_json, deserialize_json),
+    'binary': (serialize_binary, deserialize_binary),
+}
+
+
+def serialize(value: Mapping, fmt: str = None) -> bytes:
+    return SERIALIZERS[fmt or SERIALIZER][0](value)
+
+
+def message_headers(fmt: str = None) -> List[Tuple[str, bytes]]:
+    return [(FORMAT_HEADER, (fmt or SERIALIZER).encode('utf-8'))]
+
+
+def deserialize(data: bytes, headers: Optional[List[Tuple[str, bytes]]] = None) -> dict:
+    """Deserialize message by format from headers, messages without format header are json"""
+    fmt = dict(headers or []).get(FORMAT_HEADER, b'json').decode('utf-8')
+    if fmt not in SERIALIZERS:
+        raise ValueError(f'unknown message format {fmt}')
+    try:
+        return SERIALIZERS[fmt][1](data)
+    except struct.error as e:
+        raise ValueError(f'broken {fmt} message: {e}') from e
 
 
 def get_kafka_admin() -> KafkaAdminClient:
@@ -39,6 +192,10 @@ def get_kafka_admin() -> KafkaAdminClient:
     return admin
 
 
+def serialize_key(key: Optional[str]) -> Optional[bytes]:
+    return None if key is None else key.encode('utf-8')
+
+
 def get_kafka_producer() -> KafkaProducer:
     producer = KafkaProducer(
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
@@ -46,7 +203,11 @@ def get_kafka_producer() -> KafkaProducer:
         ssl_cafile="conf/ca.pem",
         ssl_certfile="conf/service.cert",
         ssl_keyfile="conf/service.key",
-        value_serializer=lambda v: json.dumps(v).encode('utf-8')
+        value_serializer=serialize,
+        key_serializer=serialize_key,
+        linger_ms=PRODUCER_LINGER_MS,
+        batch_size=PRODUCER_BATCH_SIZE,
+        compression_type=PRODUCER_COMPRESSION,
     )
     return producer
 
@@ -62,7 +223,7 @@ def get_kafka_consumer() -> KafkaConsumer:
         ssl_cafile="conf/ca.pem",
         ssl_certfile="conf/service.cert",
         ssl_keyfile="conf/service.key",
-        value_deserializer=lambda data: json.loads(data.decode('utf-8')),
+        # value is deserialized by db_writer according to format header of message
         auto_offset_reset='earliest',
         enable_auto_commit=False,
     )
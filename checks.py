@@ -0,0 +1,99 @@
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Union
+from uuid import UUID
+
+import broker
+
+
+class CheckSpec:
+    """Settings of scheduled check shared by all its runs.
+
+    Rarely used request arguments (headers, auth, data, max_bytes, conditional etc.) are kept in `options`, which
+    is None for most sites, so spec of plain site is a few pointers.
+    """
+    __slots__ = ('check_name', 'url', 'method', 'timeout', 'status', 'regexp', 'topic_name', 'options')
+
+    def __init__(self, check_name: str, url: str, method: str = None, timeout=None, status: Optional[int] = 200,
+                 regexp: str = None, topic_name: str = None, **options):
+        self.check_name = check_name
+        self.url = url
+        self.method = method
+        self.timeout = timeout
+        self.status = status
+        self.regexp = regexp
+        self.topic_name = topic_name
+        self.options: Optional[Dict[str, Any]] = options or None
+
+    @classmethod
+    def from_site(cls, check_name: str, site: dict) -> 'CheckSpec':
+        """Spec of parsed site definition without trigger fields, empty regexp means no regexp"""
+        return cls(check_name, **{**site, 'regexp': site.get('regexp') or None})
+
+    def __eq__(self, other):
+        if not isinstance(other, CheckSpec):
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return f'CheckSpec({self.check_name!r}, {self.url!r})'
+
+
+class CheckResult(Mapping):
+    """Result of check, read-only mapping of published fields.
+
+    Id and dt are kept as UUID and datetime, and timings as dict of request phases, their published values are
+    formatted on access, i.e. by serializer in publishing thread instead of event loop. `circuit` is set by circuit
+    breaker of the checker on change of its state and published only if it's set, as well as `failed_since`.
+    """
+    __slots__ = ('id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample', 'timings', 'circuit',
+                 'failed_since')
+
+    FIELDS = ('id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample')
+
+    def __init__(self, id: Union[UUID, str], check_name: str, dt: datetime, health: bool, status: Optional[int],
+                 duration: Optional[float], length: Optional[int], sample: Optional[str],
+                 timings: Dict[str, float] = None, circuit: str = None, failed_since: datetime = None):
+        self.id = id
+        self.check_name = check_name
+        self.dt = dt
+        self.health = health
+        self.status = status
+        self.duration = duration
+        self.length = length
+        self.sample = sample
+        self.timings = timings
+        self.circuit = circuit
+        self.failed_since = failed_since
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'id':
+            return str(self.id)
+        if key == 'dt':
+            return self.dt.isoformat()
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.timings is not None and key in broker.TIMING_FIELDS:
+            value = self.timings.get(key)
+            return None if value is None else round(value, 6)
+        if key == 'circuit' and self.circuit is not None:
+            return self.circuit
+        if key == 'failed_since' and self.failed_since is not None:
+            return self.failed_since.isoformat()
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.FIELDS
+        if self.timings is not None:
+            yield from broker.TIMING_FIELDS
+        if self.circuit is not None:
+            yield 'circuit'
+        if self.failed_since is not None:
+            yield 'failed_since'
+
+    def __len__(self) -> int:
+        return (len(self.FIELDS) + (len(broker.TIMING_FIELDS) if self.timings is not None else 0)
+                + (self.circuit is not None) + (self.failed_since is not None))
+
+    def __repr__(self):
+        return f'CheckResult({dict(self)!r})'
@@ -0,0 +1,106 @@
+from datetime import datetime
+import logging
+import time
+from typing import Dict, List, Optional
+
+
+# define settings default values
+# circuit of site is opened after CIRCUIT_FAILURES consecutive unhealthy checks, None - circuit breaking is disabled;
+# while circuit is open scheduled checks are skipped except probes, the first probe is run CIRCUIT_BACKOFF seconds
+# after opening and delay between failed probes grows by CIRCUIT_BACKOFF_FACTOR up to CIRCUIT_MAX_BACKOFF
+CIRCUIT_FAILURES = None
+CIRCUIT_BACKOFF = 30
+CIRCUIT_BACKOFF_FACTOR = 2
+CIRCUIT_MAX_BACKOFF = 600
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.circuit')
+
+# values of `circuit` field of results: check opened circuit (outage started), probe failed (circuit is still open),
+# probe succeeded (outage ended); results of checks with closed circuit have no such field. Result which opened
+# circuit has also `failed_since` field with dt of the first failed check
+OPENED = 'opened'
+OPEN = 'open'
+CLOSED = 'closed'
+
+
+class Circuit:
+    """Failures of site since dt of the first one, `next_probe` is in time.monotonic() time and set only when circuit
+    is open"""
+    __slots__ = ('failures', 'since', 'backoff', 'next_probe')
+
+    def __init__(self, since: Optional[datetime]):
+        self.failures = 0
+        self.since = since
+        self.backoff = 0.0
+        self.next_probe: Optional[float] = None
+
+
+class Circuits:
+    """Circuit breakers of sites by check_name, only sites with failures since the last healthy check are kept"""
+
+    def __init__(self, failures: int = None, backoff: float = None, factor: float = None, max_backoff: float = None):
+        self.failures = failures or CIRCUIT_FAILURES
+        self.backoff = backoff or CIRCUIT_BACKOFF
+        self.factor = factor or CIRCUIT_BACKOFF_FACTOR
+        self.max_backoff = max_backoff or CIRCUIT_MAX_BACKOFF
+        self.circuits: Dict[str, Circuit] = {}
+
+    def allow(self, check_name: str, now: float = None) -> bool:
+        """Check may run: circuit is closed or probe is due"""
+        circuit = self.circuits.get(check_name)
+        if circuit is None or circuit.next_probe is None:
+            return True
+        return (time.monotonic() if now is None else now) >= circuit.next_probe
+
+    def record(self, check_name: str, failed: bool, now: float = None, dt: datetime = None) -> Optional[str]:
+        """Record result of check run at `dt`, returns OPENED, OPEN or CLOSED if check opened, kept open or closed
+        circuit"""
+        now = time.monotonic() if now is None else now
+        circuit = self.circuits.get(check_name)
+        if not failed:
+            if circuit is None:
+                return None
+            del self.circuits[check_name]
+            if circuit.next_probe is None:
+                return None
+            log.info(f'circuit of {check_name} is closed after {circuit.failures} failures')
+            return CLOSED
+
+        if circuit is None:
+            circuit = self.circuits[check_name] = Circuit(dt)
+        circuit.failures += 1
+        if circuit.next_probe is not None:
+            circuit.backoff = min(circuit.backoff * self.factor, self.max_backoff)
+            circuit.next_probe = now + circuit.backoff
+            return OPEN
+        if circuit.failures < self.failures:
+            return None
+        circuit.backoff = min(self.backoff, self.max_backoff)
+        circuit.next_probe = now + circuit.backoff
+        log.warning(f'circuit of {check_name} is opened after {circuit.failures} failures, '
+                    f'probe in {circuit.backoff}s')
+        return OPENED
+
+    def failed_since(self, check_name: str) -> Optional[datetime]:
+        circuit = self.circuits.get(check_name)
+        return circuit.since if circuit else None
+
+    def discard(self, check_names: List[str]):
+        """Forget circuits of removed or changed sites"""
+        for check_name in check_names:
+            self.circuits.pop(check_name, None)
+
+    def open_count(self) -> int:
+        return sum(circuit.next_probe is not None for circuit in self.circuits.values())
+
+
+def create_circuits() -> Optional[Circuits]:
+    """Create circuit breakers by settings, None if circuit breaking is disabled"""
+    return Circuits() if CIRCUIT_FAILURES else None
@@ -1,9 +1,14 @@
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+import io
 import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
 import psycopg2
-import psycopg2.errors
 import psycopg2.extensions
 from psycopg2.extensions import connection as Connection
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 
 log = logging.getLogger('app.db')
@@ -11,6 +16,31 @@ log = logging.getLogger('app.db')
 # define settings default values
 PG_CONNECTION_STR = None
 
+# partitioning of new health_checks table by dt: None - not partitioned, 'day' or 'week'
+PARTITION_BY = None
+PARTITION_PRECREATE = 7             # number of upcoming partitions created in advance
+PARTITION_RETENTION_DAYS = None     # drop partitions older than N days, None - keep forever
+PARTITION_DETACH = False            # detach old partitions instead of dropping them
+
+# rollup tables health_checks_minute, health_checks_hour updated by db_writer with every written batch
+ROLLUPS = False
+ROLLUP_GRANULARITIES = ['minute', 'hour']
+# upper bounds of latency histogram buckets in seconds, the last bucket is unbounded;
+# must not be changed after rollups are filled
+HISTOGRAM_BOUNDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# optional columns of health_checks with durations of request phases (dns, connect, ttfb, download) and CPU time of
+# regexp search
+TIMING_COLUMNS = False
+
+# new health_checks table references dimension table checks by small integer check_id instead of storing check_name,
+# view health_checks_named exposes the old layout; the layout of existing table isn't changed
+CHECK_IDS = False
+
+# table outages with start and end of outages of checks recorded by db_writer from results which opened and closed
+# circuits of the checker (circuit.CIRCUIT_FAILURES)
+OUTAGES = False
+
 # override settings by local values
 try:
     from conf.local_settings import *       # noqa: F401, F403
@@ -18,6 +48,24 @@ except ImportError:
     pass
 
 
+FIELDS = ['id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample']
+ID_FIELDS = ['id', 'check_id', 'dt', 'health', 'status', 'duration', 'length', 'sample']
+TIMING_FIELDS = ['dns', 'connect', 'ttfb', 'download', 'regexp']
+
+
+def table_fields() -> List[str]:
+    fields = ID_FIELDS if CHECK_IDS else FIELDS
+    return fields + TIMING_FIELDS if TIMING_COLUMNS else fields
+
+
+def name_column() -> str:
+    return 'check_id int4 NOT NULL' if CHECK_IDS else 'check_name varchar NOT NULL'
+
+
+def name_index() -> str:
+    return 'check_id,dt' if CHECK_IDS else 'check_name,dt'
+
+
 def do_commit(conn: Connection):
     conn.commit()
 
@@ -25,10 +73,10 @@ def do_commit(conn: Connection):
 def init_table(conn: Connection):
     log.warning('create table health_checks')
 
-    sql = """
+    sql = f"""
     CREATE TABLE public.health_checks (
         id uuid NOT NULL,
-        check_name varchar NOT NULL,
+        {name_column()},
         dt timestamp NULL,
         health bool NULL,
         status varchar NULL,
@@ -41,28 +89,218 @@ def init_table(conn: Connection):
 
     CREATE UNIQUE INDEX health_checks_id_idx ON public.health_checks (id);
 
-    CREATE INDEX health_checks_name_idx ON public.health_checks (check_name,dt);
+    CREATE INDEX health_checks_name_idx ON public.health_checks ({name_index()});
     """
     curr = conn.cursor()
     curr.execute(sql)
+    if TIMING_COLUMNS:
+        add_timing_columns(conn)
     do_commit(conn)
 
 
-def check_table_exists(conn: Connection):
-    log.debug('check if table health_checks exists')
-    sql = """select id, check_name, dt, health, status, duration, length, sample from public.health_checks where 1=0"""
+def add_timing_columns(conn: Connection):
+    log.debug('add timing columns to health_checks if not exist')
+    curr = conn.cursor()
+    for column in TIMING_FIELDS:
+        curr.execute(f'ALTER TABLE public.health_checks ADD COLUMN IF NOT EXISTS {column} numeric NULL')
+
+
+def init_partitioned_table(conn: Connection):
+    log.warning(f'create table health_checks partitioned by {PARTITION_BY}')
+
+    sql = f"""
+    CREATE TABLE public.health_checks (
+        id uuid NOT NULL,
+        {name_column()},
+        dt timestamp NOT NULL,
+        health bool NULL,
+        status varchar NULL,
+        duration numeric NULL,
+        length int4 NULL, -- Content-Length
+        sample varchar NULL
+    ) PARTITION BY RANGE (dt);
+
+    COMMENT ON COLUMN public.health_checks.length IS 'Content-Length';
+
+    CREATE UNIQUE INDEX health_checks_id_idx ON public.health_checks (id, dt);
+
+    CREATE INDEX health_checks_name_idx ON public.health_checks ({name_index()});
+
+    CREATE TABLE public.health_checks_default PARTITION OF public.health_checks DEFAULT;
+    """
     curr = conn.cursor()
     curr.execute(sql)
+    if TIMING_COLUMNS:
+        add_timing_columns(conn)
+    create_partitions(conn)
+    do_commit(conn)
 
 
-def create_table_if_not_exists(conn: Connection):
+def partition_step(partition_by: str) -> timedelta:
+    if partition_by == 'day':
+        return timedelta(days=1)
+    if partition_by == 'week':
+        return timedelta(weeks=1)
+    raise ValueError(f'unknown partitioning {partition_by}')
+
+
+def partition_start(day: date, partition_by: str) -> date:
+    """First day of partition containing `day`, weekly partitions start on Monday"""
+    if partition_by == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def partition_name(start: date) -> str:
+    return f'health_checks_p{start:%Y%m%d}'
+
+
+def parse_partition_bound(expr: str) -> Optional[datetime]:
+    """Upper bound of range partition from `pg_get_expr(relpartbound)`, None for default partition"""
+    match = re.search(r"TO \('([^']+)'\)", expr)
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+def default_partition_starts(conn: Connection, default: str, before: date) -> List[date]:
+    """Starts of partitions for rows of default partition older than `before`"""
+    curr = conn.cursor()
+    curr.execute(f'select distinct dt::date as day from public.{default} where dt < %(before)s', dict(before=before))
+    return sorted({partition_start(row['day'], PARTITION_BY) for row in curr.fetchall()})
+
+
+def create_partition(conn: Connection, start: date, end: date, default: str = None):
+    """Create partition of range [start, end), its rows are moved into it from `default` partition.
+
+    Failure (e.g. rows are routed to default partition during moving) is logged, partition is created on the next
+    maintenance then.
+    """
+    name = partition_name(start)
+    params = dict(start=start, end=end)
+    curr = conn.cursor()
+    curr.execute('SAVEPOINT create_partition')
     try:
-        check_table_exists(conn)
-    except psycopg2.errors.UndefinedTable:
-        conn.rollback()
-        init_table(conn)
+        moved = 0
+        if default:
+            # partition can't be created while default partition has rows of its range
+            curr.execute(f"""CREATE TABLE public.{name} (LIKE public.health_checks INCLUDING DEFAULTS);
+            WITH moved AS (DELETE FROM public.{default} WHERE dt >= %(start)s AND dt < %(end)s RETURNING *)
+            INSERT INTO public.{name} SELECT * FROM moved""", params)
+            moved = curr.rowcount
+            curr.execute(f"""ALTER TABLE public.health_checks ATTACH PARTITION public.{name}
+            FOR VALUES FROM (%(start)s) TO (%(end)s)""", params)
+        else:
+            curr.execute(f"""CREATE TABLE public.{name}
+            PARTITION OF public.health_checks FOR VALUES FROM (%(start)s) TO (%(end)s)""", params)
+    except psycopg2.Error:
+        curr.execute('ROLLBACK TO SAVEPOINT create_partition')
+        log.exception(f'failed to create partition {name}')
+        return
+    curr.execute('RELEASE SAVEPOINT create_partition')
+    log.info(f'partition {name} is created' + (f', {moved} rows are moved from {default}' if moved else ''))
+
+
+def create_partitions(conn: Connection, day: date = None, count: int = None):
+    """Create partition containing `day` (today by default) and `count` upcoming ones if not exist.
+
+    Partitions are also created for older rows of default partition, so retention is applied to them.
+    """
+    count = PARTITION_PRECREATE if count is None else count
+    step = partition_step(PARTITION_BY)
+    start = partition_start(day or date.today(), PARTITION_BY)
+    partitions = list_partitions(conn)
+    existing = {partition['name'] for partition in partitions}
+    default = next((partition['name'] for partition in partitions if partition['bound'] == 'DEFAULT'), None)
+    starts = default_partition_starts(conn, default, start) if default else []
+    starts += [start + step * i for i in range(count + 1)]
+    for start in sorted(set(starts)):
+        if partition_name(start) not in existing:
+            create_partition(conn, start, start + step, default=default)
+
+
+def list_partitions(conn: Connection) -> List[dict]:
+    sql = """select c.relname as name, pg_get_expr(c.relpartbound, c.oid) as bound
+    from pg_inherits i join pg_class c on c.oid = i.inhrelid
+    where i.inhparent = 'public.health_checks'::regclass"""
+    curr = conn.cursor()
+    curr.execute(sql)
+    return curr.fetchall()
+
+
+def drop_old_partitions(conn: Connection, retention_days: int = None, detach: bool = None):
+    """Drop (or detach) partitions which contain only records older than retention"""
+    retention_days = retention_days or PARTITION_RETENTION_DAYS
+    detach = PARTITION_DETACH if detach is None else detach
+    if not retention_days:
+        return
+    threshold = datetime.combine(date.today() - timedelta(days=retention_days), datetime.min.time())
+    curr = conn.cursor()
+    for partition in list_partitions(conn):
+        end = parse_partition_bound(partition['bound'])
+        if end and end <= threshold:
+            if detach:
+                log.warning(f'detach partition {partition["name"]}')
+                curr.execute(f'ALTER TABLE public.health_checks DETACH PARTITION public.{partition["name"]}')
+            else:
+                log.warning(f'drop partition {partition["name"]}')
+                curr.execute(f'DROP TABLE public.{partition["name"]}')
+
+
+def is_partitioned(conn: Connection) -> bool:
+    curr = conn.cursor()
+    curr.execute("""select exists(select 1 from pg_partitioned_table
+    where partrelid = 'public.health_checks'::regclass) as partitioned""")
+    return curr.fetchone()['partitioned']
+
+
+def maintain_partitions(conn: Connection):
+    """Pre-create upcoming partitions and remove expired ones, should be called periodically.
+
+    Table created before PARTITION_BY was set isn't partitioned, its maintenance is skipped.
+    """
+    if not is_partitioned(conn):
+        do_commit(conn)
+        log.warning('health_checks table is not partitioned, PARTITION_BY is applied only when table is created, '
+                    'skip maintenance of partitions')
+        return
+    log.info('maintain partitions of health_checks')
+    create_partitions(conn)
+    drop_old_partitions(conn)
+    do_commit(conn)
+
+
+def table_columns(conn: Connection) -> List[str]:
+    curr = conn.cursor()
+    curr.execute("""select column_name from information_schema.columns
+    where table_schema = 'public' and table_name = 'health_checks'""")
+    return [row['column_name'] for row in curr.fetchall()]
+
+
+def check_table_exists(conn: Connection) -> bool:
+    """Whether table health_checks exists, raises RuntimeError if its layout doesn't match CHECK_IDS"""
+    log.debug('check if table health_checks exists')
+    columns = table_columns(conn)
+    if not columns:
+        return False
+    name = name_column().split()[0]
+    if name not in columns:
+        raise RuntimeError(f'table health_checks has no {name} column: CHECK_IDS is applied only when table is '
+                           f'created, set CHECK_IDS = {not CHECK_IDS} for the existing table')
+    return True
+
+
+def create_table_if_not_exists(conn: Connection):
+    if not check_table_exists(conn):
+        if PARTITION_BY:
+            init_partitioned_table(conn)
+        else:
+            init_table(conn)
     else:
         log.debug('table health_checks exists')
+        if TIMING_COLUMNS:
+            add_timing_columns(conn)
+            do_commit(conn)
+        if PARTITION_BY:
+            maintain_partitions(conn)
 
 
 def get_connect():
@@ -70,16 +308,365 @@ def get_connect():
     conn = psycopg2.connect(PG_CONNECTION_STR, cursor_factory=RealDictCursor)
     log.info('connected to db')
     create_table_if_not_exists(conn)
+    if CHECK_IDS:
+        init_checks_table(conn)
+        create_named_view(conn)
+    if ROLLUPS:
+        init_rollup_tables(conn)
+    if OUTAGES:
+        init_outages_table(conn)
     return conn
 
 
-def append_record(conn: Connection, rec: dict):
+def init_checks_table(conn: Connection):
+    log.debug('create table checks if not exists')
+    curr = conn.cursor()
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS public.checks (
+        id serial NOT NULL PRIMARY KEY,
+        name varchar NOT NULL UNIQUE,
+        url varchar NULL,
+        config_hash varchar NULL -- hash of site definition
+    )""")
+    do_commit(conn)
+
+
+def create_named_view(conn: Connection):
+    """(Re)create view of health_checks with check_name column instead of check_id"""
+    curr = conn.cursor()
+    columns = ', '.join('c.name as check_name' if k == 'check_id' else f'h.{k}' for k in table_fields())
+    curr.execute(f"""CREATE OR REPLACE VIEW public.health_checks_named AS
+    select {columns} from public.health_checks h join public.checks c on c.id = h.check_id""")
+    do_commit(conn)
+
+
+def get_check_ids(conn: Connection, names: Iterable[str]) -> Dict[str, int]:
+    """Ids of checks by names, missing checks are added to checks table"""
+    # sorted names are inserted in the same order by concurrent writers to avoid deadlocks
+    names = sorted(set(names))
+    curr = conn.cursor()
+    execute_values(curr, 'insert into public.checks(name) values %s ON CONFLICT (name) DO NOTHING',
+                   [(name, ) for name in names])
+    curr.execute('select id, name from public.checks where name = any(%(names)s)', dict(names=names))
+    return {row['name']: row['id'] for row in curr.fetchall()}
+
+
+def sync_checks(conn: Connection, checks: List[dict]) -> Dict[str, int]:
+    """Insert or update checks (name, url, config_hash) of sites definitions, returns ids of all checks by names"""
+    curr = conn.cursor()
+    if checks:
+        execute_values(curr, """insert into public.checks as c (name, url, config_hash) values %s
+        ON CONFLICT (name) DO UPDATE SET url = excluded.url, config_hash = excluded.config_hash
+        WHERE c.config_hash IS DISTINCT FROM excluded.config_hash""",
+                       sorted(checks, key=lambda check: check['name']), template='(%(name)s, %(url)s, %(config_hash)s)')
+    curr.execute('select id, name from public.checks')
+    ids = {row['name']: row['id'] for row in curr.fetchall()}
+    do_commit(conn)
+    return ids
+
+
+def get_last_states(conn: Connection) -> List[dict]:
+    """The last written result of every check"""
+    table = 'health_checks_named' if CHECK_IDS else 'health_checks'
+    sql = f"""select distinct on (check_name) check_name, dt, health, status, sample from public.{table}
+    order by check_name, dt desc"""
+    curr = conn.cursor()
+    curr.execute(sql)
+    return curr.fetchall()
+
+
+def init_offsets_table(conn: Connection):
+    log.debug('create table writer_offsets if not exists')
+    curr = conn.cursor()
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS public.writer_offsets (
+        topic varchar NOT NULL,
+        partition int4 NOT NULL,
+        next_offset int8 NOT NULL, -- offset of the first message not written yet
+        PRIMARY KEY (topic, partition)
+    )""")
+    do_commit(conn)
+
+
+def get_offsets(conn: Connection, partitions: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], int]:
+    """Next offsets of written messages by (topic, partition)"""
+    curr = conn.cursor()
+    curr.execute('select topic, partition, next_offset from public.writer_offsets where (topic, partition) in %s',
+                 (tuple(tuple(tp) for tp in partitions), ))
+    return {(row['topic'], row['partition']): row['next_offset'] for row in curr.fetchall()}
+
+
+def save_offsets(conn: Connection, offsets: Dict[Tuple[str, int], int]):
+    """Save next offsets by (topic, partition) in transaction of written messages"""
+    curr = conn.cursor()
+    execute_values(curr, """insert into public.writer_offsets (topic, partition, next_offset) values %s
+    ON CONFLICT (topic, partition) DO UPDATE SET next_offset = excluded.next_offset""",
+                   sorted((topic, partition, offset) for (topic, partition), offset in offsets.items()))
+
+
+def init_outages_table(conn: Connection):
+    log.debug('create table outages if not exists')
+    curr = conn.cursor()
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS public.outages (
+        check_name varchar NOT NULL,
+        started_at timestamp NOT NULL,
+        ended_at timestamp NULL, -- NULL while outage lasts
+        PRIMARY KEY (check_name, started_at)
+    )""")
+    # a check has one open outage at most
+    curr.execute('CREATE UNIQUE INDEX IF NOT EXISTS outages_open ON public.outages (check_name) WHERE ended_at IS NULL')
+    do_commit(conn)
+
+
+def start_outage(conn: Connection, check_name: str, dt: Any):
+    """Start outage of check unless it has open one (e.g. the checker restarted during outage) or it's recorded"""
+    curr = conn.cursor()
+    curr.execute("""insert into public.outages (check_name, started_at) values (%(check_name)s, %(dt)s)
+    ON CONFLICT DO NOTHING""", dict(check_name=check_name, dt=dt))
+
+
+def end_outage(conn: Connection, check_name: str, dt: Any):
+    """End the last outage of check started before `dt`"""
+    curr = conn.cursor()
+    curr.execute("""update public.outages set ended_at = %(dt)s
+    where check_name = %(check_name)s and ended_at is null and started_at <= %(dt)s""",
+                 dict(check_name=check_name, dt=dt))
+
+
+def end_outages(conn: Connection, ends: List[Tuple[str, Any]]):
+    """End open outages of checks by list of (check_name, dt), checks without open outage are ignored"""
+    curr = conn.cursor()
+    execute_values(curr, """update public.outages o set ended_at = v.dt
+    from (values %s) as v(check_name, dt)
+    where o.check_name = v.check_name and o.ended_at is null and o.started_at <= v.dt""",
+                   ends, template='(%s, %s::timestamp)', page_size=max(len(ends), 1))
+
+
+def get_outages(conn: Connection, check_name: str, start: datetime, end: datetime) -> List[dict]:
+    """Outages of check overlapping period [start, end), ended_at is None for ongoing outage"""
+    curr = conn.cursor()
+    curr.execute("""select check_name, started_at, ended_at from public.outages
+    where check_name = %(check_name)s and started_at < %(end)s and (ended_at is null or ended_at >= %(start)s)
+    order by started_at""", dict(check_name=check_name, start=start, end=end))
+    return curr.fetchall()
+
+
+def returning_clause(returning: Optional[List[str]]) -> str:
+    return f' RETURNING {", ".join(returning)}' if returning else ''
+
+
+def append_record(conn: Connection, rec: dict, returning: List[str] = None) -> Optional[dict]:
+    """Insert record, returns `returning` fields of inserted record, None if it already exists"""
     log.debug(f'append record {rec["id"]} health:{rec["health"]} {rec["check_name"]}')
-    sql = """insert into public.health_checks(id, check_name, dt, health, status, duration, length, sample)
-    values (%(id)s, %(check_name)s, %(dt)s, %(health)s, %(status)s, %(duration)s, %(length)s, %(sample)s)
-    ON CONFLICT DO NOTHING"""
+    fields = table_fields()
+    sql = f"""insert into public.health_checks({', '.join(fields)})
+    values ({', '.join(f'%({k})s' for k in fields)})
+    ON CONFLICT DO NOTHING""" + returning_clause(returning)
     curr = conn.cursor()
     curr.execute(sql, rec)
+    return curr.fetchone() if returning else None
+
+
+def append_records(conn: Connection, recs: List[dict], page_size: int = 1000,
+                   returning: List[str] = None) -> List[dict]:
+    """Insert records by multi-row inserts of `page_size` rows, returns `returning` fields of inserted records"""
+    log.debug(f'append {len(recs)} records')
+    fields = table_fields()
+    columns = ', '.join(fields)
+    template = '(' + ', '.join(f'%({k})s' for k in fields) + ')'
+    sql = f"""insert into public.health_checks({columns}) values %s ON CONFLICT DO NOTHING"""
+    curr = conn.cursor()
+    if returning:
+        return execute_values(curr, sql + returning_clause(returning), recs, template=template, page_size=page_size,
+                              fetch=True)
+    execute_values(curr, sql, recs, template=template, page_size=page_size)
+    return []
+
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value: Any) -> str:
+    """Format value for text format of COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_records(conn: Connection, recs: List[dict], returning: List[str] = None) -> List[dict]:
+    """Load records by COPY into temporary staging table and merge them into health_checks,
+    returns `returning` fields of inserted records"""
+    log.debug(f'copy {len(recs)} records')
+    fields = table_fields()
+    columns = ', '.join(fields)
+    buf = io.StringIO()
+    for rec in recs:
+        buf.write('\t'.join(copy_value(rec.get(k)) for k in fields) + '\n')
+    buf.seek(0)
+
+    curr = conn.cursor()
+    curr.execute("""CREATE TEMP TABLE IF NOT EXISTS health_checks_staging
+    (LIKE public.health_checks INCLUDING DEFAULTS) ON COMMIT DELETE ROWS""")
+    curr.copy_expert(f'COPY health_checks_staging ({columns}) FROM STDIN', buf)
+    curr.execute(f"""insert into public.health_checks({columns})
+    select {columns} from health_checks_staging
+    ON CONFLICT DO NOTHING""" + returning_clause(returning))
+    inserted = curr.fetchall() if returning else []
+    curr.execute('TRUNCATE health_checks_staging')
+    return inserted
+
+
+def write_records(conn: Connection, recs: List[dict], mode: str = 'values', page_size: int = 1000,
+                  copy_min_rows: int = 10000, returning: List[str] = None) -> List[dict]:
+    """Write batch of records by `mode`: 'row' - insert per record, 'values' - multi-row inserts, 'copy' - COPY,
+    'auto' - COPY for batches of `copy_min_rows` records and more, multi-row inserts otherwise.
+
+    Returns `returning` fields of inserted records, records which already exist are skipped.
+    """
+    if mode == 'auto':
+        mode = 'copy' if len(recs) >= copy_min_rows else 'values'
+
+    if mode == 'copy':
+        return copy_records(conn, recs, returning=returning)
+    elif mode == 'values':
+        return append_records(conn, recs, page_size=page_size, returning=returning)
+    elif mode == 'row':
+        inserted = [append_record(conn, rec, returning=returning) for rec in recs]
+        return [rec for rec in inserted if rec]
+    else:
+        raise ValueError(f'unknown write mode {mode}')
+
+
+ROLLUP_FIELDS = ['check_name', 'dt', 'health', 'duration']
+ROLLUP_ID_FIELDS = ['check_id', 'dt', 'health', 'duration']
+ROLLUP_COLUMNS = ['check_name', 'bucket', 'count', 'healthy', 'duration_count', 'duration_sum', 'duration_min',
+                  'duration_max', 'histogram']
+
+
+def rollup_table(granularity: str) -> str:
+    if granularity not in ('minute', 'hour'):
+        raise ValueError(f'unknown rollup granularity {granularity}')
+    return f'public.health_checks_{granularity}'
+
+
+def init_rollup_tables(conn: Connection):
+    curr = conn.cursor()
+    for granularity in ROLLUP_GRANULARITIES:
+        log.debug(f'create table {rollup_table(granularity)} if not exists')
+        curr.execute(f"""
+        CREATE TABLE IF NOT EXISTS {rollup_table(granularity)} (
+            check_name varchar NOT NULL,
+            bucket timestamp NOT NULL,
+            count int4 NOT NULL,
+            healthy int4 NOT NULL,
+            duration_count int4 NOT NULL,
+            duration_sum numeric NOT NULL,
+            duration_min numeric NULL,
+            duration_max numeric NULL,
+            histogram int4[] NOT NULL, -- counts of durations by HISTOGRAM_BOUNDS
+            PRIMARY KEY (check_name, bucket)
+        )""")
+    do_commit(conn)
+
+
+def rollup_bucket(dt: datetime, granularity: str) -> datetime:
+    if granularity == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(second=0, microsecond=0)
+
+
+def aggregate_rollups(recs: Iterable[dict], granularity: str) -> List[dict]:
+    """Aggregate records by check_name and time bucket, rollups are sorted by key to avoid deadlocks on update"""
+    rollups: Dict[Tuple[str, datetime], dict] = {}
+    for rec in recs:
+        key = rec['check_name'], rollup_bucket(rec['dt'], granularity)
+        rollup = rollups.get(key)
+        if not rollup:
+            rollup = rollups[key] = {
+                'check_name': key[0], 'bucket': key[1], 'count': 0, 'healthy': 0, 'duration_count': 0,
+                'duration_sum': 0, 'duration_min': None, 'duration_max': None,
+                'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1),
+            }
+        rollup['count'] += 1
+        rollup['healthy'] += bool(rec['health'])
+        duration = rec['duration']
+        if duration is not None:
+            rollup['duration_count'] += 1
+            rollup['duration_sum'] += duration
+            if rollup['duration_min'] is None or duration < rollup['duration_min']:
+                rollup['duration_min'] = duration
+            if rollup['duration_max'] is None or duration > rollup['duration_max']:
+                rollup['duration_max'] = duration
+            rollup['histogram'][bisect_left(HISTOGRAM_BOUNDS, duration)] += 1
+    return [rollups[key] for key in sorted(rollups)]
+
+
+def update_rollups(conn: Connection, recs: List[dict]):
+    """Add inserted records (ROLLUP_FIELDS of them) into rollup tables"""
+    columns = ', '.join(ROLLUP_COLUMNS)
+    template = '(' + ', '.join(f'%({k})s' for k in ROLLUP_COLUMNS) + ')'
+    curr = conn.cursor()
+    for granularity in ROLLUP_GRANULARITIES:
+        rollups = aggregate_rollups(recs, granularity)
+        log.debug(f'update {len(rollups)} rollups of {granularity}')
+        sql = f"""insert into {rollup_table(granularity)} as r ({columns}) values %s
+        ON CONFLICT (check_name, bucket) DO UPDATE SET
+            count = r.count + excluded.count,
+            healthy = r.healthy + excluded.healthy,
+            duration_count = r.duration_count + excluded.duration_count,
+            duration_sum = r.duration_sum + excluded.duration_sum,
+            duration_min = least(r.duration_min, excluded.duration_min),
+            duration_max = greatest(r.duration_max, excluded.duration_max),
+            histogram = array(select a + b from unnest(r.histogram, excluded.histogram) with ordinality as t(a, b, i)
+                              order by i)"""
+        execute_values(curr, sql, rollups, template=template)
+
+
+def histogram_percentile(histogram: List[int], q: float, duration_min: float, duration_max: float) -> Optional[float]:
+    """Estimate q-quantile of durations by linear interpolation inside histogram bucket"""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(histogram):
+        if count and cumulative + count >= rank:
+            lower = max(HISTOGRAM_BOUNDS[i - 1] if i else 0, duration_min)
+            upper = min(HISTOGRAM_BOUNDS[i] if i < len(HISTOGRAM_BOUNDS) else duration_max, duration_max)
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+
+
+def get_check_stats(conn: Connection, check_name: str, start: datetime, end: datetime,
+                    percentiles: Iterable[float] = (0.5, 0.95), granularity: str = 'hour') -> dict:
+    """Uptime and duration stats of check from rollups of buckets in [start, end)"""
+    sql = f"""select {', '.join(ROLLUP_COLUMNS)} from {rollup_table(granularity)}
+    where check_name = %(check_name)s and bucket >= %(start)s and bucket < %(end)s"""
+    curr = conn.cursor()
+    curr.execute(sql, dict(check_name=check_name, start=start, end=end))
+    rows = curr.fetchall()
+
+    count = sum(row['count'] for row in rows)
+    healthy = sum(row['healthy'] for row in rows)
+    duration_count = sum(row['duration_count'] for row in rows)
+    durations_min = [row['duration_min'] for row in rows if row['duration_min'] is not None]
+    durations_max = [row['duration_max'] for row in rows if row['duration_max'] is not None]
+    histogram = [sum(counts) for counts in zip(*[row['histogram'] for row in rows])]
+    duration_min = min(durations_min) if durations_min else None
+    duration_max = max(durations_max) if durations_max else None
+    return {
+        'count': count,
+        'healthy': healthy,
+        'uptime': healthy / count if count else None,
+        'duration_min': duration_min,
+        'duration_max': duration_max,
+        'duration_avg': sum(row['duration_sum'] for row in rows) / duration_count if duration_count else None,
+        'percentiles': {q: histogram_percentile(histogram, q, duration_min, duration_max) if duration_count else None
+                        for q in percentiles},
+    }
 
 
 DEC2FLOAT = psycopg2.extensions.new_type(
@@ -1,15 +1,52 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from hashlib import blake2b
+import json
 import logging
+import queue
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
 
 from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import OffsetAndMetadata, TopicPartition
 
+import broker
 from broker import get_kafka_consumer, KafkaConsumer
+import circuit
 import db
+import metrics
+from sites_loader import load_sites
+import workers
 
 
 log = logging.getLogger('app')
 
 # define settings default values
 LOG_LEVEL = logging.DEBUG
+# write mode: 'row' - insert per message, 'values' - multi-row inserts of WRITE_BATCH_SIZE rows,
+# 'copy' - COPY through staging table, 'auto' - COPY for poll batches of WRITE_COPY_MIN_ROWS messages and more
+WRITE_MODE = 'values'
+WRITE_BATCH_SIZE = 1000
+WRITE_COPY_MIN_ROWS = 10000
+# interval in seconds of partitions maintenance, used if db.PARTITION_BY is set
+MAINTENANCE_INTERVAL = 3600
+# number of writer processes consuming the topic in the same group, each with own db connection
+WRITERS = 1
+# pipelined mode: next batch is consumed while previous ones are written by PIPELINE_CONNECTIONS threads,
+# offsets are committed after db commit of all previous batches
+WRITE_PIPELINE = False
+PIPELINE_CONNECTIONS = 2
+PIPELINE_MAX_IN_FLIGHT = 4
+# sites definitions synced into checks table on start, used if db.CHECK_IDS is set
+SITES_FILE = 'conf/sites.json'
+# transitions mode: result is written only if health, status or sample of its check changed or the last written
+# result of check is older than TRANSITIONS_SAMPLE_INTERVAL seconds (0 - only changes are written); last states are
+# loaded from db on start, skipped results are still added into rollups if db.ROLLUPS is set; offsets of written
+# messages are stored in db, so messages consumed again after restart or rebalance are dropped
+WRITE_TRANSITIONS = False
+TRANSITIONS_SAMPLE_INTERVAL = 300
 
 # override settings by local values
 try:
@@ -18,38 +55,411 @@ except ImportError:
     pass
 
 
+# metrics of the writer
+WRITE_DURATION = metrics.Histogram('dbwriter_write_batch_seconds', 'Duration of writing batch of records')
+WRITTEN_ROWS = metrics.Counter('dbwriter_written_rows_total', 'Number of written records')
+SKIPPED_ROWS = metrics.Counter('dbwriter_skipped_rows_total', 'Number of records skipped in transitions mode')
+WRITE_ROWS_PER_SECOND = metrics.Gauge('dbwriter_write_rows_per_second', 'Write throughput of the last batch')
+CONSUMER_LAG = metrics.Gauge('dbwriter_consumer_lag', 'Number of messages in partition after the last polled one')
+
+# cache of ids of checks table by check_name and names by id, used if db.CHECK_IDS is set
+check_ids: Dict[str, int] = {}
+check_names: Dict[int, str] = {}
+
+# last state (health, status, sample) and dt of the last written result by check_name, used if WRITE_TRANSITIONS
+last_states: Dict[str, Tuple[tuple, datetime]] = {}
+
+
+def decode_message(message: ConsumerRecord) -> Optional[dict]:
+    """Deserialize raw value of message by its format header, already deserialized values are returned as is"""
+    if not isinstance(message.value, (bytes, bytearray)):
+        return message.value
+    try:
+        return broker.deserialize(message.value, message.headers)
+    except ValueError:
+        log.exception(f'skip message {message.partition} {message.offset} because it can\'t be deserialized')
+
+
 def parse_message(message: ConsumerRecord) -> dict:
     fields = ['id', 'check_name', 'dt', 'health', 'status', 'duration', 'length', 'sample']
     mandatory = ['id', 'check_name', 'dt', 'health']
-    if message.value and all([k in message.value for k in mandatory]):
-        return {k: message.value.get(k) for k in fields}
-    log.warning(f'skip message {message.partition} {message.offset} because not all the fields exists {message.value}')
+    value = decode_message(message)
+    if value and all([k in value for k in mandatory]):
+        if db.TIMING_COLUMNS:
+            fields = fields + db.TIMING_FIELDS
+        rec = {k: value.get(k) for k in fields}
+        if db.OUTAGES:
+            for k in ['circuit', 'failed_since']:
+                if value.get(k):
+                    rec[k] = value[k]
+        return rec
+    log.warning(f'skip message {message.partition} {message.offset} because not all the fields exists {value}')
 
 
-def write_once(consumer: KafkaConsumer, conn: db.Connection, timeout_ms=None):
+def poll_records(consumer: KafkaConsumer, timeout_ms=None,
+                 written_offsets: Callable[[List[TopicPartition]], Dict[Tuple[str, int], int]] = None
+                 ) -> Tuple[List[dict], Dict[TopicPartition, int]]:
+    """Poll messages, returns parsed records and next offsets of polled partitions.
+
+    Messages before offsets returned by `written_offsets` for polled partitions are already written and dropped.
+    """
     timeout_ms = timeout_ms or 100
-    batches = consumer.poll(timeout_ms=timeout_ms).values()
-    for batch in batches:
+    batches = consumer.poll(timeout_ms=timeout_ms)
+    written = written_offsets(list(batches)) if written_offsets and batches else {}
+    recs = []
+    offsets = {}
+    for tp, batch in batches.items():
         log.debug(f"got batch with {len(batch)} messages")
         for message in batch:
+            if message.offset < written.get(tp, 0):
+                continue
             rec = parse_message(message)
             if rec:
-                db.append_record(conn, rec)
+                recs.append(rec)
+        if batch:
+            offsets[tp] = batch[-1].offset + 1
+    observe_consumer_lag(consumer, offsets)
+    return recs, offsets
+
+
+def observe_consumer_lag(consumer: KafkaConsumer, offsets: Dict[TopicPartition, int]):
+    for tp, offset in offsets.items():
+        highwater = consumer.highwater(tp)
+        if highwater is not None:
+            CONSUMER_LAG.set(max(0, highwater - offset), topic=tp.topic, partition=tp.partition)
+
+
+def cache_check_ids(ids: Dict[str, int]):
+    check_ids.update(ids)
+    check_names.update((check_id, name) for name, check_id in ids.items())
+
+
+def config_hash(site: dict) -> str:
+    return blake2b(json.dumps(site, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def init_check_ids(conn: db.Connection, sites_file: str = None):
+    """Sync checks table with sites file and fill cache of ids by all known checks"""
+    sites_file = sites_file or SITES_FILE
+    try:
+        sites = load_sites(sites_file)
+    except (OSError, ValueError):
+        log.exception(f'sites file {sites_file} can\'t be loaded, checks are added by names on first results')
+        sites = {}
+    checks = [{'name': name, 'url': site.get('url'), 'config_hash': config_hash(site)} for name, site in sites.items()]
+    cache_check_ids(db.sync_checks(conn, checks))
+    log.info(f'{len(check_ids)} checks are loaded')
+
 
-    if batches:
+def resolve_check_ids(conn: db.Connection, recs: List[dict]):
+    """Set check_id of records, unknown checks are added to checks table and committed at once,
+    so cached ids are visible to all connections"""
+    missing = {rec['check_name'] for rec in recs if rec['check_name'] not in check_ids}
+    if missing:
+        cache_check_ids(db.get_check_ids(conn, missing))
+        db.do_commit(conn)
+    for rec in recs:
+        rec['check_id'] = check_ids[rec['check_name']]
+
+
+def state_of(rec: dict) -> tuple:
+    # status is stored as varchar, so loaded and received states are compared by string
+    status = rec.get('status')
+    return rec.get('health'), None if status is None else str(status), rec.get('sample')
+
+
+def parse_dt(dt) -> datetime:
+    return dt if isinstance(dt, datetime) else datetime.fromisoformat(dt)
+
+
+def load_last_states(conn: db.Connection):
+    for row in db.get_last_states(conn):
+        last_states[row['check_name']] = state_of(row), parse_dt(row['dt'])
+    db.do_commit(conn)
+    log.info(f'last states of {len(last_states)} checks are loaded')
+
+
+def split_transitions(recs: List[dict], sample_interval: float = None) -> Tuple[List[dict], List[dict]]:
+    """Split records into ones to write (state of check changed or sample is due) and skipped ones.
+
+    Last states are updated by records to write. Records not newer than the last state of their check (e.g. drained
+    from spool) don't change it, they are written if state differs from the preceding late record of the batch.
+    """
+    sample_interval = TRANSITIONS_SAMPLE_INTERVAL if sample_interval is None else sample_interval
+    sample_delta = timedelta(seconds=sample_interval)
+    written, skipped = [], []
+    # states of late records by check_name, state before the first one is unknown
+    late_states: Dict[str, tuple] = {}
+    for rec in recs:
+        state, dt = state_of(rec), parse_dt(rec['dt'])
+        last = last_states.get(rec['check_name'])
+        if last and dt <= last[1]:
+            if late_states.get(rec['check_name']) == state:
+                skipped.append(dict(rec, dt=dt))
+            else:
+                late_states[rec['check_name']] = state
+                written.append(rec)
+            continue
+        if last and last[0] == state and (not sample_interval or dt - last[1] < sample_delta):
+            skipped.append(dict(rec, dt=dt))
+            continue
+        last_states[rec['check_name']] = state, dt
+        written.append(rec)
+    if skipped:
+        SKIPPED_ROWS.inc(len(skipped))
+    return written, skipped
+
+
+OutageEvents = Tuple[List[Tuple[str, datetime]], List[Tuple[str, str, datetime]]]
+
+
+def outage_events(recs: Iterable[dict]) -> OutageEvents:
+    """Changes of outages by records: ends of outages started before the records by the first healthy record of
+    check, and then (circuit.OPENED or circuit.CLOSED, check_name, dt) in order of checks. Outage starts at dt of
+    the first failure of check which opened circuit and ends by the next healthy record of check.
+    """
+    ends: Dict[str, datetime] = {}
+    events = []
+    # checks with records which opened circuit, mapped to whether their outage is open
+    opened: Dict[str, bool] = {}
+    # written and skipped records of transitions mode are merged back into order of checks
+    for rec in sorted(recs, key=lambda rec: parse_dt(rec['dt'])):
+        check_name = rec['check_name']
+        if rec.get('circuit') == circuit.OPENED and not opened.get(check_name):
+            opened[check_name] = True
+            events.append((circuit.OPENED, check_name, parse_dt(rec.get('failed_since') or rec['dt'])))
+        elif rec['health'] and opened.get(check_name):
+            opened[check_name] = False
+            events.append((circuit.CLOSED, check_name, parse_dt(rec['dt'])))
+        elif rec['health'] and check_name not in opened and check_name not in ends:
+            ends[check_name] = parse_dt(rec['dt'])
+    # sorted by name to avoid deadlocks of concurrent writers
+    return sorted(ends.items()), events
+
+
+def record_outages(conn: db.Connection, events: OutageEvents):
+    ends, events = events
+    if ends:
+        db.end_outages(conn, ends)
+    for event, check_name, dt in events:
+        if event == circuit.OPENED:
+            db.start_outage(conn, check_name, dt)
+        else:
+            db.end_outage(conn, check_name, dt)
+
+
+def write_records(conn: db.Connection, recs: List[dict], skipped: List[dict] = None, ordered: bool = True):
+    """Write records and add inserted ones (and `skipped` ones of transitions mode) into rollups in the same
+    transaction, outages are recorded too.
+
+    Inserted records are added into rollups once by id, but `skipped` ones and outages only by order of batches, so they
+    are left to write_ordered if `ordered` is False.
+    """
+    start = time.perf_counter()
+    returning = None
+    if db.CHECK_IDS:
+        resolve_check_ids(conn, recs)
+        returning = db.ROLLUP_ID_FIELDS if db.ROLLUPS else None
+    elif db.ROLLUPS:
+        returning = db.ROLLUP_FIELDS
+    inserted = db.write_records(conn, recs, mode=WRITE_MODE, page_size=WRITE_BATCH_SIZE,
+                                copy_min_rows=WRITE_COPY_MIN_ROWS, returning=returning) if recs else []
+    if db.CHECK_IDS and inserted:
+        inserted = [dict(rec, check_name=check_names[rec['check_id']]) for rec in inserted]
+    rollup_recs = inserted + ((skipped or []) if ordered else [])
+    if db.ROLLUPS and rollup_recs:
+        db.update_rollups(conn, rollup_recs)
+    if db.OUTAGES and ordered:
+        record_outages(conn, outage_events(recs + (skipped or [])))
+    duration = time.perf_counter() - start
+    WRITE_DURATION.observe(duration)
+    WRITTEN_ROWS.inc(len(recs))
+    if duration:
+        WRITE_ROWS_PER_SECOND.set(len(recs) / duration)
+
+
+def write_once(consumer: KafkaConsumer, conn: db.Connection, timeout_ms=None):
+    recs, offsets = poll_records(consumer, timeout_ms=timeout_ms,
+                                 written_offsets=partial(db.get_offsets, conn) if WRITE_TRANSITIONS else None)
+    skipped = []
+    if WRITE_TRANSITIONS:
+        recs, skipped = split_transitions(recs)
+
+    if recs or skipped:
+        write_records(conn, recs, skipped)
+
+    if offsets:
+        if WRITE_TRANSITIONS:
+            # skipped records are added into rollups once, as they are dropped if consumed again
+            db.save_offsets(conn, offsets)
         db.do_commit(conn)
         consumer.commit()
 
 
-def write_forever(consumer: KafkaConsumer, conn: db.Connection, timeout_ms=None):
+def maintain_if_needed(conn: db.Connection, next_maintenance: float) -> float:
+    """Maintain partitions if time has come, returns time of next maintenance"""
+    if db.PARTITION_BY and time.monotonic() >= next_maintenance:
+        db.maintain_partitions(conn)
+        return time.monotonic() + MAINTENANCE_INTERVAL
+    return next_maintenance
+
+
+def write_forever(consumer: KafkaConsumer, conn: db.Connection, timeout_ms=None, maintenance: bool = True):
+    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
     while True:
         write_once(consumer, conn, timeout_ms=timeout_ms)
+        if maintenance:
+            next_maintenance = maintain_if_needed(conn, next_maintenance)
+
+
+def write_batch(pool: queue.Queue, recs: List[dict], skipped: List[dict] = None
+                ) -> Tuple[List[dict], Optional[OutageEvents]]:
+    """Write and commit records by free connection of the pool, runs in executor thread.
+
+    Batches are committed in any order, so skipped records and changes of outages are returned to be written by
+    write_ordered in order of batches.
+    """
+    conn = pool.get()
+    try:
+        write_records(conn, recs, skipped, ordered=False)
+        db.do_commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.put(conn)
+    return skipped or [], outage_events(recs + (skipped or [])) if db.OUTAGES else None
+
+
+def write_ordered(conn: db.Connection, written: Tuple[List[dict], Optional[OutageEvents]],
+                  offsets: Dict[TopicPartition, int]):
+    """Add skipped records of written batch into rollups, record its outages and save its offsets (transitions mode)
+    in one transaction, so they are written once and in order of batches"""
+    skipped, events = written
+    if db.ROLLUPS and skipped:
+        db.update_rollups(conn, skipped)
+    if events and (events[0] or events[1]):
+        record_outages(conn, events)
+    if WRITE_TRANSITIONS:
+        db.save_offsets(conn, offsets)
+    db.do_commit(conn)
+
+
+def make_offset(offset: int) -> OffsetAndMetadata:
+    # leader_epoch field was added in kafka-python 2.1
+    if 'leader_epoch' in OffsetAndMetadata._fields:
+        return OffsetAndMetadata(offset, None, -1)
+    return OffsetAndMetadata(offset, None)
+
+
+def commit_written(consumer: KafkaConsumer, pending: Deque[Tuple[Future, Dict[TopicPartition, int]]],
+                   wait: bool = False, on_written: Callable[[Any, Dict[TopicPartition, int]], None] = None):
+    """Commit offsets of leading written batches, so offset is never committed before db commit of its batch.
+
+    With `wait` waits for the first pending batch. If batch failed, offsets of it and all next batches are dropped
+    to be consumed again after restart, exception of batch is raised. `on_written` is called with results and offsets
+    of written batches in order of batches before their offsets are committed.
+    """
+    offsets = {}
+    try:
+        while pending and (pending[0][0].done() or wait):
+            future, batch_offsets = pending[0]
+            result = future.result()
+            if on_written:
+                on_written(result, batch_offsets)
+            pending.popleft()
+            offsets.update(batch_offsets)
+            wait = False
+    except Exception:
+        pending.clear()
+        raise
+    finally:
+        if offsets:
+            consumer.commit(offsets={tp: make_offset(offset) for tp, offset in offsets.items()})
+
+
+def write_pipelined(consumer: KafkaConsumer, conns: List[db.Connection], timeout_ms=None, maintenance: bool = True,
+                    max_in_flight: int = None, ordered_conn: db.Connection = None):
+    """Consume next batches while previous ones are written by connections of `conns` in threads.
+
+    Outages (db.OUTAGES) and skipped records of transitions mode are written by `ordered_conn` in order of batches
+    when they are written, offsets of written messages are read by it too.
+    """
+    max_in_flight = max_in_flight or PIPELINE_MAX_IN_FLIGHT
+    on_written = partial(write_ordered, ordered_conn) if db.OUTAGES or WRITE_TRANSITIONS else None
+    written_offsets = partial(db.get_offsets, ordered_conn) if WRITE_TRANSITIONS else None
+    pool = queue.Queue()
+    for conn in conns:
+        pool.put(conn)
+    pending = deque()
+    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+
+    with ThreadPoolExecutor(max_workers=len(conns)) as executor:
+        try:
+            while True:
+                recs, offsets = poll_records(consumer, timeout_ms=timeout_ms, written_offsets=written_offsets)
+                skipped = []
+                if WRITE_TRANSITIONS:
+                    recs, skipped = split_transitions(recs)
+                if offsets:
+                    pending.append((executor.submit(write_batch, pool, recs, skipped), offsets))
+                commit_written(consumer, pending, wait=len(pending) >= max_in_flight, on_written=on_written)
+
+                if maintenance and db.PARTITION_BY and time.monotonic() >= next_maintenance:
+                    conn = pool.get()
+                    try:
+                        next_maintenance = maintain_if_needed(conn, next_maintenance)
+                    finally:
+                        pool.put(conn)
+        finally:
+            # let written batches be committed on exit
+            while pending:
+                commit_written(consumer, pending, wait=True, on_written=on_written)
+
+
+def start_writing(timeout_ms=None, maintenance: bool = True, metrics_port: int = None):
+    """Write messages to db until interruption, metrics are served on `metrics_port` (or WRITER_METRICS_PORT)"""
+    conns = [db.get_connect() for _ in range(PIPELINE_CONNECTIONS if WRITE_PIPELINE else 1)]
+    # outages and skipped records of pipelined batches are written in order of batches by own connection
+    ordered_conn = db.get_connect() if WRITE_PIPELINE and (db.OUTAGES or WRITE_TRANSITIONS) else None
+    if db.CHECK_IDS:
+        init_check_ids(conns[0])
+    if WRITE_TRANSITIONS:
+        db.init_offsets_table(conns[0])
+        load_last_states(conns[0])
+    consumer = get_kafka_consumer()
+    metrics_port = metrics_port or metrics.WRITER_METRICS_PORT
+    metrics_server = metrics.start_thread_server(metrics_port) if metrics_port else None
+    try:
+        if WRITE_PIPELINE:
+            write_pipelined(consumer=consumer, conns=conns, timeout_ms=timeout_ms, maintenance=maintenance,
+                            ordered_conn=ordered_conn)
+        else:
+            write_forever(consumer=consumer, conn=conns[0], timeout_ms=timeout_ms, maintenance=maintenance)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        consumer.close()
+        for conn in conns + ([ordered_conn] if ordered_conn else []):
+            conn.close()
+        if metrics_server:
+            metrics_server.shutdown()
+
+
+def run_writer(writer: int, timeout_ms=None):
+    """Entry point of writer process, partitions of topic are balanced between writers by consumer group"""
+    workers.init_worker()
+    log.info(f'start writer {writer}')
+    # partitions are maintained by the first writer only
+    metrics_port = metrics.WRITER_METRICS_PORT + writer if metrics.WRITER_METRICS_PORT else None
+    start_writing(timeout_ms=timeout_ms, maintenance=writer == 0, metrics_port=metrics_port)
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
     log.setLevel(LOG_LEVEL)
 
-    conn = db.get_connect()
-    consumer = get_kafka_consumer()
-    write_forever(consumer=consumer, conn=conn, timeout_ms=5000)
+    if WRITERS == 1:
+        start_writing(timeout_ms=5000)
+    else:
+        workers.run_workers(run_writer, [(5000, )] * WRITERS)
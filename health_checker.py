@@ -1,18 +1,38 @@
 import asyncio
+import codecs
 from datetime import datetime
 from functools import partial
 import logging
-from typing import Union, Optional
-from uuid import uuid4
+import hashlib
+import os
 import re
+import time
+from typing import Awaitable, Callable, Dict, NamedTuple, Union, Optional, Tuple, List
+from urllib.parse import urlsplit
+from uuid import UUID, uuid4
+import zlib
 
 import aiohttp
 from aiohttp import ClientTimeout
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import broker
+from checks import CheckResult, CheckSpec
+import circuit
+from circuit import Circuits
+import limiter
+from limiter import Limiter
+import matcher
+from matcher import RegexpPool
+import metrics
+import publisher
+from scheduler import LoopScheduler
+import spool
+from spool import Spool
+import workers
 from broker import get_kafka_producer, KafkaProducer, get_kafka_admin, create_topic_if_not_exists
-from sites_loader import parse_sites_file, schedule_sites
+from sites_loader import parse_sites_file, schedule_sites, watch_sites_file
 
 
 log = logging.getLogger('app')
@@ -22,6 +42,31 @@ LOG_LEVEl = logging.DEBUG
 DEFAULT_TIMEOUT = ClientTimeout(total=3)
 SITES_FILE = 'conf/sites.json'
 
+# connection pool settings of the shared client session
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+
+# streaming mode: read body by chunks and stop after max_bytes (per site `max_bytes` overrides default)
+STREAM_MAX_BYTES = None
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_OVERLAP = 4096  # chars kept between chunks for matching regexp across chunk boundaries
+
+# scheduler of checks: 'apscheduler' or 'loop' - lightweight scheduler on event loop timers
+SCHEDULER = 'apscheduler'
+# spread first runs of checks evenly across their intervals
+SCHEDULE_SPREAD = False
+
+# interval of checking modification of sites file in seconds, None - sites file isn't reloaded
+SITES_RELOAD_INTERVAL = None
+
+# number of checker processes, sites are sharded between them by check_name; 0 - number of CPUs
+WORKERS = 1
+
+# interval of measuring event loop lag for metrics endpoint (CHECKER_METRICS_PORT)
+LOOP_LAG_INTERVAL = 1
+
 # override settings by local values
 try:
     from conf.local_settings import *       # noqa: F401, F403
@@ -29,111 +74,572 @@ except ImportError:
     pass
 
 
+# metrics of the checker
+CHECK_DURATION = metrics.Histogram('healthchecker_check_duration_seconds', 'Duration of checks')
+CHECKS = metrics.Counter('healthchecker_checks_total', 'Number of checks by health')
+REQUEST_PHASE = metrics.Histogram(
+    'healthchecker_request_phase_seconds',
+    'Duration of request phases: dns, connect (including TLS handshake) and ttfb (from sent request to headers)')
+REGEXP_DURATION = metrics.Histogram('healthchecker_regexp_seconds', 'CPU time of regexp search')
+LOOP_LAG = metrics.Histogram('healthchecker_event_loop_lag_seconds', 'Lag of event loop')
+SCHEDULE_LATENESS = metrics.Histogram(
+    'healthchecker_schedule_lateness_seconds', 'Delay of actual start of check after its planned run time')
+PUBLISH_QUEUE_SIZE = metrics.Gauge('healthchecker_publish_queue_size', 'Number of results in publishing queue')
+SPOOL_RECORDS = metrics.Gauge('healthchecker_spool_records', 'Number of results in spool')
+SKIPPED_CHECKS = metrics.Counter('healthchecker_skipped_checks_total', 'Number of checks skipped by open circuits')
+OPEN_CIRCUITS = metrics.Gauge('healthchecker_open_circuits', 'Number of sites with open circuit')
+CONCURRENCY_LIMIT = metrics.Gauge('healthchecker_concurrency_limit', 'Current global limit of checks in flight')
+IN_FLIGHT = metrics.Gauge('healthchecker_checks_in_flight', 'Number of checks in flight')
+WAITING = metrics.Gauge('healthchecker_checks_waiting', 'Number of checks waiting for global slot')
+HOST_IN_FLIGHT = metrics.Gauge('healthchecker_host_checks_in_flight', 'Number of checks in flight by host')
+
+
 def create_loop():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     return loop
 
 
+def observe_submitted_job(event: JobSubmissionEvent):
+    now = datetime.now(event.scheduled_run_times[-1].tzinfo)
+    SCHEDULE_LATENESS.observe((now - event.scheduled_run_times[-1]).total_seconds())
+
+
+def create_scheduler(loop: asyncio.AbstractEventLoop):
+    if SCHEDULER == 'loop':
+        return LoopScheduler(event_loop=loop, on_lateness=SCHEDULE_LATENESS.observe)
+    schedule = AsyncIOScheduler(event_loop=loop)
+    schedule.add_listener(observe_submitted_job, EVENT_JOB_SUBMITTED)
+    return schedule
+
+
+def record_phase(ctx, phase: str, start: float, accumulate: bool = True):
+    """Observe duration of request phase and add it to timings dict passed as `trace_request_ctx` of request.
+
+    DNS and connect phases are summed across redirects, ttfb is taken from the last response.
+    """
+    duration = time.perf_counter() - start
+    REQUEST_PHASE.observe(duration, phase=phase)
+    timings = ctx.trace_request_ctx
+    if isinstance(timings, dict):
+        if accumulate and timings.get(phase):
+            duration += timings[phase]
+        timings[phase] = duration
+
+
+async def trace_request_start(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceRequestStartParams):
+    ctx.sent = time.perf_counter()
+
+
+async def trace_dns_start(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceDnsResolveHostStartParams):
+    ctx.dns_start = time.perf_counter()
+
+
+async def trace_dns_end(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceDnsResolveHostEndParams):
+    record_phase(ctx, 'dns', ctx.dns_start)
+
+
+async def trace_connect_start(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceConnectionCreateStartParams):
+    ctx.connect_start = time.perf_counter()
+
+
+async def trace_connect_end(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceConnectionCreateEndParams):
+    record_phase(ctx, 'connect', ctx.connect_start)
+
+
+async def trace_headers_sent(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceRequestHeadersSentParams):
+    ctx.sent = time.perf_counter()
+
+
+async def trace_request_end(session: aiohttp.ClientSession, ctx, params: aiohttp.TraceRequestEndParams):
+    record_phase(ctx, 'ttfb', ctx.sent, accumulate=False)
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """Observe durations of request phases, aiohttp doesn't trace TLS handshake apart from connection creation"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(trace_request_start)
+    trace_config.on_dns_resolvehost_start.append(trace_dns_start)
+    trace_config.on_dns_resolvehost_end.append(trace_dns_end)
+    trace_config.on_connection_create_start.append(trace_connect_start)
+    trace_config.on_connection_create_end.append(trace_connect_end)
+    trace_config.on_request_headers_sent.append(trace_headers_sent)
+    trace_config.on_request_end.append(trace_request_end)
+    return trace_config
+
+
+async def create_session() -> aiohttp.ClientSession:
+    """Create long-lived session with connection pool shared by all checks of the process"""
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT, trace_configs=[create_trace_config()])
+
+
+def observe_regexp(cpu_time: float, timings: dict = None):
+    REGEXP_DURATION.observe(cpu_time)
+    if timings is not None:
+        timings['regexp'] = (timings.get('regexp') or 0) + cpu_time
+
+
+def search(regexp: re.Pattern, text: str, timings: dict = None) -> Optional[re.Match]:
+    start = time.thread_time()
+    try:
+        return regexp.search(text)
+    finally:
+        observe_regexp(time.thread_time() - start, timings)
+
+
+async def search_body(regexp: re.Pattern, text: str, timeout: float = None, pool: RegexpPool = None,
+                      timings: dict = None) -> Optional[str]:
+    """Search regexp in body within time budget, large bodies are searched in `pool`.
+
+    Raises RegexpTimeout if budget is exceeded, the budget is put into timings as regexp time then.
+    """
+    try:
+        sample, cpu_time = await matcher.search_text(regexp, text, timeout=timeout, pool=pool)
+    except matcher.RegexpTimeout:
+        if timings is not None:
+            timings['regexp'] = timeout or matcher.REGEXP_TIMEOUT
+        raise
+    observe_regexp(cpu_time, timings)
+    return sample
+
+
+def status_matches(res_status: Optional[int], exp_status: Optional[int]) -> bool:
+    return bool(res_status and not exp_status or res_status == exp_status)
+
+
 def check_resp(
         check_name: str,
-        req_id: str,
+        req_id: Union[UUID, str],
         req_dt: datetime,
         res_status: int,
         res_text: str,
         exp_status: int = None,
-        regexp: Optional[Union[str, re.Pattern]] = None):
+        regexp: Optional[Union[str, re.Pattern]] = None,
+        res_length: int = None,
+        res_sample: str = None,
+        res_duration: float = None,
+        timings: dict = None) -> CheckResult:
+    """Build check result; in streaming mode `res_text` is None and `res_length`, `res_sample` are precomputed.
+
+    `res_duration` is measured by monotonic clock by caller, phases of request from `timings` are added to result.
+    """
 
     health = False
-    res_sample = None
-    res_length = len(res_text) if res_text else None
-    res_duration = (datetime.now() - req_dt).total_seconds()
+    res_length = len(res_text) if res_text else res_length
+    if res_duration is None:
+        res_duration = (datetime.now() - req_dt).total_seconds()
 
-    if res_status and not exp_status or res_status == exp_status:
+    if status_matches(res_status, exp_status):
         health = not regexp
         if regexp and res_length and res_text:
-            if not isinstance(regexp, re.Pattern):
-                regexp = re.compile(regexp)
-            res_sample = regexp.search(res_text)
+            res_sample = search(matcher.get_pattern(regexp), res_text, timings)
             if res_sample:
                 res_sample = res_sample.group()
-                health = True
+        health = health or res_sample is not None
+    else:
+        res_sample = None
 
-    result = {
-        'id': req_id,
-        'check_name': check_name,
-        'dt': req_dt.isoformat(),
-        'health': health,
-        'status': res_status,
-        'duration': res_duration,
-        'length': res_length,
-        'sample': res_sample,
-    }
-    return result
+    return CheckResult(id=req_id, check_name=check_name, dt=req_dt, health=health, status=res_status,
+                       duration=res_duration, length=res_length, sample=res_sample, timings=timings)
 
 
 async def do_request(
+        session: aiohttp.ClientSession,
         check_name: str,
-        req_id: str,
+        req_id: Union[UUID, str],
         url: str,
         method: str = 'GET',
         timeout: Union[float, tuple] = None,
+        timings: dict = None,
         **kwargs
 ):
+    """Request url, returns status and text of response; durations of request phases are put into `timings`"""
     timeout = timeout or DEFAULT_TIMEOUT
     try:
-        log.debug(f'start  req {req_id} {check_name} {url}')
+        log.debug('start  req %s %s %s', req_id, check_name, url)
 
-        async with aiohttp.request(method, url, timeout=timeout, **kwargs) as resp:
+        async with session.request(method, url, timeout=timeout, trace_request_ctx=timings, **kwargs) as resp:
+            start = time.perf_counter()
             text = await resp.text()
-            log.debug(f'finish req {req_id} with {resp.status} {check_name} {url}')
+            if timings is not None:
+                timings['download'] = time.perf_counter() - start
+            log.debug('finish req %s with %s %s %s', req_id, resp.status, check_name, url)
             return resp.status, text
     except (asyncio.TimeoutError, aiohttp.ClientError):
         return None, None
 
 
+def get_decoder(charset: Optional[str]) -> codecs.IncrementalDecoder:
+    try:
+        return codecs.getincrementaldecoder(charset or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+async def read_stream(
+        resp: aiohttp.ClientResponse,
+        max_bytes: int,
+        regexp: Optional[re.Pattern] = None,
+        timings: dict = None,
+        regexp_timeout: float = None,
+        regexp_pool: RegexpPool = None) -> Tuple[int, Optional[str]]:
+    """Read up to max_bytes of response body by chunks and search regexp incrementally.
+
+    Body is decoded only if regexp is defined. Reading stops on the first match which can't be extended by the next
+    chunk (sample isn't at the end of searched text). Searches are run like search in the whole body: by time budget
+    and in `regexp_pool` for large chunks, reading stops without sample if budget is exceeded. Returns length of body
+    in bytes after decompression (Content-Length if reading stopped early and body isn't compressed) and found sample.
+    """
+    # Content-Length is size of compressed body, so bytes actually read are reported for compressed one
+    content_length = None if resp.headers.get('Content-Encoding') else resp.content_length
+    length = 0
+    decoder = get_decoder(resp.charset) if regexp else None
+    tail = ''
+
+    search_window = partial(search_body, regexp, timeout=regexp_timeout, pool=regexp_pool, timings=timings)
+    try:
+        async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+            chunk = chunk[:max_bytes - length]
+            length += len(chunk)
+            final = length >= max_bytes
+            if regexp:
+                text = tail + decoder.decode(chunk, final=final)
+                sample = await search_window(text)
+                if sample is not None and (final or not text.endswith(sample)):
+                    return content_length or length, sample
+                tail = text[-STREAM_OVERLAP:]
+            if final:
+                return content_length or length, None
+
+        if regexp:
+            return length, await search_window(tail + decoder.decode(b'', final=True))
+    except matcher.RegexpTimeout:
+        return content_length or length, None
+    return length, None
+
+
+async def do_stream_request(
+        session: aiohttp.ClientSession,
+        check_name: str,
+        req_id: Union[UUID, str],
+        url: str,
+        max_bytes: int,
+        method: str = 'GET',
+        timeout: Union[float, tuple] = None,
+        regexp: Optional[Union[str, re.Pattern]] = None,
+        timings: dict = None,
+        regexp_timeout: float = None,
+        regexp_pool: RegexpPool = None,
+        **kwargs
+) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    timeout = timeout or DEFAULT_TIMEOUT
+    if regexp:
+        regexp = matcher.get_pattern(regexp)
+    try:
+        log.debug('start  stream req %s %s %s', req_id, check_name, url)
+
+        async with session.request(method, url, timeout=timeout, trace_request_ctx=timings, **kwargs) as resp:
+            start = time.perf_counter()
+            length, sample = await read_stream(resp, max_bytes, regexp=regexp, timings=timings,
+                                               regexp_timeout=regexp_timeout, regexp_pool=regexp_pool)
+            if timings is not None:
+                timings['download'] = time.perf_counter() - start
+            log.debug('finish stream req %s with %s %s %s, %s bytes', req_id, resp.status, check_name, url, length)
+            return resp.status, length, sample
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return None, None, None
+
+
+class CachedResponse(NamedTuple):
+    """Validators and outcome of the last response of site checked in conditional mode"""
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body_hash: bytes
+    regexp: Optional[str]
+    status: int
+    length: Optional[int]
+    sample: Optional[str]
+
+
+# last responses of sites checked in conditional mode by check_name
+RESPONSE_CACHE: Dict[str, CachedResponse] = {}
+
+
+def forget_responses(check_names: List[str]):
+    """Drop cached responses of removed or changed sites"""
+    for check_name in check_names:
+        RESPONSE_CACHE.pop(check_name, None)
+
+
+def forget_sites(circuits: Optional[Circuits], check_names: List[str]):
+    """Drop state of removed or changed sites kept between checks"""
+    forget_responses(check_names)
+    if circuits:
+        circuits.discard(check_names)
+
+
+def body_hash(body: bytes) -> bytes:
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+def conditional_headers(headers: Optional[dict], cached: Optional[CachedResponse]) -> Optional[dict]:
+    if not cached or not (cached.etag or cached.last_modified):
+        return headers
+    headers = dict(headers or {})
+    if cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+async def do_raw_request(
+        session: aiohttp.ClientSession,
+        check_name: str,
+        req_id: Union[UUID, str],
+        url: str,
+        method: str = 'GET',
+        timeout: Union[float, tuple] = None,
+        timings: dict = None,
+        **kwargs
+) -> Tuple[Optional[int], Optional[bytes], Optional[aiohttp.ClientResponse]]:
+    """Request url, returns status, not decoded body (None for 304) and response for its headers and encoding"""
+    timeout = timeout or DEFAULT_TIMEOUT
+    try:
+        log.debug('start  raw req %s %s %s', req_id, check_name, url)
+
+        async with session.request(method, url, timeout=timeout, trace_request_ctx=timings, **kwargs) as resp:
+            start = time.perf_counter()
+            body = None if resp.status == 304 else await resp.read()
+            if timings is not None:
+                timings['download'] = time.perf_counter() - start
+            log.debug('finish raw req %s with %s %s %s', req_id, resp.status, check_name, url)
+            return resp.status, body, resp
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return None, None, None
+
+
+async def do_conditional_check(
+        session: aiohttp.ClientSession,
+        check_name: str,
+        req_id: Union[UUID, str],
+        url: str,
+        method: str,
+        timeout: Union[float, tuple] = None,
+        status: int = None,
+        regexp: Optional[Union[str, re.Pattern]] = None,
+        regexp_timeout: float = None,
+        regexp_pool: RegexpPool = None,
+        timings: dict = None,
+        headers: dict = None,
+        **kwargs) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """Request with validators of the last response and reuse its length and sample if page isn't changed.
+
+    Page is unchanged on 304 or the same hash of body, then body isn't decoded and regexp isn't searched.
+    Returns status, length and sample.
+    """
+    pattern = matcher.get_pattern(regexp).pattern if regexp else None
+    cached = RESPONSE_CACHE.get(check_name)
+    if cached and (cached.url != url or cached.regexp != pattern):
+        cached = None
+
+    res_status, body, resp = await do_raw_request(
+        session, check_name=check_name, req_id=req_id, url=url, method=method, timeout=timeout, timings=timings,
+        headers=conditional_headers(headers, cached), **kwargs)
+    if res_status == 304 and cached:
+        log.debug('req %s %s not modified', req_id, check_name)
+        return cached.status, cached.length, cached.sample
+    if body is None:
+        return res_status, None, None
+
+    digest = body_hash(body)
+    if cached and cached.body_hash == digest and cached.status == res_status:
+        log.debug('req %s %s body is unchanged', req_id, check_name)
+        etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+        if (etag, last_modified) != (cached.etag, cached.last_modified):
+            # validators may change without change of body, stale ones would force full downloads
+            RESPONSE_CACHE[check_name] = cached._replace(etag=etag, last_modified=last_modified)
+        return cached.status, cached.length, cached.sample
+
+    text = body.decode(resp.get_encoding(), errors='replace')
+    res_sample = None
+    cacheable = True
+    if regexp and text and status_matches(res_status, status):
+        try:
+            res_sample = await search_body(matcher.get_pattern(regexp), text, timeout=regexp_timeout,
+                                           pool=regexp_pool, timings=timings)
+        except matcher.RegexpTimeout:
+            cacheable = False
+    res_length = len(text) if text else None
+    if cacheable:
+        RESPONSE_CACHE[check_name] = CachedResponse(
+            url=url, etag=resp.headers.get('ETag'), last_modified=resp.headers.get('Last-Modified'), body_hash=digest,
+            regexp=pattern, status=res_status, length=res_length, sample=res_sample)
+    return res_status, res_length, res_sample
+
+
 async def do_check(
+        session: aiohttp.ClientSession,
         check_name: str,
         url: str,
         method: str = None,
         timeout: Union[float, tuple] = None,
         status: int = None,
         regexp: Optional[Union[str, re.Pattern]] = None,
-        **kwargs) -> dict:
+        max_bytes: int = None,
+        regexp_timeout: float = None,
+        regexp_pool: RegexpPool = None,
+        conditional: bool = False,
+        **kwargs) -> CheckResult:
+    """Check site; in conditional mode unchanged pages aren't downloaded or searched again (not in streaming mode)"""
     method = method or 'GET'
+    max_bytes = max_bytes or STREAM_MAX_BYTES
 
-    req_id = str(uuid4())
+    req_id = uuid4()
     req_dt = datetime.now()
+    if regexp:
+        try:
+            regexp = matcher.get_pattern(regexp)
+        except re.error as exc:
+            # regexps aren't compiled on loading of sites, so invalid one is reported by results of its check
+            log.warning(f'invalid regexp of {check_name}: {exc}')
+            return CheckResult(id=req_id, check_name=check_name, dt=req_dt, health=False, status=None, duration=0,
+                               length=None, sample=f'invalid regexp: {exc}', timings={})
+    start = time.perf_counter()
+    timings = {}
+    if max_bytes:
+        res_status, res_length, res_sample = await do_stream_request(
+            session, check_name=check_name, req_id=req_id, url=url, max_bytes=max_bytes, method=method,
+            timeout=timeout, regexp=regexp, timings=timings, regexp_timeout=regexp_timeout, regexp_pool=regexp_pool,
+            **kwargs)
+        return check_resp(check_name, req_id, req_dt, res_status=res_status, res_text=None, exp_status=status,
+                          regexp=regexp, res_length=res_length, res_sample=res_sample,
+                          res_duration=round(time.perf_counter() - start, 6), timings=timings)
+
+    if conditional:
+        res_status, res_length, res_sample = await do_conditional_check(
+            session, check_name=check_name, req_id=req_id, url=url, method=method, timeout=timeout, status=status,
+            regexp=regexp, regexp_timeout=regexp_timeout, regexp_pool=regexp_pool, timings=timings, **kwargs)
+        return check_resp(check_name, req_id, req_dt, res_status=res_status, res_text=None, exp_status=status,
+                          regexp=regexp, res_length=res_length, res_sample=res_sample,
+                          res_duration=round(time.perf_counter() - start, 6), timings=timings)
+
     res_status, res_text = await do_request(
-        check_name=check_name, req_id=req_id, url=url, method=method, timeout=timeout, **kwargs)
+        session, check_name=check_name, req_id=req_id, url=url, method=method, timeout=timeout, timings=timings,
+        **kwargs)
+
+    if regexp and res_text and status_matches(res_status, status):
+        try:
+            res_sample = await search_body(matcher.get_pattern(regexp), res_text, timeout=regexp_timeout,
+                                           pool=regexp_pool, timings=timings)
+        except matcher.RegexpTimeout:
+            res_sample = None
+        return check_resp(check_name, req_id, req_dt, res_status=res_status, res_text=None, exp_status=status,
+                          regexp=regexp, res_length=len(res_text), res_sample=res_sample,
+                          res_duration=round(time.perf_counter() - start, 6), timings=timings)
 
     return check_resp(check_name, req_id, req_dt, res_status=res_status, res_text=res_text, exp_status=status,
-                      regexp=regexp)
+                      regexp=regexp, res_duration=round(time.perf_counter() - start, 6), timings=timings)
+
+
+def run_check(session: aiohttp.ClientSession, spec: CheckSpec, **kwargs) -> Awaitable[CheckResult]:
+    return do_check(session, spec.check_name, spec.url, method=spec.method or 'GET', timeout=spec.timeout,
+                    status=spec.status, regexp=spec.regexp, **(spec.options or {}), **kwargs)
 
 
 async def check_website(
-        producer: KafkaProducer,
-        check_name: str,
-        url: str,
-        method: str = None,
-        timeout: Union[float, tuple] = None,
-        status: int = None,
-        regexp: Optional[Union[str, re.Pattern]] = None,
-        topic_name: str = None,
+        queue: asyncio.Queue,
+        session: aiohttp.ClientSession,
+        spec: CheckSpec,
+        checks_limiter: Limiter = None,
+        results_spool: Spool = None,
+        circuits: Circuits = None,
         **kwargs
 ):
-    topic_name = topic_name or broker.TOPIC_NAME
-    method = method or 'GET'
-    res = await do_check(check_name, url, method=method, timeout=timeout, status=status, regexp=regexp, **kwargs)
-    producer.send(topic_name, res)
+    """Run check of `spec` and enqueue its result for publishing; checks of sites with open circuit are skipped
+    until their probe is due"""
+    if circuits and not circuits.allow(spec.check_name):
+        SKIPPED_CHECKS.inc()
+        return
+    if checks_limiter:
+        # waiting for a slot isn't included into duration of check
+        async with checks_limiter.slot(urlsplit(spec.url).hostname):
+            res = await run_check(session, spec, **kwargs)
+        checks_limiter.record(failed=res.status is None)
+    else:
+        res = await run_check(session, spec, **kwargs)
+    if circuits:
+        res.circuit = circuits.record(spec.check_name, failed=not res.health, dt=res.dt)
+        if res.circuit == circuit.OPENED:
+            res.failed_since = circuits.failed_since(spec.check_name)
+    CHECK_DURATION.observe(res.duration)
+    CHECKS.inc(health='true' if res.health else 'false')
+    await publisher.enqueue(queue, spec.topic_name or broker.TOPIC_NAME, res, spool=results_spool)
+
+
+async def monitor_loop_lag(interval: float = None):
+    interval = interval or LOOP_LAG_INTERVAL
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
 
+def observe_limiter(checks_limiter: Limiter):
+    if checks_limiter.limit is not None:
+        CONCURRENCY_LIMIT.set_function(lambda: checks_limiter.limit)
+    IN_FLIGHT.set_function(lambda: checks_limiter.in_flight)
+    WAITING.set_function(lambda: len(checks_limiter.waiters))
+    HOST_IN_FLIGHT.set_label_function('host', lambda: dict(checks_limiter.hosts_in_flight))
 
-def start_checking(producer: KafkaProducer, sites: dict, timeout: float = None):
+
+def start_checking(producer: KafkaProducer, sites: dict, timeout: float = None, sites_file: str = None,
+                   site_filter: Callable[[str], bool] = None, spool_dir: str = None, metrics_port: int = None):
+    """Check sites until timeout or interruption, sites are reloaded from `sites_file` if SITES_RELOAD_INTERVAL set.
+
+    Results are spooled to `spool_dir` (or SPOOL_DIR) when producer is backpressured or fails. Metrics are served on
+    `metrics_port` (or CHECKER_METRICS_PORT).
+    """
     loop = create_loop()
+    session = loop.run_until_complete(create_session())
+    queue = publisher.create_queue()
+    results_spool = spool.create_spool(spool_dir)
+    sender = loop.create_task(publisher.publish_forever(producer, queue, spool=results_spool))
+    regexp_pool = matcher.create_regexp_pool()
+    drainer = loop.create_task(publisher.drain_spool(producer, results_spool, queue)) if results_spool else None
+    PUBLISH_QUEUE_SIZE.set_function(queue.qsize)
+    if results_spool:
+        SPOOL_RECORDS.set_function(lambda: results_spool.records)
+    metrics_port = metrics_port or metrics.CHECKER_METRICS_PORT
+    metrics_runner = loop.run_until_complete(metrics.start_server(metrics_port)) if metrics_port else None
+    lag_monitor = loop.create_task(monitor_loop_lag()) if metrics_port else None
+    checks_limiter = limiter.create_limiter(max_concurrency=CONNECTION_LIMIT)
+    monitor = loop.create_task(checks_limiter.monitor()) if checks_limiter and limiter.ADAPTIVE_CONCURRENCY else None
+    if checks_limiter:
+        observe_limiter(checks_limiter)
+    circuits = circuit.create_circuits()
+    if circuits:
+        OPEN_CIRCUITS.set_function(circuits.open_count)
 
-    schedule = AsyncIOScheduler(event_loop=loop)
-    schedule_sites(schedule, partial(check_website, producer), sites=sites)
+    schedule = create_scheduler(loop)
+    func = partial(check_website, queue, session, checks_limiter=checks_limiter, results_spool=results_spool,
+                   circuits=circuits, regexp_pool=regexp_pool)
+    schedule_sites(schedule, func, sites=sites, spread=SCHEDULE_SPREAD)
     schedule.start()
+    watcher = None
+    if sites_file and SITES_RELOAD_INTERVAL:
+        # changed sites are always spread to avoid burst of checks after reload
+        watcher = loop.create_task(watch_sites_file(
+            sites_file, schedule, func, SITES_RELOAD_INTERVAL, site_filter=site_filter, spread=True,
+            on_unscheduled=partial(forget_sites, circuits)))
 
     try:
         if timeout:
@@ -142,6 +648,53 @@ def start_checking(producer: KafkaProducer, sites: dict, timeout: float = None):
             loop.run_forever()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        schedule.shutdown(wait=False)
+        for task in [monitor, watcher, lag_monitor]:
+            if task:
+                task.cancel()
+        loop.run_until_complete(publisher.close_publisher(producer, queue, sender, results_spool, drainer))
+        loop.run_until_complete(session.close())
+        if regexp_pool:
+            regexp_pool.close()
+        if metrics_runner:
+            loop.run_until_complete(metrics_runner.cleanup())
+
+
+def shard_of(check_name: str, shards: int) -> int:
+    return zlib.crc32(check_name.encode('utf-8')) % shards
+
+
+def shard_sites(sites: dict, shards: int) -> List[dict]:
+    """Split sites between shards by stable hash of check_name"""
+    parts = [{} for _ in range(shards)]
+    for check_name, site in sites.items():
+        parts[shard_of(check_name, shards)][check_name] = site
+    return parts
+
+
+def run_worker(worker: int, sites: dict, shard: int, shards: int, sites_file: str = None):
+    """Entry point of worker process: own event loop, session and producer for its shard of sites"""
+    workers.init_worker()
+    log.info(f'start worker {worker} with {len(sites)} sites of shard {shard}')
+    producer = get_kafka_producer()
+    # spool of the shard is drained by the same worker after restart
+    spool_dir = os.path.join(spool.SPOOL_DIR, f'shard-{shard}') if spool.SPOOL_DIR else None
+    metrics_port = metrics.CHECKER_METRICS_PORT + worker if metrics.CHECKER_METRICS_PORT else None
+    start_checking(producer=producer, sites=sites, sites_file=sites_file, spool_dir=spool_dir,
+                   metrics_port=metrics_port, site_filter=lambda check_name: shard_of(check_name, shards) == shard)
+    producer.close()
+
+
+def run_workers(sites: dict, workers_count: int = None, sites_file: str = None):
+    """Run sharded checking in `workers_count` processes, number of CPUs by default.
+
+    Shards without sites are skipped unless sites file is reloaded, as sites may be added to them later.
+    """
+    shards = workers_count or os.cpu_count()
+    args_list = [(part, shard, shards, sites_file) for shard, part in enumerate(shard_sites(sites, shards))
+                 if part or (sites_file and SITES_RELOAD_INTERVAL)]
+    workers.run_workers(run_worker, args_list)
 
 
 if __name__ == '__main__':
@@ -150,6 +703,9 @@ if __name__ == '__main__':
 
     sites = parse_sites_file(SITES_FILE)
     create_topic_if_not_exists(admin=get_kafka_admin(), topic_name=broker.TOPIC_NAME)
-    producer = get_kafka_producer()
-    start_checking(producer=producer, sites=sites)
-    producer.close()
+    if WORKERS == 1:
+        producer = get_kafka_producer()
+        start_checking(producer=producer, sites=sites, sites_file=SITES_FILE)
+        producer.close()
+    else:
+        run_workers(sites, workers_count=WORKERS, sites_file=SITES_FILE)
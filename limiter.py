@@ -0,0 +1,160 @@
+import asyncio
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+import logging
+from typing import Optional
+
+
+# define settings default values
+MAX_CONCURRENCY = None              # global limit of checks in flight, None - unlimited
+MAX_CONCURRENCY_PER_HOST = None     # limit of checks in flight per host, None - unlimited
+# adaptive mode lowers global limit when event loop lag or failure rate of checks rises and raises it back otherwise
+ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_MIN_CONCURRENCY = 10
+ADAPTIVE_INTERVAL = 1
+ADAPTIVE_MAX_LOOP_LAG = 0.1
+ADAPTIVE_MAX_FAILURE_RATE = 0.2
+ADAPTIVE_DECREASE = 0.75
+ADAPTIVE_INCREASE = 10
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.limiter')
+
+
+class Limiter:
+    """Global limit with adjustable size and fixed per-host limits of checks in flight"""
+
+    def __init__(self, limit: int = None, per_host: int = None, min_limit: int = 1):
+        self.limit = limit
+        self.max_limit = limit
+        self.min_limit = min_limit
+        self.per_host = per_host
+        self.in_flight = 0
+        self.hosts_in_flight = defaultdict(int)
+        self.host_semaphores = {}
+        self.waiters = deque()
+        self.loop_lag = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def has_free_slot(self) -> bool:
+        return self.limit is None or self.in_flight < self.limit
+
+    def wake(self):
+        """Pass free slots to waiters in FIFO order"""
+        while self.waiters and self.has_free_slot():
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                self.in_flight += 1
+
+    async def acquire(self):
+        if not self.waiters and self.has_free_slot():
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # slot was already passed to this waiter
+                self.release()
+            elif fut in self.waiters:
+                self.waiters.remove(fut)
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def host_semaphore(self, host: str) -> Optional[asyncio.Semaphore]:
+        if not self.per_host:
+            return None
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self.host_semaphores[host]
+
+    @asynccontextmanager
+    async def slot(self, host: str):
+        """Wait for free slot of host first and then for global one, so global slots aren't held by waiting checks"""
+        semaphore = self.host_semaphore(host)
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            await self.acquire()
+            self.hosts_in_flight[host] += 1
+            try:
+                yield
+            finally:
+                self.hosts_in_flight[host] -= 1
+                if not self.hosts_in_flight[host]:
+                    del self.hosts_in_flight[host]
+                self.release()
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    def record(self, failed: bool):
+        self.requests += 1
+        self.failures += failed
+
+    def set_limit(self, limit: int):
+        if limit != self.limit:
+            log.info(f'concurrency limit {self.limit} -> {limit}, '
+                     f'in flight {self.in_flight}, waiting {len(self.waiters)}')
+        self.limit = limit
+        self.wake()
+
+    def adjust(self, loop_lag: float, max_loop_lag: float = None, max_failure_rate: float = None):
+        """Decrease limit multiplicatively on overload, increase it additively while there are waiting checks"""
+        max_loop_lag = ADAPTIVE_MAX_LOOP_LAG if max_loop_lag is None else max_loop_lag
+        max_failure_rate = ADAPTIVE_MAX_FAILURE_RATE if max_failure_rate is None else max_failure_rate
+        self.loop_lag = loop_lag
+        failure_rate = self.failures / self.requests if self.requests else 0
+        self.requests = self.failures = 0
+        if self.limit is None:
+            return
+
+        if loop_lag > max_loop_lag or failure_rate > max_failure_rate:
+            self.set_limit(max(self.min_limit, int(self.limit * ADAPTIVE_DECREASE)))
+        elif self.waiters:
+            self.set_limit(min(self.max_limit, self.limit + ADAPTIVE_INCREASE))
+
+    async def monitor(self, interval: float = None):
+        """Measure event loop lag and adjust limit every `interval` seconds"""
+        interval = interval or ADAPTIVE_INTERVAL
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.adjust(loop.time() - start - interval)
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'waiting': len(self.waiters),
+            'hosts_in_flight': dict(self.hosts_in_flight),
+            'loop_lag': self.loop_lag,
+        }
+
+
+def create_limiter(max_concurrency: int = None) -> Optional[Limiter]:
+    """Create limiter by settings, None if checks aren't limited.
+
+    Adaptive mode needs upper bound of global limit, `max_concurrency` is used if MAX_CONCURRENCY isn't set.
+    """
+    limit = MAX_CONCURRENCY
+    if ADAPTIVE_CONCURRENCY:
+        limit = limit or max_concurrency
+    if not limit and not MAX_CONCURRENCY_PER_HOST:
+        return None
+    return Limiter(limit=limit, per_host=MAX_CONCURRENCY_PER_HOST,
+                   min_limit=min(ADAPTIVE_MIN_CONCURRENCY, limit) if limit else 1)
@@ -0,0 +1,131 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import logging
+import multiprocessing
+import re
+import signal
+import time
+from typing import Optional, Tuple, Union
+
+
+# define settings default values
+REGEXP_CACHE_SIZE = 4096            # compiled patterns shared by all sites of the process
+# search over bodies of REGEXP_OFFLOAD_SIZE chars and more is run in pool of REGEXP_PROCESSES processes,
+# None - all searches are run on event loop
+REGEXP_OFFLOAD_SIZE = None
+REGEXP_PROCESSES = 2
+# time budget of search in seconds, per site `regexp_timeout` overrides it; offloaded search is aborted by budget,
+# search on event loop can't be interrupted, so result of search over budget is discarded
+REGEXP_TIMEOUT = 1
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.matcher')
+
+
+class RegexpTimeout(Exception):
+    pass
+
+
+@lru_cache(maxsize=REGEXP_CACHE_SIZE)
+def compile_regexp(pattern: str, flags: int = 0) -> re.Pattern:
+    return re.compile(pattern, flags)
+
+
+def get_pattern(regexp: Union[str, re.Pattern]) -> re.Pattern:
+    return regexp if isinstance(regexp, re.Pattern) else compile_regexp(regexp)
+
+
+def search(regexp: re.Pattern, text: str) -> Tuple[Optional[str], float]:
+    """Search regexp, returns found sample and CPU time of search"""
+    start = time.thread_time()
+    match = regexp.search(text)
+    return match.group() if match else None, time.thread_time() - start
+
+
+def search_pattern(pattern: str, flags: int, text: str) -> Tuple[Optional[str], float]:
+    """Search in pool process, pattern is compiled by cache of the process"""
+    return search(compile_regexp(pattern, flags), text)
+
+
+def init_process():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class RegexpPool:
+    """Process pool for searching regexp in large bodies, so catastrophic backtracking doesn't stall event loop.
+
+    Searches are limited by number of processes, so waiting for free process isn't counted in time budget. Processes
+    are killed on timeout, as running search can't be cancelled otherwise.
+    """
+
+    def __init__(self, processes: int = None):
+        self.processes = processes or REGEXP_PROCESSES
+        self.semaphore = asyncio.Semaphore(self.processes)
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawned processes don't inherit threads of producer and event loop of the checker
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=init_process,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    async def search(self, regexp: re.Pattern, text: str, timeout: float) -> Tuple[Optional[str], float]:
+        async with self.semaphore:
+            for attempt in range(2):
+                executor = self.get_executor()
+                future = asyncio.get_running_loop().run_in_executor(
+                    executor, search_pattern, regexp.pattern, regexp.flags, text)
+                try:
+                    return await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    log.warning(f'regexp {regexp.pattern!r} exceeded time budget {timeout}s, restart regexp processes')
+                    self.kill(executor)
+                    raise RegexpTimeout()
+                except BrokenProcessPool:
+                    # processes were killed by timeout of another search
+                    if executor is self.executor:
+                        self.executor = None
+                    if attempt:
+                        raise
+
+    def kill(self, executor: ProcessPoolExecutor):
+        if executor is self.executor:
+            self.executor = None
+        # executor has no public API to stop busy processes
+        for proc in list(executor._processes.values()):
+            proc.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        if self.executor:
+            self.kill(self.executor)
+
+
+def create_regexp_pool() -> Optional[RegexpPool]:
+    return RegexpPool() if REGEXP_OFFLOAD_SIZE else None
+
+
+async def search_text(regexp: re.Pattern, text: str, timeout: float = None,
+                      pool: RegexpPool = None) -> Tuple[Optional[str], float]:
+    """Search regexp on event loop or in `pool` for texts of REGEXP_OFFLOAD_SIZE chars and more.
+
+    Returns found sample and CPU time of search, raises RegexpTimeout if search exceeded time budget.
+    """
+    timeout = timeout or REGEXP_TIMEOUT
+    if pool and REGEXP_OFFLOAD_SIZE and len(text) >= REGEXP_OFFLOAD_SIZE:
+        return await pool.search(regexp, text, timeout)
+    start = time.perf_counter()
+    sample, cpu_time = search(regexp, text)
+    if time.perf_counter() - start > timeout:
+        log.warning(f'regexp {regexp.pattern!r} exceeded time budget {timeout}s on event loop')
+        raise RegexpTimeout()
+    return sample, cpu_time
@@ -0,0 +1,191 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from aiohttp import web
+
+
+# define settings default values
+METRICS_HOST = '0.0.0.0'
+# ports of metrics endpoints, None - endpoint is disabled; worker processes use port + number of worker
+CHECKER_METRICS_PORT = None
+WRITER_METRICS_PORT = None
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def labels_key(labels: dict) -> LabelsKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: LabelsKey) -> str:
+    if not key:
+        return ''
+    pairs = ','.join('%s="%s"' % (k, v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for k, v in key)
+    return '{' + pairs + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of metrics in Prometheus text format, metric is registered in `registry` on creation"""
+    type = 'untyped'
+
+    def __init__(self, name: str, doc: str, registry: Dict[str, 'Metric'] = None):
+        self.name = name
+        self.doc = doc
+        registry = REGISTRY if registry is None else registry
+        registry[name] = self
+
+    def samples(self) -> Iterator[Tuple[str, LabelsKey, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{format_labels(key)} {format_value(value)}' for name, key, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, doc: str, registry: Dict[str, Metric] = None):
+        super().__init__(name, doc, registry)
+        self.values: Dict[LabelsKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, key, value
+
+
+class Gauge(Metric):
+    """Gauge is set explicitly or computed by functions on rendering, label function returns values by values of
+    its label"""
+    type = 'gauge'
+
+    def __init__(self, name: str, doc: str, registry: Dict[str, Metric] = None):
+        super().__init__(name, doc, registry)
+        self.values: Dict[LabelsKey, float] = {}
+        self.functions: Dict[LabelsKey, Callable[[], float]] = {}
+        self.label_functions: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[labels_key(labels)] = value
+
+    def set_function(self, func: Callable[[], float], **labels):
+        self.functions[labels_key(labels)] = func
+
+    def set_label_function(self, label: str, func: Callable[[], Dict[str, float]]):
+        self.label_functions[label] = func
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, key, value
+        for key, func in list(self.functions.items()):
+            yield self.name, key, func()
+        for label, func in list(self.label_functions.items()):
+            for label_value, value in list(func().items()):
+                yield self.name, labels_key({label: label_value}), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, doc: str, buckets: List[float] = None, registry: Dict[str, Metric] = None):
+        super().__init__(name, doc, registry)
+        self.buckets = sorted(buckets or LATENCY_BUCKETS)
+        # per labels: counts of buckets (the last one is +Inf), sum and count of observations
+        self.values: Dict[LabelsKey, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = labels_key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [float('inf')], list(counts)):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', key + (('le', format_value(float(bound))),), cumulative
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, count
+
+
+REGISTRY: Dict[str, Metric] = {}
+
+
+def render(registry: Dict[str, Metric] = None) -> str:
+    registry = REGISTRY if registry is None else registry
+    lines = []
+    for metric in list(registry.values()):
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            log.exception(f'failed to render metric {metric.name}')
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_server(port: int, host: str = None) -> web.AppRunner:
+    """Serve /metrics on event loop of the checker"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host or METRICS_HOST, port).start()
+    log.info(f'metrics are served on port {port}')
+    return runner
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_thread_server(port: int, host: str = None) -> ThreadingHTTPServer:
+    """Serve /metrics in background thread for synchronous processes like db_writer"""
+    server = ThreadingHTTPServer((host or METRICS_HOST, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'metrics are served on port {port}')
+    return server
@@ -0,0 +1,188 @@
+import asyncio
+from collections import Counter
+from functools import partial
+import logging
+from typing import Callable, List, Tuple
+
+from kafka import KafkaProducer
+
+import broker
+import metrics
+from spool import Spool
+
+
+# define settings default values
+PUBLISH_QUEUE_SIZE = 10000
+PUBLISH_BATCH_SIZE = 500
+PUBLISH_LINGER = 0.05
+# spooled results are republished by batches, read position of spool is saved after their delivery
+SPOOL_DRAIN_BATCH_SIZE = 1000
+SPOOL_DRAIN_INTERVAL = 1
+SPOOL_DELIVERY_TIMEOUT = 30
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.publisher')
+
+# counters of publishing pipeline: enqueued, waits (enqueue blocked by full queue), batches, sent, errors,
+# spooled (results written to spool instead of the queue or producer), drained (republished from spool)
+stats = Counter()
+EVENTS = metrics.Counter('healthchecker_publisher_events_total',
+                         'Counters of publishing pipeline by event: enqueued, waits, batches, sent, errors, spooled, '
+                         'drained')
+
+
+def count(event: str, amount: int = 1):
+    stats[event] += amount
+    EVENTS.inc(amount, event=event)
+
+
+def create_queue() -> asyncio.Queue:
+    return asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+
+
+async def enqueue(queue: asyncio.Queue, topic_name: str, value: dict, spool: Spool = None):
+    """Put result into publishing queue, waits for free slot when queue is full (backpressure) or spools result"""
+    if queue.full() and spool:
+        spool_result(spool, topic_name, value)
+        return
+    if queue.full():
+        count('waits')
+        log.debug(f'publish queue is full ({queue.qsize()}), wait')
+    await queue.put((topic_name, value))
+    count('enqueued')
+
+
+async def get_batch(queue: asyncio.Queue, batch_size: int = None, linger: float = None) -> List[Tuple[str, dict]]:
+    """Wait for the first item and collect next ones during `linger` seconds up to `batch_size` items"""
+    batch_size = batch_size or PUBLISH_BATCH_SIZE
+    linger = PUBLISH_LINGER if linger is None else linger
+    loop = asyncio.get_running_loop()
+
+    batch = [await queue.get()]
+    deadline = loop.time() + linger
+    while len(batch) < batch_size:
+        if not queue.empty():
+            batch.append(queue.get_nowait())
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+def spool_result(spool: Spool, topic_name: str, value: dict):
+    if spool.append(topic_name, value):
+        count('spooled')
+
+
+def spool_failed(loop: asyncio.AbstractEventLoop, spool: Spool, topic_name: str, value: dict, exc: Exception):
+    """Errback of producer future, it's called by producer thread"""
+    try:
+        loop.call_soon_threadsafe(spool_result, spool, topic_name, value)
+    except RuntimeError:
+        log.error(f'result of {value.get("check_name")} is lost, event loop is closed: {exc}')
+
+
+def send_batch(producer: KafkaProducer, batch: List[Tuple[str, dict]],
+               on_error: Callable = None) -> List[Tuple[str, dict]]:
+    """Pass batch to producer, failed deliveries are passed to `on_error(topic_name, value, exc)`.
+
+    Results are keyed by check_name, so results of a check go to the same partition and are consumed in order.
+
+    Without `on_error` producer errors are raised, otherwise results not passed to producer are returned.
+    """
+    headers = broker.message_headers()
+    for i, (topic_name, value) in enumerate(batch):
+        try:
+            future = producer.send(topic_name, value, key=value['check_name'], headers=headers)
+        except Exception:
+            if not on_error:
+                raise
+            log.exception(f'failed to publish {len(batch) - i} results')
+            return batch[i:]
+        if on_error:
+            future.add_errback(on_error, topic_name, value)
+    return []
+
+
+async def publish_forever(producer: KafkaProducer, queue: asyncio.Queue, batch_size: int = None, linger: float = None,
+                          spool: Spool = None):
+    """Drain queue by batches and pass them to producer in executor, so blocking send doesn't stall the loop.
+
+    With `spool` results which weren't passed to producer or delivered by it are written to spool.
+    """
+    loop = asyncio.get_running_loop()
+    on_error = partial(spool_failed, loop, spool) if spool else None
+    while True:
+        batch = await get_batch(queue, batch_size=batch_size, linger=linger)
+        try:
+            rest = await loop.run_in_executor(None, send_batch, producer, batch, on_error)
+            for topic_name, value in rest:
+                spool_result(spool, topic_name, value)
+            count('batches')
+            count('sent', len(batch) - len(rest))
+            log.debug(f'published batch of {len(batch)} results, queue size {queue.qsize()}')
+        except Exception:
+            count('errors', len(batch))
+            log.exception(f'failed to publish batch of {len(batch)} results')
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+def deliver_batch(producer: KafkaProducer, batch: List[Tuple[str, dict]], timeout: float):
+    """Send batch and wait for delivery of all results, raises error of the first failed one"""
+    headers = broker.message_headers()
+    futures = [producer.send(topic_name, value, key=value['check_name'], headers=headers)
+               for topic_name, value in batch]
+    for future in futures:
+        future.get(timeout=timeout)
+
+
+async def drain_spool(producer: KafkaProducer, spool: Spool, queue: asyncio.Queue, batch_size: int = None,
+                      interval: float = None, timeout: float = None):
+    """Republish spooled results in order while publishing queue isn't full, retry every `interval` on failure"""
+    batch_size = batch_size or SPOOL_DRAIN_BATCH_SIZE
+    interval = SPOOL_DRAIN_INTERVAL if interval is None else interval
+    timeout = timeout or SPOOL_DELIVERY_TIMEOUT
+    loop = asyncio.get_running_loop()
+    while True:
+        if not spool.records or queue.full():
+            await asyncio.sleep(interval)
+            continue
+        batch = spool.read(batch_size)
+        try:
+            await loop.run_in_executor(None, deliver_batch, producer, batch, timeout)
+        except Exception as exc:
+            log.warning(f'failed to drain spool ({spool.records} records), retry in {interval}s: {exc!r}')
+            await asyncio.sleep(interval)
+            continue
+        spool.commit(len(batch))
+        count('drained', len(batch))
+        log.debug(f'drained {len(batch)} results from spool, {spool.records} records left')
+
+
+async def close_publisher(producer: KafkaProducer, queue: asyncio.Queue, sender: asyncio.Task, spool: Spool = None,
+                          drainer: asyncio.Task = None):
+    """Wait until all queued results are passed to producer, stop sender and flush producer buffers"""
+    if drainer:
+        drainer.cancel()
+    if not sender.done():
+        await queue.join()
+        sender.cancel()
+    await asyncio.get_running_loop().run_in_executor(None, producer.flush)
+    if spool:
+        # let failed deliveries reported by producer thread reach the spool
+        await asyncio.sleep(0)
+        spool.close()
+    log.info(f'publisher closed: {dict(stats)}')
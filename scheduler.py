@@ -0,0 +1,148 @@
+import asyncio
+from datetime import datetime, timedelta
+import inspect
+import logging
+import math
+import random
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Optional, Union
+from uuid import uuid4
+
+
+log = logging.getLogger('app.scheduler')
+
+# shared by jobs without keyword arguments
+NO_KWARGS = MappingProxyType({})
+
+
+class Job:
+    """Interval job, `next_run` and `end` are in event loop time"""
+    __slots__ = ('id', 'name', 'func', 'args', 'kwargs', 'interval', 'jitter', 'next_run', 'end', 'max_instances',
+                 'coalesce', 'running', 'handle')
+
+    def __init__(self, id: str, name: str, func: Callable, args: tuple, kwargs: Mapping, interval: float,
+                 jitter: Optional[float], next_run: float, end: Optional[float], max_instances: int, coalesce: bool):
+        self.id = id
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run = next_run
+        self.end = end
+        self.max_instances = max_instances
+        self.coalesce = coalesce
+        self.running = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+def to_datetime(value: Union[None, str, datetime]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class LoopScheduler:
+    """Lightweight replacement of AsyncIOScheduler for interval jobs.
+
+    Every job is a single timer in the heap of event loop, so there are no job store, locks and polling. Supports
+    subset of `add_job` arguments used by `sites_loader.schedule_sites`. `on_lateness` is called with delay of every
+    run after its planned time.
+    """
+
+    def __init__(self, event_loop: asyncio.AbstractEventLoop = None, on_lateness: Callable[[float], None] = None):
+        self.loop = event_loop or asyncio.get_event_loop()
+        self.on_lateness = on_lateness
+        self.jobs: Dict[str, Job] = {}
+        self.tasks = set()
+        self.running = False
+
+    def loop_time(self, dt: datetime) -> float:
+        return self.loop.time() + (dt - datetime.now(dt.tzinfo)).total_seconds()
+
+    def add_job(self, func: Callable, name: str = None, trigger: str = 'interval', id: str = None,
+                weeks: float = 0, days: float = 0, hours: float = 0, minutes: float = 0, seconds: float = 0,
+                start_date: Union[str, datetime] = None, end_date: Union[str, datetime] = None, timezone=None,
+                jitter: float = None, next_run_time: datetime = None, max_instances: int = 1, coalesce: bool = True,
+                args: tuple = None, kwargs: dict = None) -> Job:
+        if trigger != 'interval':
+            raise ValueError(f'unsupported trigger {trigger}')
+        interval = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds).total_seconds()
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+
+        now = self.loop.time()
+        start_date, end_date = to_datetime(start_date), to_datetime(end_date)
+        if next_run_time:
+            next_run = self.loop_time(next_run_time)
+        elif start_date:
+            next_run = self.loop_time(start_date)
+            if next_run < now:
+                next_run += math.ceil((now - next_run) / interval) * interval
+        else:
+            next_run = now + interval
+
+        job = Job(id=id or uuid4().hex, name=name or func.__name__, func=func, args=tuple(args or ()),
+                  kwargs=kwargs or NO_KWARGS, interval=interval, jitter=jitter, next_run=next_run,
+                  end=self.loop_time(end_date) if end_date else None,
+                  max_instances=max_instances, coalesce=coalesce)
+        self.jobs[job.id] = job
+        if self.running:
+            self.arm(job)
+        return job
+
+    def get_jobs(self) -> List[Job]:
+        return list(self.jobs.values())
+
+    def remove_job(self, job_id: str):
+        job = self.jobs.pop(job_id)
+        if job.handle:
+            job.handle.cancel()
+
+    def start(self):
+        self.running = True
+        for job in self.get_jobs():
+            self.arm(job)
+
+    def shutdown(self, wait: bool = False):
+        """Stop scheduling, running jobs are not interrupted"""
+        self.running = False
+        for job in self.jobs.values():
+            if job.handle:
+                job.handle.cancel()
+                job.handle = None
+
+    def arm(self, job: Job):
+        if job.end is not None and job.next_run > job.end:
+            log.debug(f'job {job.name} reached end date')
+            self.jobs.pop(job.id, None)
+            return
+        when = job.next_run + random.uniform(0, job.jitter) if job.jitter else job.next_run
+        job.handle = self.loop.call_at(when, self.fire, job)
+
+    def fire(self, job: Job):
+        if self.on_lateness:
+            self.on_lateness(max(0.0, self.loop.time() - job.handle.when()))
+        if job.running >= job.max_instances:
+            log.warning(f'skip run of job {job.name}: maximum number of running instances reached')
+        else:
+            job.running += 1
+            task = self.loop.create_task(self.run_job(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        job.next_run += job.interval
+        now = self.loop.time()
+        if job.coalesce and job.next_run < now:
+            # missed runs are coalesced into single one
+            job.next_run += math.ceil((now - job.next_run) / job.interval) * job.interval
+        self.arm(job)
+
+    async def run_job(self, job: Job):
+        try:
+            res = job.func(*job.args, **job.kwargs)
+            if inspect.isawaitable(res):
+                await res
+        except Exception:
+            log.exception(f'job {job.name} raised exception')
+        finally:
+            job.running -= 1
@@ -1,47 +1,453 @@
-from datetime import datetime
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
 import json
+import logging
+import os
 import re
-from typing import Callable
+import sys
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
 
 from aiohttp import BasicAuth, ClientTimeout
 from apscheduler.schedulers.base import BaseScheduler
 
+from checks import CheckSpec
+
+
+# define settings default values
+# sites files of SITES_STREAM_MIN_SIZE bytes and more are parsed incrementally by chunks of SITES_CHUNK_SIZE chars,
+# so text of file isn't held in memory with parsed sites; it's slower than parsing of the whole text
+SITES_STREAM_MIN_SIZE = 64 * 1024 * 1024
+SITES_CHUNK_SIZE = 1024 * 1024
+# sites path may be a directory of *.json files, they are read by SITES_LOAD_PROCESSES processes,
+# None - number of CPUs
+SITES_LOAD_PROCESSES = None
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.sites_loader')
+
+TRIGGER_FIELDS = ['weeks', 'days', 'hours', 'minutes', 'seconds', 'start_date', 'end_date', 'timezone', 'jitter']
+INTERVAL_FIELDS = ['weeks', 'days', 'hours', 'minutes', 'seconds']
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# top-level key of named templates, site or group refers to template by `template` field, template may extend another
+TEMPLATES_KEY = '$templates'
+
+
+class SitesError(ValueError):
+    """Invalid sites definitions, contains all found errors"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__(f'{len(errors)} errors in sites definitions:\n' + '\n'.join(errors))
+        self.errors = errors
+
+
+@lru_cache(maxsize=None)
+def client_timeout(total: float) -> ClientTimeout:
+    # ClientTimeout and BasicAuth are immutable, so equal settings of sites share the same object
+    return ClientTimeout(total=total)
+
+
+@lru_cache(maxsize=None)
+def basic_auth(*args: str) -> BasicAuth:
+    return BasicAuth(*args)
+
+
+@lru_cache(maxsize=None)
+def encode_data(data: str) -> bytes:
+    return data.encode('utf-8')
+
 
 def parse_check_settings(check: dict):
+    """Convert settings of site into request arguments, regexp is compiled lazily on the first check"""
     if 'status' not in check:
         check['status'] = 200
     timeout = check.get('timeout')
     if timeout:
-        check['timeout'] = ClientTimeout(total=timeout)
+        check['timeout'] = client_timeout(timeout)
     auth = check.get('auth')
     if auth and isinstance(auth, list):
-        check['auth'] = BasicAuth(*auth)
+        check['auth'] = basic_auth(*auth)
     data = check.get('data')
     if data and isinstance(data, str):
-        check['data'] = data.encode('utf-8')
+        check['data'] = encode_data(data)
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_site(check_name: str, site: Any, compile_regexps: bool = False) -> List[str]:
+    """Errors of site definition; regexps are only type checked unless `compile_regexps` is set, they are compiled
+    without cache of matcher then, so validation doesn't evict patterns of checks"""
+    if not isinstance(site, dict):
+        return [f'{check_name}: definition must be an object']
+    errors = []
+
+    def error(field: str, message: str):
+        errors.append(f'{check_name}.{field}: {message}')
+
+    url = site.get('url')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        error('url', 'http(s) url is required')
+    for field in ['method', 'data', 'topic_name']:
+        if field in site and not isinstance(site[field], str):
+            error(field, 'must be a string')
+    headers = site.get('headers')
+    if headers is not None and not (isinstance(headers, dict) and all(isinstance(v, str) for v in headers.values())):
+        error('headers', 'must be an object of strings')
+    auth = site.get('auth')
+    if auth is not None and not (isinstance(auth, list) and 1 <= len(auth) <= 3
+                                 and all(isinstance(v, str) for v in auth)):
+        error('auth', 'must be a list of login, password and optional encoding')
+    status = site.get('status')
+    if status is not None and not (isinstance(status, int) and not isinstance(status, bool)):
+        error('status', 'must be an integer or null')
+    for field in ['timeout', 'regexp_timeout', 'max_bytes', 'jitter']:
+        if site.get(field) is not None and not (is_number(site[field]) and site[field] > 0):
+            error(field, 'must be a positive number')
+    if 'conditional' in site and not isinstance(site['conditional'], bool):
+        error('conditional', 'must be a boolean')
+    for field in INTERVAL_FIELDS:
+        if field in site and not (is_number(site[field]) and site[field] >= 0):
+            error(field, 'must be a non-negative number')
+    if not any(is_number(site.get(field)) and site[field] > 0 for field in INTERVAL_FIELDS):
+        error('interval', f'one of {", ".join(INTERVAL_FIELDS)} must be set')
+    regexp = site.get('regexp')
+    if regexp is not None:
+        if not isinstance(regexp, str):
+            error('regexp', 'must be a string')
+        elif compile_regexps:
+            try:
+                re.compile(regexp)
+            except re.error as exc:
+                error('regexp', str(exc))
+    return errors
+
+
+def resolve_templates(templates: Any) -> Tuple[Dict[str, dict], List[str]]:
+    """Merge templates with templates they extend, returns resolved templates and errors"""
+    if not isinstance(templates, dict):
+        return {}, [f'{TEMPLATES_KEY}: must be an object of templates']
+    resolved, errors = {}, []
+
+    def resolve(name: str, chain: Tuple[str, ...]) -> Optional[dict]:
+        if name in resolved:
+            return resolved[name]
+        template = templates[name]
+        if not isinstance(template, dict):
+            errors.append(f'{TEMPLATES_KEY}.{name}: template must be an object')
+            return None
+        if name in chain:
+            errors.append(f'{TEMPLATES_KEY}.{name}: cyclic inheritance {" -> ".join(chain + (name, ))}')
+            return None
+        result = {}
+        parent = template.get('template')
+        if parent is not None:
+            if parent not in templates:
+                errors.append(f'{TEMPLATES_KEY}.{name}.template: unknown template {parent!r}')
+                return None
+            parent_template = resolve(parent, chain + (name, ))
+            if parent_template is None:
+                return None
+            result.update(parent_template)
+        result.update((k, v) for k, v in template.items() if k != 'template')
+        resolved[name] = result
+        return result
+
+    for name in templates:
+        resolve(name, ())
+    return resolved, errors
+
+
+def expand_sites(sites: Any) -> dict:
+    """Expand templates and groups into definitions of individual checks, raises SitesError.
+
+    Group is an entry with `urls` object of check names and urls, its other fields are shared by all its checks.
+    Values of templates and groups aren't copied, so expanded checks share them.
+    """
+    if not isinstance(sites, dict):
+        raise SitesError(['sites must be an object of check names'])
+    raw_templates = sites.get(TEMPLATES_KEY, {})
+    templates, errors = resolve_templates(raw_templates)
+    expanded = {}
+
+    def add(check_name: str, site: Any, group: str = None):
+        if check_name in expanded:
+            errors.append(f'{check_name}: defined again' + (f' in group {group}' if group else ''))
+        expanded[check_name] = site
+
+    for name, site in sites.items():
+        if name == TEMPLATES_KEY:
+            continue
+        if not isinstance(site, dict) or ('template' not in site and 'urls' not in site):
+            add(name, site)
+            continue
+        base = {}
+        if 'template' in site:
+            if site['template'] not in templates:
+                # errors of existing templates are already reported
+                if site['template'] not in raw_templates:
+                    errors.append(f'{name}.template: unknown template {site["template"]!r}')
+                continue
+            base = templates[site['template']]
+        own = {k: v for k, v in site.items() if k not in ('template', 'urls')}
+        if 'urls' not in site:
+            add(name, {**base, **own})
+            continue
+        urls = site['urls']
+        if not isinstance(urls, dict) or not urls:
+            errors.append(f'{name}.urls: must be an object of check names and urls')
+            continue
+        for check_name, url in urls.items():
+            add(check_name, {**base, **own, 'url': url}, group=name)
+
+    if errors:
+        raise SitesError(errors)
+    return expanded
+
+
+def validate_sites(sites: Any, compile_regexps: bool = False):
+    """Validate all sites, raises SitesError with all found errors"""
+    if not isinstance(sites, dict):
+        raise SitesError(['sites must be an object of check names'])
+    errors = []
+    for check_name, site in sites.items():
+        errors.extend(validate_site(check_name, site, compile_regexps=compile_regexps))
+    if errors:
+        raise SitesError(errors)
+
+
+def iter_json_object(f: TextIO, chunk_size: int = None) -> Iterator[Tuple[str, Any]]:
+    """Parse top-level JSON object incrementally, yields its items without reading the whole file into memory"""
+    chunk_size = chunk_size or SITES_CHUNK_SIZE
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def read() -> bool:
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+        return bool(chunk)
+
+    def next_char() -> str:
+        """Skip whitespace, returns next char or empty string at the end of file"""
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or not read():
+                return buf[pos:pos + 1]
+
+    def next_value() -> Any:
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # number at the end of buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read()
+
+    def expect(chars: str, context: str) -> str:
+        nonlocal pos
+        char = next_char()
+        if not char or char not in chars:
+            raise ValueError(f'expected {" or ".join(chars)} {context}, got {char or "end of file"!r}')
+        pos += 1
+        return char
+
+    expect('{', 'at the start of sites file')
+    if next_char() == '}':
+        return
+    key = None
+    while True:
+        if next_char() != '"':
+            raise ValueError(f'expected name of site after {key!r}')
+        key = next_value()
+        expect(':', f'after {key!r}')
+        next_char()
+        yield key, next_value()
+        if expect(',}', f'after site {key!r}') == '}':
+            return
+
+
+def read_sites_file(fn: str) -> dict:
+    """Read sites without parsing of settings, used for comparing of sites definitions"""
+    with open(fn, 'r', encoding='utf-8') as f:
+        if os.fstat(f.fileno()).st_size < SITES_STREAM_MIN_SIZE:
+            return json.load(f)
+        return dict(iter_json_object(f))
+
+
+def sites_files(path: str) -> List[str]:
+    """Sites file or sorted *.json files of sites directory"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json'))
+
+
+def sites_mtime(path: str) -> float:
+    """Modification time of sites file, the latest one of directory and its files for sites directory"""
+    return max([os.stat(path).st_mtime] + [os.stat(fn).st_mtime for fn in sites_files(path)])
+
+
+def read_sites(path: str, processes: int = None) -> dict:
+    """Read sites of file or directory without parsing of settings, files of directory are read in parallel.
+
+    Raises SitesError if the same check name is defined in several files.
+    """
+    files = sites_files(path)
+    processes = min(processes or SITES_LOAD_PROCESSES or os.cpu_count(), len(files))
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            parts = list(executor.map(read_sites_file, files))
+    else:
+        parts = [read_sites_file(fn) for fn in files]
+
+    sites, templates, errors = {}, {}, []
+    for fn, part in zip(files, parts):
+        # templates of all files are shared
+        part_templates = part.pop(TEMPLATES_KEY, {})
+        if isinstance(part_templates, dict):
+            errors.extend(f'{TEMPLATES_KEY}.{name}: defined again in {fn}' for name in part_templates
+                          if name in templates)
+            templates.update(part_templates)
+        else:
+            errors.append(f'{TEMPLATES_KEY}: must be an object of templates in {fn}')
+        errors.extend(f'{name}: defined again in {fn}' for name in part if name in sites)
+        sites.update(part)
+    if templates:
+        sites[TEMPLATES_KEY] = templates
+    if errors:
+        raise SitesError(errors)
+    return sites
+
+
+def load_sites(path: str, processes: int = None) -> dict:
+    """Read, expand and validate sites without parsing of settings"""
+    sites = expand_sites(read_sites(path, processes=processes))
+    validate_sites(sites)
+    return sites
 
 
 def parse_sites(data: str) -> dict:
-    sites = json.loads(data)
+    sites = expand_sites(json.loads(data))
+    validate_sites(sites)
     for site in sites.values():
         parse_check_settings(site)
     return sites
 
 
 def parse_sites_file(fn: str) -> dict:
-    data = open(fn, 'r', encoding='utf-8').read()
-    return parse_sites(data)
+    """Load sites of file or directory and parse their settings"""
+    sites = load_sites(fn)
+    for site in sites.values():
+        parse_check_settings(site)
+    return sites
+
 
+def get_interval(trigger_kwargs: dict) -> timedelta:
+    return timedelta(**{k: trigger_kwargs.get(k, 0) for k in INTERVAL_FIELDS})
 
-def schedule_sites(schedule: BaseScheduler, func: Callable, sites: dict):
-    trigger_fields = ['weeks', 'days', 'hours', 'minutes', 'seconds', 'start_date', 'end_date', 'timezone', 'jitter']
 
-    for check_name, data in sites.items():
-        trigger_kwargs = {k: data.pop(k) for k in trigger_fields if k in data}
+def schedule_sites(schedule: BaseScheduler, func: Callable, sites: dict, spread: bool = False):
+    """Add job per site; with `spread` first runs are spread evenly across interval instead of running all at once"""
+    now = datetime.now()
+    for i, (check_name, data) in enumerate(sites.items()):
+        trigger_kwargs = {k: data.pop(k) for k in TRIGGER_FIELDS if k in data}
+        next_run_time = now + get_interval(trigger_kwargs) * i / len(sites) if spread else now
         schedule.add_job(
-            func=func, name=check_name, trigger="interval", **trigger_kwargs,
-            next_run_time=datetime.now(), max_instances=1, coalesce=True, kwargs={
-                'check_name': check_name,
-                **data,
-                'regexp': re.compile(data.pop('regexp')) if data.get('regexp') else None,
-            })
+            func=func, id=check_name, name=check_name, trigger="interval", **trigger_kwargs,
+            next_run_time=next_run_time, max_instances=1, coalesce=True,
+            # spec is the only argument of job, so job doesn't keep dict of its arguments;
+            # pattern of regexp is compiled by cache of matcher on the first check
+            args=(CheckSpec.from_site(check_name, data),))
+
+
+def diff_sites(old: dict, new: dict) -> Tuple[List[str], List[str], List[str]]:
+    """Compare sites definitions by check_name, returns added, removed and changed names"""
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    changed = [name for name in new if name in old and new[name] != old[name]]
+    return added, removed, changed
+
+
+def reschedule_sites(schedule: BaseScheduler, func: Callable, old: dict, new: dict, spread: bool = False,
+                     on_unscheduled: Callable[[List[str]], None] = None) -> Tuple[List[str], List[str], List[str]]:
+    """Apply difference of not parsed sites definitions to scheduled jobs, unchanged jobs are kept as is.
+
+    `on_unscheduled` is called with names of removed and changed sites, e.g. to drop their cached state.
+    """
+    added, removed, changed = diff_sites(old, new)
+    for check_name in removed + changed:
+        try:
+            schedule.remove_job(check_name)
+        except KeyError:
+            # job has already finished by end_date
+            pass
+    if on_unscheduled and (removed or changed):
+        on_unscheduled(removed + changed)
+
+    # parsing replaces values of the top-level dict only, so values shared by templates aren't copied
+    sites = {name: dict(new[name]) for name in added + changed}
+    for site in sites.values():
+        parse_check_settings(site)
+    schedule_sites(schedule, func, sites, spread=spread)
+    return added, removed, changed
+
+
+async def watch_sites_file(fn: str, schedule: BaseScheduler, func: Callable, interval: float,
+                           site_filter: Callable[[str], bool] = None, spread: bool = False,
+                           on_unscheduled: Callable[[List[str]], None] = None):
+    """Poll modification time of sites file (or directory) and reschedule changed sites, invalid sites aren't applied.
+
+    Files are read and validated in a thread, so checks on event loop aren't blocked by reload of large sites files,
+    only changed sites are rescheduled on event loop. `site_filter` selects sites by check_name handled by this process,
+    `on_unscheduled` is passed to reschedule_sites.
+    """
+    def load() -> dict:
+        # forking of the process running event loop and producer isn't safe, so files are read sequentially
+        sites = load_sites(fn, processes=1)
+        return {name: site for name, site in sites.items() if not site_filter or site_filter(name)}
+
+    loop = asyncio.get_running_loop()
+    mtime = await loop.run_in_executor(None, sites_mtime, fn)
+    sites = await loop.run_in_executor(None, load)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            new_mtime = await loop.run_in_executor(None, sites_mtime, fn)
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+            new_sites = await loop.run_in_executor(None, load)
+        except (OSError, ValueError):
+            # file may be partially written, try on next poll
+            log.exception(f'failed to reload sites file {fn}')
+            continue
+
+        added, removed, changed = reschedule_sites(schedule, func, sites, new_sites, spread=spread,
+                                                   on_unscheduled=on_unscheduled)
+        sites = new_sites
+        log.info(f'sites file {fn} reloaded: {len(added)} added, {len(removed)} removed, {len(changed)} changed')
+
+
+if __name__ == '__main__':
+    # validate sites file or directory including regexps, e.g. before deploy
+    path = sys.argv[1] if len(sys.argv) > 1 else 'conf/sites.json'
+    try:
+        validate_sites(expand_sites(read_sites(path)), compile_regexps=True)
+    except SitesError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+    print(f'{path} is valid')
@@ -0,0 +1,185 @@
+from collections import Counter
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Iterator, List, Mapping, Optional, Tuple
+import zlib
+
+
+# define settings default values
+SPOOL_DIR = None                        # directory of spool, None - results aren't spooled to disk
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024    # new results are dropped when spool reaches this size
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.spool')
+
+FRAME_HEAD = struct.Struct('<II')   # length and crc32 of payload
+SEGMENT_SUFFIX = '.seg'
+POSITION_FILE = 'position'
+
+
+class Spool:
+    """Append-only queue of results on disk split into numbered segment files.
+
+    Records are appended to the last segment and read in order from the first one through memory mapping. Read
+    position is saved only on commit and fully read segments are removed, so records are read at least once.
+    """
+
+    def __init__(self, path: str, segment_size: int = None, max_bytes: int = None):
+        self.path = path
+        self.segment_size = segment_size or SPOOL_SEGMENT_SIZE
+        self.max_bytes = max_bytes or SPOOL_MAX_BYTES
+        self.counters = Counter()
+        os.makedirs(path, exist_ok=True)
+
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(path)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.bytes = sum(os.path.getsize(self.segment_path(seq)) for seq in self.segments)
+        self.position = self.load_position()
+        self.next_position = self.position
+        self.remove_read_segments()
+        self.records = sum(1 for _ in self.iter_records(self.position))
+        # tail of the last segment may be torn by crash, so appending is always started from the new segment
+        self.writer = None
+        self.writer_size = 0
+        if self.records:
+            log.warning(f'spool {path} has {self.records} records')
+
+    def segment_path(self, seq: int) -> str:
+        return os.path.join(self.path, f'{seq:012d}{SEGMENT_SUFFIX}')
+
+    def load_position(self) -> Tuple[int, int]:
+        first = self.segments[0] if self.segments else 0
+        try:
+            with open(os.path.join(self.path, POSITION_FILE)) as f:
+                seq, offset = map(int, f.read().split())
+        except (OSError, ValueError):
+            return first, 0
+        return (seq, offset) if seq >= first else (first, 0)
+
+    def save_position(self):
+        tmp_path = os.path.join(self.path, POSITION_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('%d %d' % self.position)
+        os.replace(tmp_path, os.path.join(self.path, POSITION_FILE))
+
+    def remove_read_segments(self):
+        while self.segments and self.segments[0] < self.position[0]:
+            seq = self.segments.pop(0)
+            self.bytes -= os.path.getsize(self.segment_path(seq))
+            os.remove(self.segment_path(seq))
+
+    def iter_frames(self, seq: int, offset: int) -> Iterator[Tuple[int, bytes]]:
+        """Yield payloads of segment with offsets after them, stop at truncated or corrupted frame"""
+        path = self.segment_path(seq)
+        size = os.path.getsize(path)
+        if offset >= size:
+            return
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while offset + FRAME_HEAD.size <= size:
+                length, crc = FRAME_HEAD.unpack_from(data, offset)
+                start = offset + FRAME_HEAD.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    log.error(f'corrupted record in spool segment {path} at {offset}, rest of segment is skipped')
+                    return
+                offset = start + length
+                yield offset, payload
+
+    def iter_records(self, position: Tuple[int, int]) -> Iterator[Tuple[Tuple[int, int], bytes]]:
+        """Yield payloads of all segments starting from `position` with positions after them"""
+        seq, offset = position
+        for segment in self.segments:
+            if segment < seq:
+                continue
+            for offset, payload in self.iter_frames(segment, offset if segment == seq else 0):
+                yield (segment, offset), payload
+
+    def append(self, topic_name: str, value: Mapping) -> bool:
+        """Append result to the last segment, returns False if result is dropped because spool is full"""
+        payload = json.dumps([topic_name, value if isinstance(value, dict) else dict(value)]).encode('utf-8')
+        frame = FRAME_HEAD.pack(len(payload), zlib.crc32(payload)) + payload
+        if self.bytes + len(frame) > self.max_bytes:
+            self.counters['dropped'] += 1
+            if self.counters['dropped'] == 1 or not self.counters['dropped'] % 1000:
+                log.error(f'spool {self.path} is full, {self.counters["dropped"]} results dropped')
+            return False
+
+        if self.writer is None or self.writer_size and self.writer_size + len(frame) > self.segment_size:
+            self.rotate()
+        self.writer.write(frame)
+        self.writer_size += len(frame)
+        self.bytes += len(frame)
+        self.records += 1
+        self.counters['spooled'] += 1
+        return True
+
+    def rotate(self):
+        if self.writer:
+            self.writer.close()
+        seq = self.segments[-1] + 1 if self.segments else self.position[0]
+        self.segments.append(seq)
+        self.writer = open(self.segment_path(seq), 'ab')
+        self.writer_size = 0
+
+    def read(self, max_records: int) -> List[Tuple[str, dict]]:
+        """Read up to `max_records` results from read position, position is moved by `commit`"""
+        if self.writer:
+            self.writer.flush()
+        items = []
+        self.next_position = self.position
+        if not self.records:
+            return items
+        for position, payload in self.iter_records(self.position):
+            items.append(tuple(json.loads(payload.decode('utf-8'))))
+            self.next_position = position
+            if len(items) >= max_records:
+                break
+        return items
+
+    def commit(self, count: int):
+        """Move read position after `count` results returned by the last `read` and remove fully read segments"""
+        self.records = max(0, self.records - count)
+        self.counters['drained'] += count
+        if not self.records:
+            # spool is empty, segments are removed and the next result starts the new one
+            self.close_writer()
+            self.position = (self.segments[-1] + 1 if self.segments else self.position[0], 0)
+        else:
+            self.position = self.next_position
+        self.remove_read_segments()
+        self.save_position()
+
+    def close_writer(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            self.writer_size = 0
+
+    def close(self):
+        self.close_writer()
+        self.save_position()
+        log.info(f'spool closed: {self.stats()}')
+
+    def stats(self) -> dict:
+        return {
+            'records': self.records,
+            'bytes': self.bytes,
+            'segments': len(self.segments),
+            **self.counters,
+        }
+
+
+def create_spool(path: str = None) -> Optional[Spool]:
+    """Create spool in `path` or SPOOL_DIR, None if spooling is disabled"""
+    path = path or SPOOL_DIR
+    return Spool(path) if path else None
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from pytest import mark, param, fixture
 
 import db
@@ -28,3 +30,91 @@ def test_append_record(record: dict, temp_conn):
     actual = get_record(temp_conn, record['id'])
     db.do_commit(temp_conn)
     assert actual == record
+
+
+@mark.parametrize("mode", ['values', 'copy'])
+def test_write_records(mode: str, temp_conn):
+    clear_db(temp_conn)
+    empty_sample = {**TEST_RECORD1, 'id': '0c8d9ad6-7f0e-4a1e-9d3c-4a2b8f1f6b11', 'sample': '', 'length': None}
+    records = [TEST_RECORD1, TEST_RECORD2, empty_sample]
+    db.write_records(temp_conn, records, mode=mode)
+    # duplicates are skipped
+    db.write_records(temp_conn, records, mode=mode)
+    db.do_commit(temp_conn)
+    actual = [get_record(temp_conn, rec['id']) for rec in records]
+    assert actual == records
+
+
+def test_rollups(temp_conn):
+    clear_db(temp_conn)
+    db.init_rollup_tables(temp_conn)
+    curr = temp_conn.cursor()
+    for granularity in db.ROLLUP_GRANULARITIES:
+        curr.execute(f'delete from {db.rollup_table(granularity)}')
+
+    records = [TEST_RECORD1, {**TEST_RECORD1, 'id': '5b0e2a3e-1c1f-4f4e-9a53-2b9f0f3c9a01', 'health': False,
+                              'duration': 0.3}]
+    for _ in range(2):
+        # records written twice are added into rollups once
+        inserted = db.write_records(temp_conn, records, returning=db.ROLLUP_FIELDS)
+        db.update_rollups(temp_conn, inserted)
+    db.do_commit(temp_conn)
+
+    stats = db.get_check_stats(temp_conn, TEST_RECORD1['check_name'], TEST_RECORD1['dt'],
+                               TEST_RECORD1['dt'] + timedelta(hours=1), percentiles=[1])
+    assert (stats['count'], stats['healthy'], stats['uptime']) == (2, 1, 0.5)
+    assert (stats['duration_min'], stats['duration_max'], stats['percentiles'][1]) == (0.1, 0.3, 0.3)
+
+
+def test_check_ids(temp_conn):
+    db.init_checks_table(temp_conn)
+    curr = temp_conn.cursor()
+    curr.execute('delete from public.checks')
+    db.do_commit(temp_conn)
+
+    ids = db.sync_checks(temp_conn, [{'name': 'test1', 'url': 'https://test1', 'config_hash': 'h1'}])
+    assert list(ids) == ['test1']
+    new_ids = db.get_check_ids(temp_conn, ['test1', 'test2'])
+    db.do_commit(temp_conn)
+    assert new_ids['test1'] == ids['test1']
+    assert new_ids['test2'] != ids['test1']
+
+
+def test_outages(temp_conn):
+    db.init_outages_table(temp_conn)
+    curr = temp_conn.cursor()
+    curr.execute('delete from public.outages')
+    start = TEST_RECORD1['dt']
+
+    db.start_outage(temp_conn, 'test1', start)
+    # outage started by redelivered result isn't duplicated
+    db.start_outage(temp_conn, 'test1', start)
+    db.end_outage(temp_conn, 'test1', start + timedelta(minutes=5))
+    db.start_outage(temp_conn, 'test1', start + timedelta(minutes=30))
+    # only one outage of check is open
+    db.start_outage(temp_conn, 'test1', start + timedelta(minutes=40))
+    # healthy result older than open outage doesn't end it
+    db.end_outages(temp_conn, [('test1', start + timedelta(minutes=20))])
+    db.do_commit(temp_conn)
+
+    outages = db.get_outages(temp_conn, 'test1', start, start + timedelta(hours=1))
+    assert [(o['started_at'], o['ended_at']) for o in outages] == [
+        (start, start + timedelta(minutes=5)),
+        (start + timedelta(minutes=30), None),
+    ]
+
+    db.end_outages(temp_conn, [('test1', start + timedelta(minutes=50)), ('test2', start)])
+    db.do_commit(temp_conn)
+    outages = db.get_outages(temp_conn, 'test1', start, start + timedelta(hours=1))
+    assert outages[-1]['ended_at'] == start + timedelta(minutes=50)
+
+
+def test_offsets(temp_conn):
+    db.init_offsets_table(temp_conn)
+    curr = temp_conn.cursor()
+    curr.execute('delete from public.writer_offsets')
+    db.save_offsets(temp_conn, {('topic', 0): 10, ('topic', 1): 5})
+    db.save_offsets(temp_conn, {('topic', 0): 12})
+    db.do_commit(temp_conn)
+
+    assert db.get_offsets(temp_conn, [('topic', 0), ('topic', 1), ('topic', 2)]) == {('topic', 0): 12, ('topic', 1): 5}
@@ -4,6 +4,7 @@ from unittest import mock
 
 import broker
 from broker import create_topic_if_not_exists
+from db_writer import decode_message
 from health_checker import start_checking
 
 
@@ -43,7 +44,7 @@ def convert_message(message: dict) -> dict:
     param(TEST_SITES, 200, 'aaa', timedelta(seconds=0.01), [
         {'check_name': 'test', 'health': True, 'length': 3, 'sample': None, 'status': 200}]),
 ])
-@mock.patch('aiohttp.request')
+@mock.patch('aiohttp.ClientSession.request')
 def test_start_checking(mock_request, temp_producer, temp_consumer, sites: dict, status, text, duration, expected):
     set_mock_request(mock_request, status, text=text)
 
@@ -51,5 +52,5 @@ def test_start_checking(mock_request, temp_producer, temp_consumer, sites: dict,
 
     batches = temp_consumer.poll(timeout_ms=BROKER_WAIT_TIMEOUT_MS).values()
     temp_consumer.commit()
-    actual = [convert_message(message.value) for batch in batches for message in batch]
+    actual = [convert_message(decode_message(message)) for batch in batches for message in batch]
     assert actual == expected
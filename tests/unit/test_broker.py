@@ -0,0 +1,92 @@
+from unittest import mock
+
+from pytest import mark, param
+
+import broker
+from broker import create_topic_if_not_exists, serialize, deserialize, message_headers
+
+
+@mark.parametrize("topics, partitions, num_partitions, expected_create, expected_increase", [
+    param([], None, 4, True, None, id='create'),
+    param(['test_topic'], [{}], 4, False, 4, id='increase'),
+    param(['test_topic'], [{}] * 4, 2, False, None, id='enough'),
+])
+def test_create_topic_if_not_exists(topics, partitions, num_partitions, expected_create, expected_increase):
+    admin = mock.Mock()
+    admin.list_topics.return_value = topics
+    admin.describe_topics.return_value = [{'topic': 'test_topic', 'partitions': partitions}]
+
+    create_topic_if_not_exists(admin, 'test_topic', num_partitions=num_partitions)
+
+    if expected_create:
+        new_topic, = admin.create_topics.call_args.kwargs['new_topics']
+        assert (new_topic.name, new_topic.num_partitions) == ('test_topic', num_partitions)
+        assert new_topic.replication_factor == broker.TOPIC_REPLICATION_FACTOR
+    else:
+        admin.create_topics.assert_not_called()
+
+    if expected_increase:
+        new_partitions = admin.create_partitions.call_args.args[0]['test_topic']
+        assert new_partitions.total_count == expected_increase
+    else:
+        admin.create_partitions.assert_not_called()
+
+
+TEST_MESSAGE1 = {
+    'id': 'd4a549fd-0907-4d64-92d6-bcc492d4f7ce',
+    'check_name': 'test1',
+    'dt': '2023-01-01T10:00:00.123456',
+    'health': True,
+    'status': 200,
+    'duration': 0.1,
+    'length': 300,
+    'sample': '170',
+}
+
+TEST_MESSAGE2 = {
+    'id': '3598c988-4cb3-4d34-a01a-237feab8228b',
+    'check_name': 'тест2',
+    'dt': '2023-01-01T11:00:00',
+    'health': False,
+    'status': None,
+    'duration': 3.0,
+    'length': None,
+    'sample': None,
+}
+
+
+@mark.parametrize("fmt", ['json', 'binary'])
+@mark.parametrize("message", [
+    param(TEST_MESSAGE1, id='full'),
+    param(TEST_MESSAGE2, id='empty-fields'),
+    param({**TEST_MESSAGE1, 'extra': {'a': 1}}, id='extra-fields'),
+    param({**TEST_MESSAGE1, 'dns': None, 'connect': 0.01, 'ttfb': 0.2, 'download': 0.05, 'regexp': None},
+          id='timings'),
+    param({**TEST_MESSAGE1, 'extra': {'a': 1}, 'dns': 0.001, 'connect': None, 'ttfb': 0.2, 'download': 0.05,
+           'regexp': 0.001}, id='extra-fields-timings'),
+])
+def test_serialize(fmt, message):
+    data = serialize(message, fmt)
+    assert deserialize(data, message_headers(fmt)) == message
+
+
+def test_binary_is_compact():
+    assert len(serialize(TEST_MESSAGE1, 'binary')) < len(serialize(TEST_MESSAGE1, 'json')) / 3
+
+
+def test_binary_timings_ignored_by_old_reader():
+    data = serialize({**TEST_MESSAGE1, 'dns': 0.001, 'connect': 0.01, 'ttfb': 0.2, 'download': 0.05}, 'binary')
+    # reader without timings support stops after known fields
+    with mock.patch('broker.FLAG_TIMINGS', 0):
+        assert deserialize(data, message_headers('binary')) == TEST_MESSAGE1
+
+
+def test_binary_timings_of_older_writer():
+    timings = {'dns': 0.001, 'connect': 0.01, 'ttfb': 0.2, 'download': 0.05}
+    data = serialize({**TEST_MESSAGE1, **timings, 'regexp': 0.001}, 'binary')
+    # writer knowing less timings packs less of them
+    assert deserialize(data[:-8], message_headers('binary')) == {**TEST_MESSAGE1, **timings}
+
+
+def test_deserialize_without_header():
+    assert deserialize(serialize(TEST_MESSAGE1, 'json'), []) == TEST_MESSAGE1
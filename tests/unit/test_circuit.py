@@ -0,0 +1,51 @@
+from unittest import mock
+
+from pytest import mark, param
+
+from circuit import CLOSED, OPEN, OPENED, Circuits
+
+
+def run_checks(circuits: Circuits, results: list, step: float = 10) -> list:
+    """Run checks every `step` seconds, checks skipped by circuit are None, others are events of their results"""
+    events = []
+    for i, failed in enumerate(results):
+        now = i * step
+        if not circuits.allow('test', now=now):
+            events.append(None)
+            continue
+        events.append(circuits.record('test', failed, now=now) or '')
+    return events
+
+
+@mark.parametrize("results, expected", [
+    param([False] * 4, [''] * 4, id='healthy'),
+    param([True, True, False, True, True], [''] * 5, id='intermittent'),
+    param([True] * 3 + [False] * 2, ['', '', OPENED, None, None], id='opened'),
+    param([True] * 3 + [True] * 3 + [False] * 4 + [False],
+          ['', '', OPENED, None, None, OPEN] + [None] * 4 + [CLOSED], id='backoff'),
+    param([True] * 3 + [False] * 3 + [True] * 3, ['', '', OPENED, None, None, CLOSED, '', '', OPENED],
+          id='recovered'),
+])
+def test_circuit(results, expected):
+    circuits = Circuits(failures=3, backoff=30, factor=2, max_backoff=50)
+    assert run_checks(circuits, results) == expected
+
+
+def test_max_backoff():
+    circuits = Circuits(failures=1, backoff=30, factor=2, max_backoff=50)
+    assert circuits.record('test', True, now=0) == OPENED
+    assert circuits.circuits['test'].next_probe == 30
+    assert circuits.record('test', True, now=30) == OPEN
+    assert circuits.circuits['test'].next_probe == 80
+    assert circuits.open_count() == 1
+    assert circuits.record('test', False, now=80) == CLOSED
+    assert circuits.circuits == {} and circuits.open_count() == 0
+
+
+def test_failed_since():
+    circuits = Circuits(failures=2, backoff=30, factor=2, max_backoff=50)
+    assert circuits.record('test', True, now=0, dt=mock.sentinel.dt1) is None
+    assert circuits.record('test', True, now=10, dt=mock.sentinel.dt2) == OPENED
+    assert circuits.failed_since('test') == mock.sentinel.dt1
+    circuits.discard(['test', 'unknown'])
+    assert circuits.failed_since('test') is None and circuits.allow('test', now=20)
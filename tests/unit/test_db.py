@@ -0,0 +1,180 @@
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import psycopg2
+import pytest
+from pytest import mark, param
+
+import db
+from db import (copy_value, create_partitions, drop_old_partitions, parse_partition_bound, partition_name,
+                partition_start, aggregate_rollups, histogram_percentile)
+
+
+@mark.parametrize("value, expected", [
+    param(None, '\\N', id='null'),
+    param(True, 't', id='bool'),
+    param(0.5, '0.5', id='float'),
+    param('', '', id='empty'),
+    param(datetime(2023, 1, 1, 10), '2023-01-01 10:00:00', id='datetime'),
+    param('a\tb\nc\\d', 'a\\tb\\nc\\\\d', id='escaped'),
+])
+def test_copy_value(value, expected):
+    assert copy_value(value) == expected
+
+
+@mark.parametrize("day, partition_by, expected", [
+    param(date(2023, 1, 4), 'day', date(2023, 1, 4), id='day'),
+    param(date(2023, 1, 4), 'week', date(2023, 1, 2), id='week'),
+    param(date(2023, 1, 2), 'week', date(2023, 1, 2), id='monday'),
+])
+def test_partition_start(day, partition_by, expected):
+    assert partition_start(day, partition_by) == expected
+
+
+@mark.parametrize("expr, expected", [
+    param("FOR VALUES FROM ('2023-01-01 00:00:00') TO ('2023-01-02 00:00:00')", datetime(2023, 1, 2), id='range'),
+    param("DEFAULT", None, id='default'),
+])
+def test_parse_partition_bound(expr, expected):
+    assert parse_partition_bound(expr) == expected
+
+
+@mock.patch('db.list_partitions')
+def test_drop_old_partitions(mock_list_partitions):
+    today = date.today()
+    mock_list_partitions.return_value = [
+        {'name': partition_name(today - timedelta(days=40)),
+         'bound': f"FOR VALUES FROM ('{today - timedelta(days=40)}') TO ('{today - timedelta(days=39)}')"},
+        {'name': partition_name(today),
+         'bound': f"FOR VALUES FROM ('{today}') TO ('{today + timedelta(days=1)}')"},
+        {'name': 'health_checks_default', 'bound': 'DEFAULT'},
+    ]
+    conn = mock.Mock()
+    drop_old_partitions(conn, retention_days=30, detach=False)
+    conn.cursor.return_value.execute.assert_called_once_with(
+        f'DROP TABLE public.{partition_name(today - timedelta(days=40))}')
+
+
+@mock.patch('db.PARTITION_BY', 'day')
+@mock.patch('db.create_partition')
+@mock.patch('db.list_partitions')
+def test_create_partitions(mock_list_partitions, mock_create_partition):
+    today = date(2023, 1, 10)
+    mock_list_partitions.return_value = [
+        {'name': partition_name(today), 'bound': f"FOR VALUES FROM ('{today}') TO ('{today + timedelta(days=1)}')"},
+        {'name': 'health_checks_default', 'bound': 'DEFAULT'},
+    ]
+    conn = mock.Mock()
+    # old rows of default partition get their partition, so retention is applied to them
+    conn.cursor.return_value.fetchall.return_value = [{'day': date(2022, 12, 1)}]
+    create_partitions(conn, day=today, count=1)
+    assert mock_create_partition.call_args_list == [
+        mock.call(conn, date(2022, 12, 1), date(2022, 12, 2), default='health_checks_default'),
+        mock.call(conn, date(2023, 1, 11), date(2023, 1, 12), default='health_checks_default'),
+    ]
+
+
+def test_create_partition_failed():
+    conn = mock.Mock()
+    # rows are routed to default partition while they are moved
+    conn.cursor.return_value.execute.side_effect = [None, None, psycopg2.Error('constraint is violated'), None]
+    db.create_partition(conn, date(2023, 1, 10), date(2023, 1, 11), default='health_checks_default')
+    assert conn.cursor.return_value.execute.call_args == mock.call('ROLLBACK TO SAVEPOINT create_partition')
+
+
+@mark.parametrize("partitioned, expected_calls", [
+    param(True, 1, id='partitioned'),
+    param(False, 0, id='not-partitioned'),
+])
+@mock.patch('db.drop_old_partitions')
+@mock.patch('db.create_partitions')
+def test_maintain_partitions(mock_create_partitions, mock_drop_old_partitions, partitioned, expected_calls):
+    conn = mock.Mock()
+    conn.cursor.return_value.fetchone.return_value = {'partitioned': partitioned}
+    db.maintain_partitions(conn)
+    assert mock_create_partitions.call_count == mock_drop_old_partitions.call_count == expected_calls
+    conn.commit.assert_called_once()
+
+
+@mark.parametrize("timing_columns, expected", [
+    param(False, 'id, check_name, dt, health, status, duration, length, sample', id='default'),
+    param(True, 'id, check_name, dt, health, status, duration, length, sample, dns, connect, ttfb, download, regexp',
+          id='timings'),
+    param(False, 'id, check_id, dt, health, status, duration, length, sample', id='check-ids'),
+])
+def test_append_record_columns(timing_columns, expected):
+    conn = mock.Mock()
+    with mock.patch('db.TIMING_COLUMNS', timing_columns), mock.patch('db.CHECK_IDS', 'check_id' in expected):
+        db.append_record(conn, {'id': 'id1', 'check_name': 'test1', 'health': True})
+    sql = conn.cursor.return_value.execute.call_args.args[0]
+    assert f'health_checks({expected})' in sql
+
+
+@mark.parametrize("check_ids, columns, expected", [
+    param(False, [], False, id='no-table'),
+    param(False, db.FIELDS, True, id='names'),
+    param(True, db.ID_FIELDS, True, id='ids'),
+    param(True, db.FIELDS, RuntimeError, id='ids-on-names'),
+    param(False, db.ID_FIELDS, RuntimeError, id='names-on-ids'),
+])
+def test_check_table_exists(check_ids, columns, expected):
+    conn = mock.Mock()
+    conn.cursor.return_value.fetchall.return_value = [{'column_name': column} for column in columns]
+    with mock.patch('db.CHECK_IDS', check_ids):
+        if expected is RuntimeError:
+            with pytest.raises(RuntimeError, match='CHECK_IDS is applied only when table is created'):
+                db.check_table_exists(conn)
+        else:
+            assert db.check_table_exists(conn) is expected
+
+
+def test_create_named_view():
+    conn = mock.Mock()
+    with mock.patch('db.CHECK_IDS', True), mock.patch('db.TIMING_COLUMNS', False):
+        db.create_named_view(conn)
+    sql = conn.cursor.return_value.execute.call_args.args[0]
+    assert 'select h.id, c.name as check_name, h.dt, h.health, h.status, h.duration, h.length, h.sample' in sql
+
+
+TEST_ROLLUP_RECORDS = [
+    {'check_name': 'test1', 'dt': datetime(2023, 1, 1, 10, 0, 10), 'health': True, 'duration': 0.2},
+    {'check_name': 'test1', 'dt': datetime(2023, 1, 1, 10, 0, 50), 'health': False, 'duration': None},
+    {'check_name': 'test1', 'dt': datetime(2023, 1, 1, 10, 1, 10), 'health': True, 'duration': 0.03},
+    {'check_name': 'test0', 'dt': datetime(2023, 1, 1, 10, 30, 0), 'health': True, 'duration': 20},
+]
+
+
+def histogram(*buckets):
+    res = [0] * (len(db.HISTOGRAM_BOUNDS) + 1)
+    for bucket in buckets:
+        res[bucket] += 1
+    return res
+
+
+@mark.parametrize("granularity, expected", [
+    param('minute', [
+        ('test0', datetime(2023, 1, 1, 10, 30), 1, 1, 1, 20, 20, 20, histogram(11)),
+        ('test1', datetime(2023, 1, 1, 10, 0), 2, 1, 1, 0.2, 0.2, 0.2, histogram(5)),
+        ('test1', datetime(2023, 1, 1, 10, 1), 1, 1, 1, 0.03, 0.03, 0.03, histogram(3)),
+    ], id='minute'),
+    param('hour', [
+        ('test0', datetime(2023, 1, 1, 10), 1, 1, 1, 20, 20, 20, histogram(11)),
+        ('test1', datetime(2023, 1, 1, 10), 3, 2, 2, 0.2 + 0.03, 0.03, 0.2, histogram(3, 5)),
+    ], id='hour'),
+])
+def test_aggregate_rollups(granularity, expected):
+    rollups = aggregate_rollups(TEST_ROLLUP_RECORDS, granularity)
+    actual = [tuple(rollup[k] for k in db.ROLLUP_COLUMNS) for rollup in rollups]
+    assert actual == expected
+
+
+@mark.parametrize("hist, q, duration_min, duration_max, expected", [
+    param(histogram(*[5] * 10), 0.5, 0.1, 0.25, 0.175, id='single-bucket'),
+    param(histogram(3, 5), 0.5, 0.03, 0.2, 0.05, id='lower-bucket'),
+    param(histogram(3, 5), 1, 0.03, 0.2, 0.2, id='max'),
+    param(histogram(*[11] * 4), 0.5, 10, 20, 15, id='unbounded-bucket'),
+    param(histogram(), 0.5, None, None, None, id='empty'),
+])
+def test_histogram_percentile(hist, q, duration_min, duration_max, expected):
+    actual = histogram_percentile(hist, q, duration_min, duration_max)
+    assert actual == (expected if expected is None else pytest.approx(expected))
@@ -1,9 +1,17 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest import mock
 
+from collections import deque
+from concurrent.futures import Future
+
+from kafka.structs import TopicPartition
+import pytest
 from pytest import mark, param
 
-from db_writer import parse_message
+import broker
+import db_writer
+from db_writer import (parse_message, poll_records, write_once, commit_written, write_pipelined, split_transitions,
+                       outage_events)
 
 
 TEST_RECORD1 = {
@@ -64,3 +72,363 @@ def test_parse_message(record, expected):
     message.value = record
     actual = parse_message(message)
     assert actual == expected
+
+
+def mock_message(record, offset=0, headers=None):
+    message = mock.Mock()
+    message.partition = 0
+    message.offset = offset
+    message.value = record
+    message.headers = headers or []
+    return message
+
+
+@mark.parametrize("fmt", ['json', 'binary'])
+def test_parse_serialized_message(fmt):
+    value = {**TEST_RECORD1, 'dt': TEST_RECORD1['dt'].isoformat(), 'status': 200}
+    message = mock_message(broker.serialize(value, fmt), headers=broker.message_headers(fmt))
+    assert parse_message(message) == value
+
+
+def test_parse_bad_serialized_message():
+    message = mock_message(b'\x00\x01', headers=broker.message_headers('binary'))
+    assert parse_message(message) is None
+
+
+def mock_consumer():
+    consumer = mock.Mock()
+    consumer.highwater.return_value = None
+    return consumer
+
+
+@mock.patch('db_writer.db')
+def test_write_once(mock_db):
+    mock_db.ROLLUPS = False
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    consumer = mock_consumer()
+    consumer.poll.return_value = {
+        'tp0': [mock_message(TEST_RECORD1, 1), mock_message(TEST_BAD_RECORD, 2)],
+        'tp1': [mock_message(TEST_RECORD2, 3)],
+    }
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    mock_db.write_records.assert_called_once_with(
+        conn, [TEST_RECORD1, TEST_RECORD2], mode=db_writer.WRITE_MODE, page_size=db_writer.WRITE_BATCH_SIZE,
+        copy_min_rows=db_writer.WRITE_COPY_MIN_ROWS, returning=None)
+    mock_db.do_commit.assert_called_once_with(conn)
+    consumer.commit.assert_called_once()
+
+
+def done_future(exc=None):
+    future = Future()
+    if exc:
+        future.set_exception(exc)
+    else:
+        future.set_result(None)
+    return future
+
+
+def committed_offsets(consumer):
+    return [{tp: o.offset for tp, o in c.kwargs['offsets'].items()} for c in consumer.commit.call_args_list]
+
+
+def test_commit_written():
+    consumer = mock.Mock()
+    pending = deque([(done_future(), {'tp0': 5}), (done_future(), {'tp0': 7, 'tp1': 2}), (Future(), {'tp0': 9})])
+    commit_written(consumer, pending)
+    assert committed_offsets(consumer) == [{'tp0': 7, 'tp1': 2}]
+    assert len(pending) == 1
+
+
+def test_commit_written_failed():
+    consumer = mock.Mock()
+    pending = deque([(done_future(), {'tp0': 5}), (done_future(ValueError()), {'tp0': 7}), (done_future(), {'tp0': 9})])
+    with pytest.raises(ValueError):
+        commit_written(consumer, pending)
+    # offsets of batches after failed one aren't committed
+    assert committed_offsets(consumer) == [{'tp0': 5}]
+    assert not pending
+
+
+class StopWriter(Exception):
+    pass
+
+
+@mock.patch('db_writer.db')
+def test_write_pipelined(mock_db):
+    mock_db.ROLLUPS = False
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    consumer = mock_consumer()
+    consumer.poll.side_effect = [
+        {'tp0': [mock_message(TEST_RECORD1, 1)]},
+        {},
+        {'tp0': [mock_message(TEST_RECORD2, 2)], 'tp1': [mock_message(TEST_BAD_RECORD, 7)]},
+        StopWriter(),
+    ]
+    conns = [mock.Mock(), mock.Mock()]
+
+    with pytest.raises(StopWriter):
+        write_pipelined(consumer, conns, maintenance=False)
+
+    written = [c.args[1] for c in mock_db.write_records.call_args_list]
+    assert sorted(rec['id'] for recs in written for rec in recs) == sorted([TEST_RECORD1['id'], TEST_RECORD2['id']])
+    assert mock_db.do_commit.call_count == 2
+    offsets = {}
+    for batch_offsets in committed_offsets(consumer):
+        offsets.update(batch_offsets)
+    assert offsets == {'tp0': 3, 'tp1': 8}
+
+
+@mock.patch('db_writer.db')
+def test_write_once_rollups(mock_db):
+    mock_db.ROLLUPS = True
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    mock_db.write_records.return_value = [mock.sentinel.inserted]
+    consumer = mock_consumer()
+    consumer.poll.return_value = {'tp0': [mock_message(TEST_RECORD1, 1)]}
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    assert mock_db.write_records.call_args.kwargs['returning'] == mock_db.ROLLUP_FIELDS
+    mock_db.update_rollups.assert_called_once_with(conn, [mock.sentinel.inserted])
+
+
+@mock.patch.dict('db_writer.check_names', clear=True)
+@mock.patch.dict('db_writer.check_ids', {'test1': 1}, clear=True)
+@mock.patch('db_writer.db')
+def test_write_once_check_ids(mock_db):
+    mock_db.ROLLUPS = True
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = True
+    mock_db.OUTAGES = False
+    mock_db.get_check_ids.return_value = {'test2': 2}
+    mock_db.write_records.return_value = [{'check_id': 2, 'dt': TEST_RECORD2['dt'], 'health': False, 'duration': 1}]
+    consumer = mock_consumer()
+    consumer.poll.return_value = {'tp0': [mock_message(TEST_RECORD1, 1), mock_message(TEST_RECORD2, 2)]}
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    # only unknown names are resolved by db
+    mock_db.get_check_ids.assert_called_once_with(conn, {'test2'})
+    recs = mock_db.write_records.call_args.args[1]
+    assert [rec['check_id'] for rec in recs] == [1, 2]
+    assert mock_db.write_records.call_args.kwargs['returning'] == mock_db.ROLLUP_ID_FIELDS
+    assert mock_db.update_rollups.call_args.args[1][0]['check_name'] == 'test2'
+
+
+def transition_record(minutes: int, health: bool = True, status='200', sample='170') -> dict:
+    return {**TEST_RECORD1, 'dt': (TEST_RECORD1['dt'] + timedelta(minutes=minutes)).isoformat(), 'health': health,
+            'status': status, 'sample': sample}
+
+
+@mark.parametrize("last, recs, expected", [
+    param(None, [transition_record(0)], [0], id='unknown'),
+    param(((True, '200', '170'), TEST_RECORD1['dt']), [transition_record(1, status=200)], [], id='same-state'),
+    param(((True, '200', '170'), TEST_RECORD1['dt']),
+          [transition_record(1, health=False, status=500), transition_record(2, health=False, status=500),
+           transition_record(3)], [0, 2], id='outage'),
+    param(((True, '200', '170'), TEST_RECORD1['dt']), [transition_record(1, sample='171')], [0], id='sample'),
+    param(((True, '200', '170'), TEST_RECORD1['dt']), [transition_record(4), transition_record(6)], [1],
+          id='sampled'),
+    # late record (e.g. drained from spool) doesn't hide recovery after newer outage
+    param(((True, '200', '170'), TEST_RECORD1['dt']),
+          [transition_record(10, health=False, status=None, sample=None), transition_record(5), transition_record(15)],
+          [0, 1, 2], id='out-of-order'),
+    # changes of late records are written, but they don't change the last state
+    param(((True, '200', '170'), TEST_RECORD1['dt'] + timedelta(minutes=10)),
+          [transition_record(1, health=False, status=None, sample=None),
+           transition_record(2, health=False, status=None, sample=None), transition_record(3), transition_record(11)],
+          [0, 2], id='late'),
+])
+def test_split_transitions(last, recs, expected):
+    states = {TEST_RECORD1['check_name']: last} if last else {}
+    with mock.patch.dict('db_writer.last_states', states, clear=True):
+        written, skipped = split_transitions(recs, sample_interval=300)
+    assert written == [recs[i] for i in expected]
+    assert len(skipped) == len(recs) - len(expected)
+
+
+@mock.patch.dict('db_writer.last_states', clear=True)
+@mock.patch('db_writer.WRITE_TRANSITIONS', True)
+@mock.patch('db_writer.db')
+def test_write_once_transitions(mock_db):
+    mock_db.ROLLUPS = True
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    mock_db.write_records.return_value = [mock.sentinel.inserted]
+    mock_db.get_offsets.return_value = {}
+    consumer = mock_consumer()
+    next_record = {**TEST_RECORD1, 'id': 'next', 'dt': TEST_RECORD1['dt'] + timedelta(minutes=1)}
+    consumer.poll.return_value = {'tp0': [mock_message(TEST_RECORD1, 1), mock_message(next_record, 2)]}
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    assert mock_db.write_records.call_args.args[1] == [TEST_RECORD1]
+    # skipped record is still added into rollups
+    rollup_recs = mock_db.update_rollups.call_args.args[1]
+    assert rollup_recs[0] == mock.sentinel.inserted and rollup_recs[1]['id'] == 'next'
+    # offsets are saved in the same transaction
+    mock_db.save_offsets.assert_called_once_with(conn, {'tp0': 3})
+    consumer.commit.assert_called_once()
+
+
+@mock.patch.dict('db_writer.last_states', clear=True)
+@mock.patch('db_writer.WRITE_TRANSITIONS', True)
+@mock.patch('db_writer.db')
+def test_write_once_redelivered(mock_db):
+    mock_db.ROLLUPS = True
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    mock_db.write_records.return_value = []
+    # the first message was written before restart, but its offset wasn't committed to kafka
+    mock_db.get_offsets.return_value = {('topic', 0): 2}
+    tp = TopicPartition('topic', 0)
+    consumer = mock_consumer()
+    consumer.poll.return_value = {tp: [mock_message(TEST_RECORD1, 1), mock_message(TEST_RECORD2, 2)]}
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    mock_db.get_offsets.assert_called_once_with(conn, [tp])
+    assert mock_db.write_records.call_args.args[1] == [TEST_RECORD2]
+    mock_db.save_offsets.assert_called_once_with(conn, {tp: 3})
+
+
+@mock.patch.dict('db_writer.last_states', clear=True)
+@mock.patch('db_writer.WRITE_TRANSITIONS', True)
+@mock.patch('db_writer.db')
+def test_write_once_outages(mock_db):
+    mock_db.ROLLUPS = False
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = True
+    mock_db.get_offsets.return_value = {}
+    failed = {**TEST_RECORD1, 'health': False, 'status': None, 'sample': None}
+    recs = [
+        failed,
+        {**failed, 'dt': failed['dt'] + timedelta(seconds=10), 'circuit': 'opened', 'failed_since': failed['dt']},
+        # healthy result of check which wasn't probed ends outage too
+        {**TEST_RECORD1, 'dt': failed['dt'] + timedelta(seconds=70)},
+    ]
+    consumer = mock_consumer()
+    consumer.poll.return_value = {'tp0': [mock_message(rec, i) for i, rec in enumerate(recs)]}
+    conn = mock.sentinel.conn
+
+    write_once(consumer, conn)
+
+    # record which opened circuit is skipped in transitions mode, but outage is still started (at the first failure)
+    # before its end
+    assert mock_db.write_records.call_args.args[1] == [recs[0], recs[2]]
+    assert [c for c in mock_db.method_calls if c[0] in ('start_outage', 'end_outage')] == [
+        mock.call.start_outage(conn, 'test1', failed['dt']),
+        mock.call.end_outage(conn, 'test1', recs[2]['dt']),
+    ]
+
+
+def outage_record(minutes: int, health: bool = True, check_name: str = 'test1', **fields) -> dict:
+    return {'check_name': check_name, 'dt': TEST_RECORD1['dt'] + timedelta(minutes=minutes), 'health': health,
+            **fields}
+
+
+def outage_dt(minutes: int) -> datetime:
+    return TEST_RECORD1['dt'] + timedelta(minutes=minutes)
+
+
+@mark.parametrize("recs, expected", [
+    param([outage_record(0), outage_record(1, check_name='test2'), outage_record(2)],
+          ([('test1', outage_dt(0)), ('test2', outage_dt(1))], []), id='ends'),
+    param([outage_record(1, False, circuit='opened', failed_since=outage_dt(0)),
+           outage_record(2, False, circuit='open'), outage_record(3), outage_record(4)],
+          ([], [('opened', 'test1', outage_dt(0)), ('closed', 'test1', outage_dt(3))]), id='outage'),
+    param([outage_record(3), outage_record(1, False, circuit='opened'), outage_record(0)],
+          ([('test1', outage_dt(0))], [('opened', 'test1', outage_dt(1)), ('closed', 'test1', outage_dt(3))]),
+          id='out-of-order'),
+    param([outage_record(0, False), outage_record(1, False, circuit='opened'), outage_record(2, False, circuit='open')],
+          ([], [('opened', 'test1', outage_dt(1))]), id='open'),
+])
+def test_outage_events(recs, expected):
+    assert outage_events(recs) == expected
+
+
+@mock.patch('db_writer.db')
+def test_write_pipelined_outages(mock_db):
+    mock_db.ROLLUPS = False
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = True
+    consumer = mock_consumer()
+    consumer.poll.side_effect = [
+        {'tp0': [mock_message({**TEST_RECORD1, 'health': False, 'circuit': 'opened'}, 1)]},
+        {'tp0': [mock_message({**TEST_RECORD1, 'dt': TEST_RECORD1['dt'] + timedelta(minutes=1)}, 2)]},
+        StopWriter(),
+    ]
+    conns = [mock.Mock(), mock.Mock()]
+    ordered_conn = mock.Mock()
+
+    with pytest.raises(StopWriter):
+        write_pipelined(consumer, conns, maintenance=False, ordered_conn=ordered_conn)
+
+    # outages aren't recorded by writing threads, but by own connection in order of batches
+    outage_calls = [c for c in mock_db.method_calls if c[0] in ('start_outage', 'end_outages', 'end_outage')]
+    assert outage_calls == [
+        mock.call.start_outage(ordered_conn, 'test1', TEST_RECORD1['dt']),
+        mock.call.end_outages(ordered_conn, [('test1', TEST_RECORD1['dt'] + timedelta(minutes=1))]),
+    ]
+    mock_db.do_commit.assert_any_call(ordered_conn)
+
+
+@mock.patch.dict('db_writer.last_states', clear=True)
+@mock.patch('db_writer.WRITE_TRANSITIONS', True)
+@mock.patch('db_writer.db')
+def test_write_pipelined_transitions(mock_db):
+    mock_db.ROLLUPS = True
+    mock_db.TIMING_COLUMNS = False
+    mock_db.CHECK_IDS = False
+    mock_db.OUTAGES = False
+    mock_db.write_records.return_value = []
+    mock_db.get_offsets.return_value = {}
+    consumer = mock_consumer()
+    consumer.poll.side_effect = [
+        {'tp0': [mock_message(TEST_RECORD1, 1),
+                 mock_message({**TEST_RECORD1, 'id': 'next', 'dt': TEST_RECORD1['dt'] + timedelta(minutes=1)}, 2)]},
+        StopWriter(),
+    ]
+    conns = [mock.Mock()]
+    ordered_conn = mock.Mock()
+
+    with pytest.raises(StopWriter):
+        write_pipelined(consumer, conns, maintenance=False, ordered_conn=ordered_conn)
+
+    mock_db.get_offsets.assert_called_once_with(ordered_conn, ['tp0'])
+    # skipped record is added into rollups with offsets of its batch by ordered connection only
+    mock_db.update_rollups.assert_called_once()
+    assert mock_db.update_rollups.call_args.args[0] is ordered_conn
+    assert [rec['id'] for rec in mock_db.update_rollups.call_args.args[1]] == ['next']
+    mock_db.save_offsets.assert_called_once_with(ordered_conn, {'tp0': 3})
+
+
+def test_consumer_lag():
+    consumer = mock.Mock()
+    consumer.highwater.side_effect = lambda tp: {0: 10, 1: None}[tp.partition]
+    consumer.poll.return_value = {
+        TopicPartition('topic', 0): [mock_message(TEST_RECORD1, 6)],
+        TopicPartition('topic', 1): [mock_message(TEST_RECORD2, 3)],
+    }
+
+    poll_records(consumer)
+
+    assert db_writer.CONSUMER_LAG.values[(('partition', '0'), ('topic', 'topic'))] == 3
+    assert (('partition', '1'), ('topic', 'topic')) not in db_writer.CONSUMER_LAG.values
@@ -1,4 +1,6 @@
 import asyncio
+import re
+import time
 from datetime import datetime, timedelta
 from unittest import mock
 from uuid import UUID
@@ -8,7 +10,13 @@ import pytest
 from pytest import mark, param
 
 import broker
-from health_checker import check_resp, do_check, check_website
+from checks import CheckResult, CheckSpec
+from circuit import OPENED, Circuits
+import health_checker
+from limiter import Limiter
+import metrics
+from health_checker import (check_resp, do_check, check_website, create_session, read_stream, shard_sites, shard_of,
+                            run_workers, observe_limiter)
 
 
 def mock_resp(content, status_code=200, text=None, elapsed=timedelta(seconds=0.01)):
@@ -27,6 +35,13 @@ def mock_producer():
     return res
 
 
+@pytest.fixture()
+def mock_session():
+    return mock.MagicMock()
+
+
+MOCK_SESSION = mock.sentinel.session
+
 TEST_RESP1 = (200, 'aaa')
 TEST_RESP2 = (201, 'pp23ss')
 TEST_RESP3 = (500, 'internal server error')
@@ -45,13 +60,23 @@ TEST_RESP3 = (500, 'internal server error')
 ])
 def test_check_response(check_name: str, req_id: str, req_dt: datetime, status: int, regexp: str,
                         res_status: int, res_text: str, expected: dict):
-    actual = check_resp(check_name=check_name, req_id=req_id, req_dt=req_dt,
-                        res_status=res_status, res_text=res_text, exp_status=status, regexp=regexp)
+    actual = dict(check_resp(check_name=check_name, req_id=req_id, req_dt=req_dt,
+                             res_status=res_status, res_text=res_text, exp_status=status, regexp=regexp))
     expected.pop('duration')
     actual.pop('duration')
     assert actual == expected
 
 
+def test_record_phase():
+    ctx = mock.Mock(trace_request_ctx={'dns': 0.5, 'ttfb': 0.5})
+    start = time.perf_counter() - 0.1
+    health_checker.record_phase(ctx, 'dns', start)
+    health_checker.record_phase(ctx, 'ttfb', start, accumulate=False)
+    # dns is summed across redirects, ttfb is of the last response
+    assert 0.6 <= ctx.trace_request_ctx['dns'] < 1
+    assert 0.1 <= ctx.trace_request_ctx['ttfb'] < 0.5
+
+
 def set_mock_request(mock_obj, status, text):
     mock_obj.return_value.__aenter__.return_value.status = status
 
@@ -72,53 +97,273 @@ def set_mock_request(mock_obj, status, text):
           (('GET', 'http://localhost'), {'timeout': ClientTimeout(3)}),
           {'check_name': 'test3', 'health': False, 'status': 500, 'duration': 0.5, 'length': 21, 'sample': None}),
 ])
-@mock.patch('aiohttp.request')
-def test_do_check(mock_request, name: str, url: str, method: str, status: int, regexp: str,
+def test_do_check(mock_session, name: str, url: str, method: str, status: int, regexp: str,
                   res_status: int, res_text: str, expected_call, expected: dict):
 
-    set_mock_request(mock_request, res_status, text=res_text)
-    resp = asyncio.run(do_check(name, url, method=method, status=status, regexp=regexp))
+    set_mock_request(mock_session.request, res_status, text=res_text)
+    resp = dict(asyncio.run(do_check(mock_session, name, url, method=method, status=status, regexp=regexp)))
 
-    actual_args, actual_kwargs = mock_request.call_args
+    actual_args, actual_kwargs = mock_session.request.call_args
+    timings = actual_kwargs.pop('trace_request_ctx')
     assert (actual_args, actual_kwargs) == expected_call
+    assert 'download' in timings
 
     expected.pop('duration')
     resp.pop('duration')
+    # other phases are traced by session
+    assert [resp.pop(k) is not None for k in broker.TIMING_FIELDS] == [False, False, False, True, bool(regexp)]
     assert UUID(resp.pop('id'))
     assert datetime.fromisoformat(resp.pop('dt'))
     assert resp == expected
 
 
+def make_result(check_name: str, health: bool, status: int, duration: float, length: int = None,
+                sample: str = None) -> CheckResult:
+    return CheckResult(id='6301e00b-65b3-411d-97c8-3ec1da1e5eb5', check_name=check_name, dt=datetime(2023, 1, 1),
+                       health=health, status=status, duration=duration, length=length, sample=sample)
+
+
 @mark.parametrize("name, url, method, status, regexp, expected_call_do_check, do_check_res", [
     param('test1', 'https://google.com', 'GET', 200, None,
-          (('test1', 'https://google.com'), {'method': 'GET', 'status': 200, 'regexp': None, 'timeout': None}),
-          {'check_name': 'test1', 'health': True, 'status': 200, 'duration': 1.5, 'length': 3, 'sample': None}),
+          ((MOCK_SESSION, 'test1', 'https://google.com'),
+           {'method': 'GET', 'status': 200, 'regexp': None, 'timeout': None}),
+          make_result('test1', health=True, status=200, duration=1.5, length=3)),
     param('test2', 'https://stackoverflow.com', 'POST', None, r'(?<=pp)\d+(?=ss)',
-          (('test2', 'https://stackoverflow.com'), {'method': 'POST', 'status': None, 'regexp': r'(?<=pp)\d+(?=ss)',
-                                                    'timeout': None}),
-          {'check_name': 'test2', 'health': True, 'status': 201, 'duration': 0.1, 'length': 6, 'sample': '23'}),
+          ((MOCK_SESSION, 'test2', 'https://stackoverflow.com'),
+           {'method': 'POST', 'status': None, 'regexp': r'(?<=pp)\d+(?=ss)', 'timeout': None}),
+          make_result('test2', health=True, status=201, duration=0.1, length=6, sample='23')),
     param('test3', 'http://localhost', None, 200, None,
-          (('test3', 'http://localhost'), {'method': 'GET', 'status': 200, 'regexp': None, 'timeout': None}),
-          {'check_name': 'test3', 'health': False, 'status': 500, 'duration': 0.5, 'length': 21, 'sample': None}),
+          ((MOCK_SESSION, 'test3', 'http://localhost'),
+           {'method': 'GET', 'status': 200, 'regexp': None, 'timeout': None}),
+          make_result('test3', health=False, status=500, duration=0.5, length=21)),
 ])
 @mock.patch('health_checker.do_check')
-def test_check_website(mock_do_check, mock_producer, name: str, url: str, method: str, status: int, regexp: str,
+def test_check_website(mock_do_check, name: str, url: str, method: str, status: int, regexp: str,
                        expected_call_do_check, do_check_res: dict):
 
     mock_do_check.return_value = do_check_res
+    queue = asyncio.Queue()
 
-    asyncio.run(check_website(
-        mock_producer,
-        check_name=name,
-        url=url,
-        method=method,
-        status=status,
-        regexp=regexp,
-    ))
+    asyncio.run(check_website(queue, MOCK_SESSION, CheckSpec(name, url, method=method, status=status, regexp=regexp)))
 
     actual_args, actual_kwargs = mock_do_check.call_args
     assert (actual_args, actual_kwargs) == expected_call_do_check
 
-    expected_call_provider_send = ((broker.TOPIC_NAME, do_check_res), {})
-    actual_args, actual_kwargs = mock_producer.send.call_args
-    assert (actual_args, actual_kwargs) == expected_call_provider_send
+    assert queue.get_nowait() == (broker.TOPIC_NAME, do_check_res)
+
+
+def test_create_session():
+    async def create():
+        session = await create_session()
+        actual = session.connector.limit, session.connector.limit_per_host, session.timeout
+        await session.close()
+        return actual
+
+    expected = health_checker.CONNECTION_LIMIT, health_checker.CONNECTION_LIMIT_PER_HOST, health_checker.DEFAULT_TIMEOUT
+    assert asyncio.run(create()) == expected
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, n):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def fake_stream_resp(chunks, content_length=None, charset='utf-8', encoding=None):
+    resp = mock.Mock()
+    resp.content = FakeStream(chunks)
+    resp.content_length = content_length
+    resp.headers = {'Content-Encoding': encoding} if encoding else {}
+    resp.charset = charset
+    return resp
+
+
+@mark.parametrize("chunks, content_length, max_bytes, regexp, expected", [
+    param([b'aaa', b'bbb'], None, 100, None, (6, None), id='no-regexp'),
+    param([b'aaa', b'bbb'], 1000, 4, None, (1000, None), id='no-regexp-content-length'),
+    param([b'xxpp1', b'23ssxx'], None, 100, r'(?<=pp)\d+(?=ss)', (11, '123'), id='match-across-chunks'),
+    param([b'pp12ss', b'xx'], 8, 100, r'(?<=pp)\d+(?=ss)', (8, '12'), id='match-in-first-chunk'),
+    param([b'xxpp1', b'23ssxx'], None, 6, r'(?<=pp)\d+(?=ss)', (6, None), id='cut-by-max-bytes'),
+    param(['привет'.encode()[:5], 'привет'.encode()[5:]], None, 100, 'привет', (12, 'привет'), id='split-utf8'),
+])
+def test_read_stream(chunks, content_length, max_bytes, regexp, expected):
+    resp = fake_stream_resp(chunks, content_length=content_length)
+    actual = asyncio.run(read_stream(resp, max_bytes, regexp=re.compile(regexp) if regexp else None))
+    assert actual == expected
+
+
+def test_read_compressed_stream():
+    # Content-Length is size of compressed body, so bytes of decompressed body are counted
+    resp = fake_stream_resp([b'aaa', b'bbb'], content_length=1000, encoding='gzip')
+    assert asyncio.run(read_stream(resp, 4)) == (4, None)
+
+
+@mock.patch('matcher.REGEXP_TIMEOUT', 0.01)
+@mock.patch('matcher.search', side_effect=lambda *args: time.sleep(0.02) or ('23', 0.02))
+def test_do_check_regexp_over_budget(mock_search, mock_session):
+    set_mock_request(mock_session.request, *TEST_RESP2)
+    resp = asyncio.run(do_check(mock_session, 'test2', 'https://stackoverflow.com', status=None, regexp=r'\d+'))
+    assert (resp['health'], resp['sample'], resp['regexp']) == (False, None, 0.01)
+
+
+@mock.patch('matcher.REGEXP_TIMEOUT', 0.01)
+@mock.patch('matcher.search', side_effect=lambda *args: time.sleep(0.02) or ('23', 0.02))
+def test_read_stream_regexp_over_budget(mock_search):
+    # reading stops on exceeded budget, so the next chunks aren't searched
+    resp = fake_stream_resp([b'pp1', b'23ss', b'xx'])
+    timings = {}
+    assert asyncio.run(read_stream(resp, 100, regexp=re.compile(r'\d+'), timings=timings)) == (3, None)
+    assert mock_search.call_count == 1 and timings['regexp'] == 0.01
+
+
+def test_read_stream_offload():
+    pool = mock.Mock()
+    pool.search = mock.AsyncMock(return_value=('12', 0.001))
+    resp = fake_stream_resp([b'pp12ss', b'xx'])
+    with mock.patch('matcher.REGEXP_OFFLOAD_SIZE', 4):
+        actual = asyncio.run(read_stream(resp, 100, regexp=re.compile(r'\d+'), regexp_timeout=2, regexp_pool=pool))
+    assert actual == (6, '12')
+    pool.search.assert_awaited_once_with(re.compile(r'\d+'), 'pp12ss', 2)
+
+
+def test_do_check_invalid_regexp(mock_session):
+    resp = asyncio.run(do_check(mock_session, 'test1', 'https://google.com', regexp='(unclosed'))
+    assert (resp['health'], resp['status'], resp['sample']) == (
+        False, None, 'invalid regexp: missing ), unterminated subpattern at position 0')
+    mock_session.request.assert_not_called()
+
+
+def set_mock_raw_request(mock_obj, status, body=None, headers=None):
+    resp = mock_obj.return_value.__aenter__.return_value
+    resp.status = status
+    resp.headers = headers or {}
+    resp.get_encoding = mock.Mock(return_value='utf-8')
+
+    async def read():
+        return body
+
+    resp.read = read
+
+
+def test_do_check_conditional(mock_session):
+    async def run(status, body=None, headers=None):
+        set_mock_raw_request(mock_session.request, status, body, headers)
+        return await do_check(mock_session, 'conditional', 'https://google.com', status=200, regexp=r'\d+',
+                              headers={'X-API-KEY': '1'}, conditional=True)
+
+    health_checker.RESPONSE_CACHE.pop('conditional', None)
+    first = asyncio.run(run(200, b'pp23ss', {'ETag': '"v1"'}))
+    assert mock_session.request.call_args.kwargs['headers'] == {'X-API-KEY': '1'}
+    assert (first['status'], first['sample'], first['length']) == (200, '23', 6)
+
+    # not modified page reuses sample of the last response
+    not_modified = asyncio.run(run(304))
+    assert mock_session.request.call_args.kwargs['headers'] == {'X-API-KEY': '1', 'If-None-Match': '"v1"'}
+    assert (not_modified['health'], not_modified['status'], not_modified['sample']) == (True, 200, '23')
+    assert not_modified['regexp'] is None
+
+    # the same body isn't searched again, changed one is
+    unchanged = asyncio.run(run(200, b'pp23ss'))
+    assert (unchanged['sample'], unchanged['regexp']) == ('23', None)
+    # validators of unchanged body are refreshed
+    asyncio.run(run(200, b'pp23ss', {'ETag': '"v2"'}))
+    asyncio.run(run(304))
+    assert mock_session.request.call_args.kwargs['headers'] == {'X-API-KEY': '1', 'If-None-Match': '"v2"'}
+    changed = asyncio.run(run(200, b'pp45ss'))
+    assert changed['sample'] == '45' and changed['regexp'] is not None
+
+
+def test_do_check_stream(mock_session):
+    mock_session.request.return_value.__aenter__.return_value = fake_stream_resp([b'xxpp1', b'23ssxx'])
+    mock_session.request.return_value.__aenter__.return_value.status = 200
+    resp = asyncio.run(do_check(mock_session, 'test1', 'https://google.com', status=200,
+                                regexp=r'(?<=pp)\d+(?=ss)', max_bytes=100))
+    assert resp['health'] is True
+    assert (resp['length'], resp['sample']) == (11, '123')
+
+
+def test_shard_sites():
+    sites = {f'site{i}': {'url': f'http://site{i}.com'} for i in range(100)}
+    shards = shard_sites(sites, 4)
+    assert len(shards) == 4
+    assert sorted(name for shard in shards for name in shard) == sorted(sites)
+    # sharding is stable
+    assert shard_sites(sites, 4) == shards
+    assert shard_sites(dict(reversed(sites.items())), 4) == [dict(reversed(shard.items())) for shard in shards]
+
+
+@mark.parametrize("reload_interval, expected_shards", [
+    param(None, [shard_of('test1', 8)], id='without-empty'),
+    param(10, list(range(8)), id='reload'),
+])
+def test_run_workers(reload_interval, expected_shards):
+    with mock.patch('health_checker.workers.run_workers') as mock_run_workers, \
+            mock.patch('health_checker.SITES_RELOAD_INTERVAL', reload_interval):
+        run_workers({'test1': {}}, workers_count=8, sites_file='sites.json')
+
+    target, args_list = mock_run_workers.call_args.args
+    assert target == health_checker.run_worker
+    assert [args[1] for args in args_list] == expected_shards
+
+
+@mock.patch('health_checker.do_check')
+def test_check_website_limited(mock_do_check):
+    mock_do_check.return_value = make_result('test1', health=False, status=None, duration=0.1)
+    checks_limiter = Limiter(limit=1, per_host=1)
+    queue = asyncio.Queue()
+
+    asyncio.run(check_website(queue, MOCK_SESSION, CheckSpec('test1', 'https://google.com/path'),
+                              checks_limiter=checks_limiter))
+
+    assert (checks_limiter.requests, checks_limiter.failures) == (1, 1)
+    assert list(checks_limiter.host_semaphores) == ['google.com']
+    assert queue.qsize() == 1
+
+
+@mock.patch('health_checker.do_check')
+def test_check_website_circuit(mock_do_check):
+    mock_do_check.side_effect = lambda *args, **kwargs: make_result('test1', health=False, status=None, duration=0.1)
+    circuits = Circuits(failures=2, backoff=60)
+    queue = asyncio.Queue()
+
+    async def run():
+        for _ in range(3):
+            await check_website(queue, MOCK_SESSION, CheckSpec('test1', 'https://google.com'), circuits=circuits)
+
+    asyncio.run(run())
+
+    # the third check is skipped by open circuit
+    assert mock_do_check.call_count == 2
+    results = [queue.get_nowait()[1] for _ in range(queue.qsize())]
+    assert ['circuit' in res for res in results] == [False, True]
+    assert results[1]['circuit'] == OPENED
+    # outage starts at the first failed check
+    assert results[1]['failed_since'] == results[0]['dt']
+
+
+def test_check_result_serialization():
+    timings = {'dns': None, 'connect': 0.0123456789, 'ttfb': 0.1, 'download': 0.2, 'regexp': 0.001}
+    result = CheckResult(id=UUID('6301e00b-65b3-411d-97c8-3ec1da1e5eb5'), check_name='test1',
+                         dt=datetime(2023, 1, 1), health=True, status=200, duration=0.3, length=3, sample='23',
+                         timings=timings, circuit='closed')
+    expected = {'id': '6301e00b-65b3-411d-97c8-3ec1da1e5eb5', 'check_name': 'test1', 'dt': '2023-01-01T00:00:00',
+                'health': True, 'status': 200, 'duration': 0.3, 'length': 3, 'sample': '23', 'dns': None,
+                'connect': 0.012346, 'ttfb': 0.1, 'download': 0.2, 'regexp': 0.001, 'circuit': 'closed'}
+    assert dict(result) == expected
+    for fmt in ['json', 'binary']:
+        assert broker.deserialize(broker.serialize(result, fmt), broker.message_headers(fmt)) == expected
+
+
+def test_observe_limiter():
+    checks_limiter = Limiter(limit=5, per_host=2)
+    checks_limiter.in_flight = 3
+    checks_limiter.hosts_in_flight['google.com'] = 2
+    observe_limiter(checks_limiter)
+
+    lines = metrics.render().splitlines()
+    for line in ['healthchecker_concurrency_limit 5', 'healthchecker_checks_in_flight 3',
+                 'healthchecker_checks_waiting 0', 'healthchecker_host_checks_in_flight{host="google.com"} 2']:
+        assert line in lines
@@ -0,0 +1,64 @@
+import asyncio
+
+from pytest import mark, param
+
+from limiter import Limiter
+
+
+def run_checks(limiter: Limiter, hosts: list, duration: float = 0.01):
+    """Run checks of hosts through limiter, returns max number of checks in flight globally and per host"""
+    max_in_flight = [0, 0]
+
+    async def check(host):
+        async with limiter.slot(host):
+            max_in_flight[0] = max(max_in_flight[0], limiter.in_flight)
+            max_in_flight[1] = max(max_in_flight[1], limiter.hosts_in_flight[host])
+            await asyncio.sleep(duration)
+
+    async def run():
+        await asyncio.gather(*[check(host) for host in hosts])
+
+    asyncio.run(run())
+    return tuple(max_in_flight)
+
+
+@mark.parametrize("limit, per_host, hosts, expected", [
+    param(None, None, ['a'] * 5 + ['b'] * 2, (7, 5), id='unlimited'),
+    param(3, None, ['a'] * 5 + ['b'] * 2, (3, 3), id='global'),
+    param(None, 2, ['a'] * 5 + ['b'] * 2, (4, 2), id='per-host'),
+    param(3, 2, ['a'] * 5 + ['b'] * 2, (3, 2), id='both'),
+])
+def test_slot(limit, per_host, hosts, expected):
+    limiter = Limiter(limit=limit, per_host=per_host)
+    assert run_checks(limiter, hosts) == expected
+    assert limiter.stats() == {'limit': limit, 'in_flight': 0, 'waiting': 0, 'hosts_in_flight': {}, 'loop_lag': 0}
+
+
+def test_cancel_waiting():
+    async def run():
+        limiter = Limiter(limit=1)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        limiter.release()
+        return limiter.stats()
+
+    stats = asyncio.run(run())
+    assert (stats['in_flight'], stats['waiting']) == (0, 0)
+
+
+@mark.parametrize("loop_lag, requests, failures, waiters, expected", [
+    param(0.5, 10, 0, 0, 67, id='loop-lag'),
+    param(0, 10, 5, 0, 67, id='failures'),
+    param(0, 10, 0, 1, 100, id='increase-to-max'),
+    param(0, 10, 0, 0, 90, id='no-demand'),
+])
+def test_adjust(loop_lag, requests, failures, waiters, expected):
+    limiter = Limiter(limit=100, min_limit=10)
+    limiter.limit = 90
+    limiter.requests, limiter.failures = requests, failures
+    limiter.waiters.extend(asyncio.Future(loop=asyncio.new_event_loop()) for _ in range(waiters))
+    limiter.adjust(loop_lag, max_loop_lag=0.1, max_failure_rate=0.2)
+    assert limiter.limit == expected
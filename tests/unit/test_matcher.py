@@ -0,0 +1,52 @@
+import asyncio
+import re
+from unittest import mock
+
+import pytest
+
+import matcher
+from matcher import RegexpPool, RegexpTimeout, get_pattern, search_text
+
+
+CATASTROPHIC_REGEXP = re.compile(r'(a+)+$')
+CATASTROPHIC_TEXT = 'a' * 40 + 'b'
+
+
+def test_get_pattern_cached():
+    assert get_pattern(r'\d+') is get_pattern(r'\d+')
+    assert get_pattern(CATASTROPHIC_REGEXP) is CATASTROPHIC_REGEXP
+
+
+def test_search_text():
+    sample, cpu_time = asyncio.run(search_text(re.compile(r'\d+'), 'abc 123'))
+    assert sample == '123'
+    assert cpu_time >= 0
+
+
+def test_search_text_over_budget():
+    with mock.patch('matcher.search', side_effect=lambda *args: matcher.time.sleep(0.02) or (None, 0.02)):
+        with pytest.raises(RegexpTimeout):
+            asyncio.run(search_text(re.compile(r'\d+'), 'abc 123', timeout=0.01))
+
+
+@mock.patch('matcher.REGEXP_OFFLOAD_SIZE', 10)
+def test_pool():
+    async def run():
+        pool = RegexpPool(processes=2)
+        try:
+            small = await search_text(re.compile(r'\d+'), 'abc 123', pool=pool)
+            # catastrophic backtracking is aborted by budget and processes are restarted for the next searches
+            searches = await asyncio.gather(
+                search_text(CATASTROPHIC_REGEXP, CATASTROPHIC_TEXT, timeout=2, pool=pool),
+                search_text(re.compile(r'\d+'), 'x' * 20 + '456', timeout=2, pool=pool),
+                return_exceptions=True)
+            large = await search_text(re.compile(r'\d+'), 'x' * 20 + '789', timeout=2, pool=pool)
+            return small, searches, large
+        finally:
+            pool.close()
+
+    small, (catastrophic, found), large = asyncio.run(run())
+    assert small[0] == '123'
+    assert isinstance(catastrophic, RegexpTimeout)
+    assert found[0] == '456'
+    assert large[0] == '789'
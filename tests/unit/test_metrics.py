@@ -0,0 +1,31 @@
+from metrics import Counter, Gauge, Histogram, render
+
+
+def test_render():
+    registry = {}
+    counter = Counter('checks_total', 'Number of checks', registry=registry)
+    gauge = Gauge('queue_size', 'Size of queue', registry=registry)
+    histogram = Histogram('duration_seconds', 'Duration', buckets=[0.1, 1], registry=registry)
+    counter.inc(health='true')
+    counter.inc(2, health='true')
+    gauge.set_function(lambda: 7)
+    gauge.set_label_function('host', lambda: {'a.com': 2})
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value, phase='dns')
+
+    assert render(registry).splitlines() == [
+        '# HELP checks_total Number of checks',
+        '# TYPE checks_total counter',
+        'checks_total{health="true"} 3',
+        '# HELP queue_size Size of queue',
+        '# TYPE queue_size gauge',
+        'queue_size 7',
+        'queue_size{host="a.com"} 2',
+        '# HELP duration_seconds Duration',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{phase="dns",le="0.1"} 2',
+        'duration_seconds_bucket{phase="dns",le="1.0"} 3',
+        'duration_seconds_bucket{phase="dns",le="+Inf"} 4',
+        'duration_seconds_sum{phase="dns"} 3.65',
+        'duration_seconds_count{phase="dns"} 4',
+    ]
@@ -0,0 +1,115 @@
+import asyncio
+from unittest import mock
+
+from pytest import mark, param
+
+import publisher
+from publisher import enqueue, get_batch, publish_forever, close_publisher, drain_spool
+from spool import Spool
+
+
+TEST_RESULTS = [('topic', {'check_name': f'test{i}', 'health': True}) for i in range(5)]
+
+
+@mark.parametrize("items, batch_size, expected", [
+    param(TEST_RESULTS[:1], 10, TEST_RESULTS[:1], id='single'),
+    param(TEST_RESULTS, 10, TEST_RESULTS, id='all'),
+    param(TEST_RESULTS, 2, TEST_RESULTS[:2], id='limited'),
+])
+def test_get_batch(items, batch_size, expected):
+    async def run():
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        return await get_batch(queue, batch_size=batch_size, linger=0.01)
+
+    assert asyncio.run(run()) == expected
+
+
+def test_enqueue_backpressure():
+    async def run():
+        queue = asyncio.Queue(maxsize=1)
+        await enqueue(queue, *TEST_RESULTS[0])
+        waiting = asyncio.create_task(enqueue(queue, *TEST_RESULTS[1]))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        queue.get_nowait()
+        await waiting
+        return queue.get_nowait()
+
+    waits = publisher.stats['waits']
+    assert asyncio.run(run()) == TEST_RESULTS[1]
+    assert publisher.stats['waits'] == waits + 1
+    assert publisher.EVENTS.values[(('event', 'waits'),)] == publisher.stats['waits']
+
+
+def test_publish_and_close():
+    producer = mock.Mock()
+
+    async def run():
+        queue = asyncio.Queue()
+        sender = asyncio.create_task(publish_forever(producer, queue, batch_size=2, linger=0.01))
+        for item in TEST_RESULTS:
+            await enqueue(queue, *item)
+        await close_publisher(producer, queue, sender)
+
+    asyncio.run(run())
+    assert [c.args for c in producer.send.call_args_list] == TEST_RESULTS
+    # results are keyed by check name, so results of a check keep their order in a partition
+    assert [c.kwargs['key'] for c in producer.send.call_args_list] == [v['check_name'] for _, v in TEST_RESULTS]
+    producer.flush.assert_called_once()
+
+
+def test_enqueue_spool(tmp_path):
+    spool = Spool(str(tmp_path))
+
+    async def run():
+        queue = asyncio.Queue(maxsize=1)
+        for item in TEST_RESULTS[:3]:
+            await enqueue(queue, *item, spool=spool)
+        return queue.get_nowait()
+
+    assert asyncio.run(run()) == TEST_RESULTS[0]
+    assert spool.read(10) == TEST_RESULTS[1:3]
+
+
+def test_publish_failed_to_spool(tmp_path):
+    spool = Spool(str(tmp_path))
+    producer = mock.Mock()
+    future = mock.Mock()
+    # the third result isn't passed to producer, the first one fails on delivery
+    producer.send.side_effect = [future, mock.Mock(), Exception('buffer is full')]
+
+    async def run():
+        queue = asyncio.Queue()
+        sender = asyncio.create_task(publish_forever(producer, queue, batch_size=5, linger=0.01, spool=spool))
+        for item in TEST_RESULTS[:4]:
+            await enqueue(queue, *item)
+        await queue.join()
+        errback, *args = future.add_errback.call_args.args
+        errback(*args, Exception('delivery failed'))
+        await close_publisher(producer, queue, sender, spool)
+
+    asyncio.run(run())
+    assert Spool(str(tmp_path)).read(10) == TEST_RESULTS[2:4] + TEST_RESULTS[:1]
+
+
+def test_drain_spool(tmp_path):
+    spool = Spool(str(tmp_path))
+    for item in TEST_RESULTS:
+        spool.append(*item)
+    producer = mock.Mock()
+    # the first attempt fails on delivery, spooled results are republished in order by the next ones
+    producer.send.return_value.get.side_effect = [Exception('timeout')] + [None] * len(TEST_RESULTS)
+
+    async def run():
+        drainer = asyncio.create_task(drain_spool(producer, spool, asyncio.Queue(), batch_size=3, interval=0.01))
+        while spool.records:
+            await asyncio.sleep(0.01)
+        drainer.cancel()
+
+    asyncio.run(run())
+    sent = [c.args for c in producer.send.call_args_list]
+    assert sent == TEST_RESULTS[:3] + TEST_RESULTS
+    assert producer.send.call_args.kwargs['key'] == TEST_RESULTS[-1][1]['check_name']
+    assert spool.stats()['drained'] == len(TEST_RESULTS)
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime, timedelta
+import time
+
+from pytest import mark, param
+
+from scheduler import LoopScheduler
+
+
+def run_scheduler(func, timeout: float, **job_kwargs):
+    """Run scheduler with single job, dates of job are passed as offsets in seconds from now"""
+    now = datetime.now()
+    for k in ['next_run_time', 'start_date', 'end_date']:
+        if k in job_kwargs:
+            job_kwargs[k] = now + timedelta(seconds=job_kwargs[k])
+
+    async def run():
+        schedule = LoopScheduler(event_loop=asyncio.get_running_loop())
+        schedule.add_job(func, name='test', **job_kwargs)
+        schedule.start()
+        await asyncio.sleep(timeout)
+        schedule.shutdown()
+        return schedule
+
+    return asyncio.run(run())
+
+
+@mark.parametrize("job_kwargs, expected", [
+    param({'seconds': 0.1}, 3, id='interval'),
+    param({'seconds': 0.1, 'next_run_time': 0}, 4, id='run-now'),
+    param({'seconds': 0.1, 'next_run_time': 0, 'end_date': 0.15}, 2, id='end-date'),
+    param({'seconds': 0.1, 'start_date': 0.2}, 2, id='start-date'),
+])
+def test_interval(job_kwargs, expected):
+    runs = []
+    run_scheduler(lambda: runs.append(1), 0.35, **job_kwargs)
+    assert len(runs) == expected
+
+
+def test_max_instances():
+    runs = []
+
+    async def slow():
+        runs.append(1)
+        await asyncio.sleep(0.25)
+
+    run_scheduler(slow, 0.35, seconds=0.1, next_run_time=0)
+    # runs at 0.1 and 0.2 are skipped because the first one is still running
+    assert len(runs) == 2
+
+
+def test_coalesce():
+    runs = []
+
+    def blocking():
+        runs.append(1)
+        if len(runs) == 1:
+            # blocks the loop so runs at 0.1 and 0.2 are missed and coalesced into single one
+            time.sleep(0.25)
+
+    run_scheduler(blocking, 0.35, seconds=0.1, next_run_time=0)
+    assert len(runs) == 3
+
+
+def test_remove_job():
+    async def run():
+        schedule = LoopScheduler(event_loop=asyncio.get_running_loop())
+        job = schedule.add_job(lambda: None, name='test', seconds=1)
+        schedule.start()
+        schedule.remove_job(job.id)
+        return job, schedule.get_jobs()
+
+    job, jobs = asyncio.run(run())
+    assert jobs == []
+    assert job.handle.cancelled()
+
+
+def test_lateness():
+    lateness = []
+
+    async def run():
+        schedule = LoopScheduler(event_loop=asyncio.get_running_loop(), on_lateness=lateness.append)
+        schedule.add_job(lambda: None, name='test', seconds=0.05)
+        schedule.start()
+        await asyncio.sleep(0.02)
+        # blocked event loop delays the first run
+        time.sleep(0.08)
+        await asyncio.sleep(0.01)
+        schedule.shutdown()
+
+    asyncio.run(run())
+    assert len(lateness) == 1 and lateness[0] >= 0.04
+
+
+def test_args():
+    calls = []
+    run_scheduler(lambda *args, **kwargs: calls.append((args, kwargs)), 0.05, seconds=1, next_run_time=0,
+                  args=('spec',), kwargs={'limiter': None})
+    assert calls == [(('spec',), {'limiter': None})]
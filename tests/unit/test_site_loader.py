@@ -1,13 +1,24 @@
+import asyncio
+import copy
 from datetime import timedelta
+import io
 import json
-import re
+import os
+import threading
+from unittest import mock
 
 from aiohttp import BasicAuth, ClientTimeout
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.job import Job
 from apscheduler.triggers.interval import IntervalTrigger
+import pytest
+from pytest import mark, param
 
-from sites_loader import parse_sites, schedule_sites
+from checks import CheckSpec
+from scheduler import LoopScheduler
+import sites_loader
+from sites_loader import (parse_sites, schedule_sites, diff_sites, reschedule_sites, watch_sites_file, iter_json_object,
+                          read_sites, validate_sites, expand_sites, SitesError)
 
 
 def check_website(*args, **kwargs):
@@ -38,20 +49,20 @@ EXPECTED_JOBS = [
     {
         'name': 'test1',
         'func': check_website,
-        'args': tuple(),
-        'kwargs': {
-            'check_name': 'test1',
-            "url": "http://test1.com",
-            "method": "POST",
-            "auth": BasicAuth("user", "pass"),
-            "headers": {
+        'args': (CheckSpec(
+            'test1',
+            url="http://test1.com",
+            method="POST",
+            auth=BasicAuth("user", "pass"),
+            headers={
                 "X-API-KEY": "123456789AAA"
             },
-            "data": b'hello',
-            "timeout": ClientTimeout(total=3),
-            "status": 200,
-            "regexp": None,
-        },
+            data=b'hello',
+            timeout=ClientTimeout(total=3),
+            status=200,
+            regexp=None,
+        ),),
+        'kwargs': {},
         'trigger': {
             'type': IntervalTrigger,
             'interval': timedelta(seconds=5),
@@ -62,13 +73,13 @@ EXPECTED_JOBS = [
     {
         'name': 'test2',
         'func': check_website,
-        'args': tuple(),
-        'kwargs': {
-            'check_name': 'test2',
-            "url": "https://test2.com",
-            "status": None,
-            "regexp": re.compile(r"(?<=aaa)\d+(?=bbb)"),
-        },
+        'args': (CheckSpec(
+            'test2',
+            url="https://test2.com",
+            status=None,
+            regexp=r"(?<=aaa)\d+(?=bbb)",
+        ),),
+        'kwargs': {},
         'trigger': {
             'type': IntervalTrigger,
             'interval': timedelta(minutes=10),
@@ -100,3 +111,208 @@ def test_schedule_sites():
     schedule_sites(schedule, check_website, sites)
     actual_jobs = list(map(dump_job, schedule.get_jobs()))
     assert actual_jobs == EXPECTED_JOBS
+
+
+def test_schedule_sites_spread():
+    sites = parse_sites(json.dumps(TEST_SITES))
+    loop = asyncio.new_event_loop()
+    schedule = LoopScheduler(event_loop=loop)
+    schedule_sites(schedule, check_website, sites, spread=True)
+    now = loop.time()
+    loop.close()
+    # first runs are spread across intervals: 0 of 5 seconds for test1, 1/2 of 10 minutes for test2
+    actual = [(job.name, round(job.next_run - now)) for job in schedule.get_jobs()]
+    assert actual == [('test1', 0), ('test2', 300)]
+
+
+def test_diff_sites():
+    new = copy.deepcopy(TEST_SITES)
+    new['test2']['minutes'] = 5
+    new['test3'] = {'url': 'http://test3.com', 'seconds': 1}
+    del new['test1']
+    assert diff_sites(TEST_SITES, new) == (['test3'], ['test1'], ['test2'])
+
+
+def test_reschedule_sites():
+    new = copy.deepcopy(TEST_SITES)
+    new['test2']['minutes'] = 5
+    new['test3'] = {'url': 'http://test3.com', 'seconds': 1}
+
+    schedule = BlockingScheduler()
+    schedule_sites(schedule, check_website, parse_sites(json.dumps(TEST_SITES)))
+    test1_job = schedule.get_job('test1')
+    unscheduled = []
+    reschedule_sites(schedule, check_website, TEST_SITES, new, on_unscheduled=unscheduled.extend)
+
+    jobs = {job.id: job for job in schedule.get_jobs()}
+    assert sorted(jobs) == ['test1', 'test2', 'test3']
+    assert jobs['test1'] is test1_job
+    assert jobs['test2'].trigger.interval == timedelta(minutes=5)
+    assert unscheduled == ['test2']
+    # definitions of sites aren't changed by parsing
+    assert new['test3'] == {'url': 'http://test3.com', 'seconds': 1}
+
+
+def test_watch_sites_file(tmp_path):
+    fn = tmp_path / 'sites.json'
+    fn.write_text(json.dumps(TEST_SITES))
+    new = {**TEST_SITES, 'test3': {'url': 'http://test3.com', 'seconds': 1}}
+
+    async def run():
+        schedule = LoopScheduler(event_loop=asyncio.get_running_loop())
+        schedule_sites(schedule, check_website, {k: v for k, v in parse_sites(fn.read_text()).items() if k != 'test2'})
+        watcher = asyncio.create_task(watch_sites_file(
+            str(fn), schedule, check_website, 0.01, site_filter=lambda name: name != 'test2'))
+        await asyncio.sleep(0.02)
+        fn.write_text(json.dumps(new))
+        os.utime(fn, (0, 0))
+        await asyncio.sleep(0.05)
+        watcher.cancel()
+        return sorted(job.id for job in schedule.get_jobs())
+
+    assert asyncio.run(run()) == ['test1', 'test3']
+
+
+def test_watch_sites_file_in_thread(tmp_path):
+    fn = tmp_path / 'sites.json'
+    fn.write_text(json.dumps(TEST_SITES))
+    threads = []
+    original = sites_loader.load_sites
+
+    def load_sites(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return original(*args, **kwargs)
+
+    async def run():
+        schedule = LoopScheduler(event_loop=asyncio.get_running_loop())
+        with mock.patch('sites_loader.load_sites', side_effect=load_sites):
+            watcher = asyncio.create_task(watch_sites_file(str(fn), schedule, check_website, 0.01))
+            await asyncio.sleep(0.02)
+            assert not watcher.done()
+            watcher.cancel()
+
+    asyncio.run(run())
+    # sites are loaded out of event loop
+    assert threads and threading.main_thread() not in threads
+
+
+@mark.parametrize("chunk_size", [1, 7, 1024])
+def test_iter_json_object(chunk_size):
+    data = json.dumps({**TEST_SITES, 'test3': {'url': 'http://test3.com', 'seconds': 12345}}, indent=2)
+    actual = list(iter_json_object(io.StringIO(data), chunk_size=chunk_size))
+    assert actual == list(json.loads(data).items())
+
+
+@mark.parametrize("data", [
+    param('[]', id='not-object'),
+    param('{"test1": {"url": "http://test1.com"} "test2": {}}', id='no-comma'),
+    param('{"test1": {"url": "http://test1.com"}', id='truncated'),
+])
+def test_iter_json_object_invalid(data):
+    with pytest.raises(ValueError):
+        list(iter_json_object(io.StringIO(data), chunk_size=4))
+
+
+def test_validate_sites():
+    sites = {
+        **TEST_SITES,
+        'bad1': {'url': 'test.com', 'seconds': 5, 'status': '200'},
+        'bad2': {'url': 'http://test.com', 'timeout': -1, 'auth': 'user'},
+        'bad3': 'http://test.com',
+    }
+    with pytest.raises(SitesError) as exc_info:
+        validate_sites(sites)
+    # all errors are reported at once
+    assert exc_info.value.errors == [
+        'bad1.url: http(s) url is required',
+        'bad1.status: must be an integer or null',
+        'bad2.auth: must be a list of login, password and optional encoding',
+        'bad2.timeout: must be a positive number',
+        'bad2.interval: one of weeks, days, hours, minutes, seconds must be set',
+        'bad3: definition must be an object',
+    ]
+
+
+def test_validate_sites_regexp():
+    sites = {'test1': {'url': 'http://test1.com', 'seconds': 5, 'regexp': '(unclosed'}}
+    validate_sites(sites)
+    with pytest.raises(SitesError):
+        validate_sites(sites, compile_regexps=True)
+    # regexps are compiled lazily by checks
+    assert parse_sites(json.dumps(sites))['test1']['regexp'] == sites['test1']['regexp']
+
+
+def test_parse_sites_shared_settings():
+    sites = parse_sites(json.dumps({'test1': TEST_SITES['test1'], 'test1a': TEST_SITES['test1']}))
+    assert sites['test1']['timeout'] is sites['test1a']['timeout']
+    assert sites['test1']['auth'] is sites['test1a']['auth']
+
+
+@mark.parametrize("processes", [1, 2])
+def test_read_sites_directory(tmp_path, processes):
+    (tmp_path / 'a.json').write_text(json.dumps({'test1': TEST_SITES['test1']}))
+    (tmp_path / 'b.json').write_text(json.dumps({'test2': TEST_SITES['test2']}))
+    (tmp_path / 'readme.txt').write_text('not sites')
+    assert read_sites(str(tmp_path), processes=processes) == TEST_SITES
+
+    (tmp_path / 'c.json').write_text(json.dumps({'test1': TEST_SITES['test1']}))
+    with pytest.raises(SitesError):
+        read_sites(str(tmp_path), processes=processes)
+
+
+TEST_TEMPLATED_SITES = {
+    '$templates': {
+        'api': {'method': 'POST', 'headers': {'X-API-KEY': '123456789AAA'}, 'seconds': 5, 'timeout': 3},
+        'slow-api': {'template': 'api', 'timeout': 10},
+    },
+    'test1': {'template': 'api', 'url': 'http://test1.com', 'seconds': 10},
+    'shop': {'template': 'slow-api', 'regexp': '\\d+',
+             'urls': {'shop-main': 'http://shop.com', 'shop-cart': 'http://shop.com/cart'}},
+    'test2': TEST_SITES['test2'],
+}
+
+
+def test_expand_sites():
+    sites = expand_sites(TEST_TEMPLATED_SITES)
+    headers = TEST_TEMPLATED_SITES['$templates']['api']['headers']
+    assert sites == {
+        'test1': {'method': 'POST', 'headers': headers, 'seconds': 10, 'timeout': 3, 'url': 'http://test1.com'},
+        'shop-main': {'method': 'POST', 'headers': headers, 'seconds': 5, 'timeout': 10, 'regexp': '\\d+',
+                      'url': 'http://shop.com'},
+        'shop-cart': {'method': 'POST', 'headers': headers, 'seconds': 5, 'timeout': 10, 'regexp': '\\d+',
+                      'url': 'http://shop.com/cart'},
+        'test2': TEST_SITES['test2'],
+    }
+    # values of templates are shared by checks
+    assert sites['test1']['headers'] is sites['shop-main']['headers'] is headers
+
+
+def test_parse_templated_sites_shared_settings():
+    sites = parse_sites(json.dumps(TEST_TEMPLATED_SITES))
+    assert sites['shop-main']['headers'] is sites['shop-cart']['headers']
+    assert sites['shop-main']['timeout'] is sites['shop-cart']['timeout']
+
+
+def test_expand_sites_errors():
+    sites = {
+        '$templates': {'a': {'template': 'b'}, 'b': {'template': 'a'}, 'c': {'template': 'unknown'}},
+        'test1': {'template': 'missing', 'url': 'http://test1.com'},
+        'group': {'urls': {'test2': 'http://test2.com', 'test3': 'http://test3.com'}},
+        'test3': {'url': 'http://test3.com', 'seconds': 1},
+    }
+    with pytest.raises(SitesError) as exc_info:
+        expand_sites(sites)
+    assert exc_info.value.errors == [
+        '$templates.a: cyclic inheritance a -> b -> a',
+        '$templates.b: cyclic inheritance b -> a -> b',
+        "$templates.c.template: unknown template 'unknown'",
+        "test1.template: unknown template 'missing'",
+        'test3: defined again',
+    ]
+
+
+def test_read_sites_directory_templates(tmp_path):
+    (tmp_path / 'a.json').write_text(json.dumps({'$templates': TEST_TEMPLATED_SITES['$templates']}))
+    (tmp_path / 'b.json').write_text(json.dumps({'test1': TEST_TEMPLATED_SITES['test1']}))
+    sites = expand_sites(read_sites(str(tmp_path), processes=1))
+    assert sites['test1']['method'] == 'POST'
@@ -0,0 +1,69 @@
+import os
+
+from pytest import mark, param
+
+from spool import Spool
+
+
+TEST_RESULTS = [('topic', {'check_name': f'test{i}', 'health': True, 'sample': 'x' * 50}) for i in range(10)]
+
+
+def fill_spool(spool: Spool, items: list):
+    for topic_name, value in items:
+        assert spool.append(topic_name, value)
+
+
+@mark.parametrize("segment_size, batch_size", [
+    param(None, 3, id='single-segment'),
+    param(200, 3, id='segments'),
+    param(200, 100, id='segments-single-batch'),
+])
+def test_read_commit(tmp_path, segment_size, batch_size):
+    spool = Spool(str(tmp_path), segment_size=segment_size)
+    fill_spool(spool, TEST_RESULTS)
+    assert spool.records == len(TEST_RESULTS)
+
+    read = []
+    while spool.records:
+        batch = spool.read(batch_size)
+        read.extend(batch)
+        spool.commit(len(batch))
+    assert read == TEST_RESULTS
+    assert spool.stats()['bytes'] == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.seg')]
+
+
+def test_reopen(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=200)
+    fill_spool(spool, TEST_RESULTS[:6])
+    spool.commit(len(spool.read(2)))
+    # read but not committed results are read again
+    spool.read(2)
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=200)
+    assert spool.records == 4
+    fill_spool(spool, TEST_RESULTS[6:])
+    assert spool.read(100) == TEST_RESULTS[2:]
+
+
+def test_corrupted_tail(tmp_path):
+    spool = Spool(str(tmp_path))
+    fill_spool(spool, TEST_RESULTS[:3])
+    spool.close()
+    segment, = [name for name in os.listdir(tmp_path) if name.endswith('.seg')]
+    with open(os.path.join(tmp_path, segment), 'r+b') as f:
+        f.truncate(os.path.getsize(f.name) - 5)
+
+    spool = Spool(str(tmp_path))
+    assert spool.records == 2
+    fill_spool(spool, TEST_RESULTS[3:4])
+    assert spool.read(100) == TEST_RESULTS[:2] + TEST_RESULTS[3:4]
+
+
+def test_max_bytes(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=400)
+    appended = [spool.append(*item) for item in TEST_RESULTS]
+    assert appended == [True, True, True] + [False] * 7
+    assert spool.stats()['dropped'] == 7
+    assert spool.read(100) == TEST_RESULTS[:3]
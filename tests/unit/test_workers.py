@@ -0,0 +1,21 @@
+from unittest import mock
+
+from workers import restart_crashed_workers
+
+
+def run(*args):
+    pass
+
+
+@mock.patch('workers.start_worker')
+def test_restart_crashed_workers(mock_start_worker):
+    alive, finished, crashed = mock.Mock(), mock.Mock(), mock.Mock()
+    alive.is_alive.return_value, alive.exitcode = True, None
+    finished.is_alive.return_value, finished.exitcode = False, 0
+    crashed.is_alive.return_value, crashed.exitcode = False, 1
+    procs = [alive, finished, crashed]
+    args_list = [({'test1': {}}, ), ({'test2': {}}, ), ({'test3': {}}, )]
+
+    assert restart_crashed_workers(procs, run, args_list) == 1
+    mock_start_worker.assert_called_once_with(run, 2, ({'test3': {}}, ))
+    assert procs == [alive, finished, mock_start_worker.return_value]
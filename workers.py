@@ -0,0 +1,68 @@
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+from typing import Callable, List
+
+
+# define settings default values
+SUPERVISOR_INTERVAL = 1
+WORKER_RESTART_DELAY = 5
+
+# override settings by local values
+try:
+    from conf.local_settings import *       # noqa: F401, F403
+except ImportError:
+    pass
+
+
+log = logging.getLogger('app.workers')
+
+
+def stop_process(*args):
+    """SIGTERM handler, further signals are ignored to let the process flush results"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def init_worker():
+    """Worker process is stopped by supervisor with SIGTERM only"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_process)
+
+
+def start_worker(target: Callable, worker: int, args: tuple) -> multiprocessing.Process:
+    proc = multiprocessing.Process(target=target, args=(worker, *args), name=f'{target.__name__}-{worker}')
+    proc.start()
+    return proc
+
+
+def restart_crashed_workers(procs: List[multiprocessing.Process], target: Callable, args_list: List[tuple]) -> int:
+    """Restart workers exited with error, returns number of restarted workers"""
+    restarted = 0
+    for worker, proc in enumerate(procs):
+        if not proc.is_alive() and proc.exitcode:
+            log.error(f'worker {proc.name} exited with code {proc.exitcode}, restart')
+            procs[worker] = start_worker(target, worker, args_list[worker])
+            restarted += 1
+    return restarted
+
+
+def run_workers(target: Callable, args_list: List[tuple]):
+    """Run `target(worker, *args)` in process per args and restart crashed ones until all of them finish"""
+    signal.signal(signal.SIGTERM, stop_process)
+    procs = [start_worker(target, worker, args) for worker, args in enumerate(args_list)]
+    try:
+        while any(proc.is_alive() or proc.exitcode for proc in procs):
+            time.sleep(SUPERVISOR_INTERVAL)
+            if restart_crashed_workers(procs, target, args_list):
+                time.sleep(WORKER_RESTART_DELAY)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join()